@@ -0,0 +1,115 @@
+'''
+Limits on the amount of work done in a build (for bounded previews).
+
+A L{BuildBudget} given to a build space is checked before every
+queued generator is run. Generators deeper than the depth limit are
+not run. Once any other limit is reached, the build is stopped and the
+generators still waiting in the queue are not run. Since the queue
+holds the generators of the least importance (the deepest ones in BFS,
+the ones at the end of the order of priority schedulers), those are
+the subtrees which are cut off. Generators which were not run are kept
+in L{BuildSpace.truncated} and can be run later using
+L{BuildSpace.refine}.
+
+Limits are checked between generators, so a build can exceed a
+limit by the output of one generator.
+
+G{importgraph}
+'''
+
+import time
+
+from procodile.draw import SurfaceGroup, Instance
+
+def count_vertices(geom):
+    if isinstance(geom, Instance):
+        return len(geom.prototype.get_vertices())
+
+    if isinstance(geom, SurfaceGroup):
+        return sum(count_vertices(s) for s in geom.surfaces.itervalues())
+
+    return len(geom._get_gts_vertices())
+
+class BuildBudget:
+    '''
+    Limits (None means no limit) and the work done so far.
+    '''
+
+    #: limits in the order in which they are checked
+    LIMITS = ['max_generators', 'max_geoms', 'max_vertices', 'max_time']
+
+    def __init__(self, max_generators=None, max_geoms=None,
+                       max_vertices=None, max_depth=None,
+                       max_time=None):
+        '''
+        @param max_depth: generators deeper than this are not run
+            (the root generator is at depth 0)
+
+        @param max_time: wall clock time (seconds) from the start
+            of the build
+        '''
+        self.max_generators = max_generators
+        self.max_geoms = max_geoms
+        self.max_vertices = max_vertices
+        self.max_depth = max_depth
+        self.max_time = max_time
+
+        self.start()
+
+    def start(self):
+        '''
+        Reset work done; called when a build starts.
+        '''
+        self.num_generators = 0
+        self.num_geoms = 0
+        self.num_vertices = 0
+        self.start_time = time.time()
+
+        #: name of the limit which stopped the build (if any)
+        self.exceeded = None
+
+    def count(self, event, args):
+        if event == 'add_gen':
+            self.num_generators += 1
+
+        elif event == 'add_geom':
+            self.num_geoms += 1
+
+            # counting is not cheap; only when required
+            if self.max_vertices is not None:
+                gen_obj, geom = args
+                self.num_vertices += count_vertices(geom)
+
+    def _get_used(self, limit):
+        if limit == 'max_time':
+            return time.time() - self.start_time
+
+        # eg: max_geoms -> num_geoms
+        return getattr(self, 'num_' + limit[4:])
+
+    def is_exhausted(self):
+        if self.exceeded:
+            return True
+
+        for limit in self.LIMITS:
+            value = getattr(self, limit)
+
+            if value is not None and self._get_used(limit) >= value:
+                self.exceeded = limit
+                return True
+
+        return False
+
+    def allows(self, entry):
+        '''
+        Can the queued generator (L{scheduler.QueueEntry}) be run?
+        Generators queued without a parent (the root generator and
+        re-runs) always are, so that a build has something to show.
+        '''
+        if entry.parent is None:
+            return True
+
+        if self.max_depth is not None and entry.depth > self.max_depth:
+            return False
+
+        return not self.is_exhausted()
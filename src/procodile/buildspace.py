@@ -5,18 +5,34 @@ G{importgraph}
 '''
 
 import cStringIO
+import math
 import time
+import logging
+import itertools
+import threading
+import multiprocessing
+from collections import OrderedDict
 
-from rtree import index as rtree
+import numpy
 
 from procodile.xmlwriter import XMLNode
+from procodile.dependency import DependencyTracker
+from procodile.events import EventBatcher
+from procodile.indexbackend import get_backend, RtreeBackend
+from procodile.utils import Vector
+import procodile.narrowphase as narrowphase
+from procodile.draw import Instance, transform_mesh, _get_mesh_lists
+
+import procodile.scheduler as sched
+
+log = logging.getLogger()
 
 class BoundBox:
     def __init__(self, xmin=0, ymin=0, zmin=0,
                        xmax=0, ymax=0, zmax=0):
 
         if isinstance(xmin, BoundBox):
-            xmin, ymin, zmin,
+            xmin, ymin, zmin, \
             xmax, ymax, zmax = xmin.as_tuple()
 
         elif isinstance(xmin, tuple):
@@ -59,20 +75,26 @@ class BoundBox:
 
         return True
 
+    def intersects(self, bbox):
+        return self.xmin <= bbox.xmax and bbox.xmin <= self.xmax and \
+               self.ymin <= bbox.ymax and bbox.ymin <= self.ymax and \
+               self.zmin <= bbox.zmax and bbox.zmin <= self.zmax
+
     def transform(self, location):
+        '''
+        @return: BoundBox enclosing the corners of
+            this one transformed by location
+        '''
         x1, y1, z1, x2, y2, z2 = self.as_tuple()
-        x1, y1, z1 = location.transform((x1, y1, z1))
-        x2, y2, z2 = location.transform((x2, y2, z2))
+        corners = [(x, y, z) for x in (x1, x2)
+                             for y in (y1, y2)
+                             for z in (z1, z2)]
 
-        bbox = BoundBox()
-        bbox.xmin = min(x1, x2)
-        bbox.xmax = max(x1, x2)
-        bbox.ymin = min(y1, y2)
-        bbox.ymax = max(y1, y2)
-        bbox.zmin = min(z1, z2)
-        bbox.zmax = max(z1, z2)
+        points = location.transform_points(corners)
+        lo = points.min(axis=0).tolist()
+        hi = points.max(axis=0).tolist()
 
-        return bbox
+        return BoundBox(*(lo + hi))
 
     def __copy__(self):
         return self.copy()
@@ -93,89 +115,952 @@ class BoundBox:
     def __repr__(self):
         return str(self)
 
-class IndexNode:
+# corners of the whole space
+_MIN_POINT = (-numpy.inf,) * 3
+_MAX_POINT = (numpy.inf,) * 3
+
+def _get_distances(boxes, point):
+    '''
+    @param boxes: numpy array of bound boxes (one per row)
+    @return: distances of point from boxes (0 if inside)
+    '''
+    point = numpy.asarray(point, dtype=float)
+    d = numpy.maximum(boxes[:, :3] - point, point - boxes[:, 3:])
+    d = numpy.maximum(d, 0)
+    return numpy.sqrt((d * d).sum(axis=1))
+
+def _get_box_around(point, radius):
+    return BoundBox(*([v - radius for v in point] +
+                      [v + radius for v in point]))
+
+def _normalize(vector):
+    length = math.sqrt(sum(v * v for v in vector))
+    if not length:
+        raise ValueError('direction of a ray cannot be zero')
+    return [v / length for v in vector]
+
+def _get_ray_distances(origin, direction, boxes):
+    '''
+    Slab test of a ray against boxes.
+
+    @param direction: normalized
+    @return: numpy array of distances at which the ray
+        enters boxes (infinite where it misses them)
+    '''
+    boxes = numpy.asarray(boxes, dtype=float)
+    lo, hi = boxes[:, :3], boxes[:, 3:]
+    origin = numpy.asarray(origin, dtype=float)
+    direction = numpy.asarray(direction, dtype=float)
+
+    parallel = direction == 0
+    safe = numpy.where(parallel, 1, direction)
+
+    t1 = (lo - origin) / safe
+    t2 = (hi - origin) / safe
+    tnear = numpy.minimum(t1, t2)
+    tfar = numpy.maximum(t1, t2)
+
+    # along axes the ray is parallel to, it is either
+    # always or never between the slabs
+    inside = (lo <= origin) & (origin <= hi)
+    tnear = numpy.where(parallel, numpy.where(inside, -numpy.inf,
+                                              numpy.inf), tnear)
+    tfar = numpy.where(parallel, numpy.where(inside, numpy.inf,
+                                             -numpy.inf), tfar)
+
+    tnear = numpy.maximum(tnear.max(axis=1), 0)
+    tfar = tfar.min(axis=1)
+
+    return numpy.where(tnear <= tfar, tnear, numpy.inf)
+
+class IndexNode(object):
+    __slots__ = ['id', 'gen_obj', 'geom', 'tags', 'handle']
+
     def __init__(self, _id, gen_obj, geom=None):
         self.id = _id
         self.gen_obj = gen_obj
         self.geom = geom
 
-class SpatialIndex:
+        #: tags of geom when it was indexed (or last passed
+        #   to L{SpatialIndex.update_tags})
+        self.tags = tuple(geom.tags) if geom else ()
+
+        #: row of the node in L{NodeStore.bboxes}
+        self.handle = None
+
+class NodeStore(object):
+    '''
+    Index nodes by id of their generator or geom. Bound boxes are
+    kept in one numpy array (a row per node) and nodes are addressed
+    by handles (row numbers) which are reused once nodes are removed.
+    Reads of many bound boxes are array slices (L{get_bboxes}).
+    '''
+
+    #: initial number of rows
+    CAPACITY = 1024
+
     def __init__(self):
-        p = rtree.Property()
-        p.dimension = 3
-        index = rtree.Index(None, properties=p)
-        self.index = index
+        #: (xmin, ymin, zmin, xmax, ymax, zmax) by handle
+        self.bboxes = numpy.zeros((self.CAPACITY, 6))
 
-        self.node_map = {}
+        #: handle -> IndexNode (None for unused handles)
+        self.nodes = []
 
-    def add(self, gen_obj, geom=None):
+        #: id -> handle
+        self.handles = {}
+
+        self._free = []
+
+    def add(self, node, bbox):
+        if self._free:
+            handle = self._free.pop()
+        else:
+            handle = len(self.nodes)
+            self.nodes.append(None)
+
+            if handle == len(self.bboxes):
+                bboxes = numpy.zeros((handle * 2, 6))
+                bboxes[:handle] = self.bboxes
+                self.bboxes = bboxes
+
+        self.bboxes[handle] = bbox
+        self.nodes[handle] = node
+        self.handles[node.id] = handle
+        node.handle = handle
+
+        return handle
+
+    def pop(self, _id):
+        '''
+        @return: bbox tuple and node of _id
+        '''
+        handle = self.handles.pop(_id)
+
+        node = self.nodes[handle]
+        self.nodes[handle] = None
+        self._free.append(handle)
+
+        return tuple(self.bboxes[handle].tolist()), node
+
+    def get(self, _id, default=None):
+        '''
+        @return: IndexNode of _id
+        '''
+        handle = self.handles.get(_id)
+        return default if handle is None else self.nodes[handle]
+
+    def get_bbox(self, _id):
+        return BoundBox(*self.bboxes[self.handles[_id]].tolist())
+
+    def get_bboxes(self, ids):
+        '''
+        @return: numpy array of bound boxes of ids (one per row)
+        '''
+        handles = [self.handles[_id] for _id in ids]
+        return self.bboxes[handles]
+
+    def get_handles(self):
+        return self.handles.values()
+
+    def __getitem__(self, _id):
+        '''
+        @return: BoundBox and IndexNode of _id
+        '''
+        handle = self.handles[_id]
+        bbox = BoundBox(*self.bboxes[handle].tolist())
+        return bbox, self.nodes[handle]
+
+    def __contains__(self, _id):
+        return _id in self.handles
+
+    def __len__(self):
+        return len(self.handles)
+
+def _add_to_map(_map, key, _id):
+    ids = _map.get(key)
+    if ids is None:
+        ids = _map[key] = set()
+    ids.add(_id)
+
+def _remove_from_map(_map, key, _id):
+    ids = _map.get(key)
+    if ids is None:
+        return
+
+    ids.discard(_id)
+    if not ids:
+        del _map[key]
+
+class QueryCache(object):
+    '''
+    Results of spatial queries by query type and bound box.
+
+    Space is divided into cubic cells, each remembering the epoch
+    (a counter bumped on every modification of the index) in which
+    it was last modified. A cached result stays valid as long as
+    none of the cells overlapped by its bound box has been modified
+    since it was stored.
+
+    Cells come in levels, the edge of cells doubling from one level
+    to the next. A modification is recorded in the cells of the
+    finest level at which it overlaps no more than L{MAX_CELLS}
+    cells, so large modifications invalidate the results around
+    them rather than every result. Results are checked against the
+    cells of every level. Rebuilds of the index (and modifications
+    of unbounded regions) invalidate every result. Queries
+    overlapping too many cells are not cached.
+    '''
+
+    #: modifications are recorded at the finest level
+    #   at which they overlap no more than this many cells
+    MAX_CELLS = 64
+
+    #: results of queries overlapping more cells
+    #   than this are not cached
+    MAX_QUERY_CELLS = 512
+
+    #: number of cell epochs (at least; see L{_prune})
+    #   beyond which they are dropped
+    PRUNE_SIZE = 4096
+
+    def __init__(self, cell_size=10.0, max_entries=10000):
+        '''
+        @param cell_size: edge length of cells (of the finest level)
+
+        @param max_entries: number of results to keep; least
+            recently used ones are dropped beyond this
+        '''
+        self.cell_size = float(cell_size)
+        self.max_entries = max_entries
+
+        self.epoch = 0
+
+        #: (level, i, j, k) -> epoch of the last modification
+        self.cell_epochs = {}
+
+        # levels that modifications have been recorded at
+        self._num_levels = 1
+
+        # size of cell_epochs at which to prune them
+        self._prune_size = self.PRUNE_SIZE
+
+        # key -> (epoch, cells, cell range, results) in order of use
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _get_cell_range(self, bbox):
+        '''
+        @return: lowest and highest indices (along x, y and z) of
+            the cells of the finest level overlapped by bbox or
+            None if bbox is unbounded
+        '''
+        s = self.cell_size
+
+        try:
+            lo = [int(math.floor(v / s)) for v in bbox[:3]]
+            hi = [int(math.floor(v / s)) for v in bbox[3:]]
+        except (OverflowError, ValueError):
+            # infinite or nan
+            return None
+
+        return lo, hi
+
+    @staticmethod
+    def _count_cells(cell_range, level):
+        lo, hi = cell_range
+
+        num_cells = 1
+        for l, h in zip(lo, hi):
+            num_cells *= max((h >> level) - (l >> level) + 1, 0)
+
+        return num_cells
+
+    @staticmethod
+    def _get_cells(cell_range, level):
+        '''
+        @return: cells of level covering cell_range
+        '''
+        lo, hi = cell_range
+        xr, yr, zr = [xrange(l >> level, (h >> level) + 1)
+                      for l, h in zip(lo, hi)]
+        return [(level, i, j, k) for i in xr for j in yr for k in zr]
+
+    def _is_valid(self, entry):
+        epoch, cells, cell_range, results = entry
+        get = self.cell_epochs.get
+
+        if any(get(c, 0) > epoch for c in cells):
+            return False
+
+        for level in xrange(1, self._num_levels):
+            for c in self._get_cells(cell_range, level):
+                if get(c, 0) > epoch:
+                    return False
+
+        return True
+
+    def modify(self, bbox):
+        '''
+        Invalidate results depending on bbox (a tuple).
+        '''
+        cell_range = self._get_cell_range(bbox)
+        if cell_range is None:
+            self.invalidate()
+            return
+
+        self.epoch += 1
+
+        level = 0
+        while self._count_cells(cell_range, level) > self.MAX_CELLS:
+            level += 1
+        self._num_levels = max(self._num_levels, level + 1)
+
+        epochs = self.cell_epochs
+        for cell in self._get_cells(cell_range, level):
+            epochs[cell] = self.epoch
+
+        if len(epochs) > self._prune_size:
+            self._prune()
+
+    def _prune(self):
+        '''
+        Drop results which are no longer valid and all cell epochs.
+        Results which are still valid are as good as stored now.
+        '''
+        entries = self._entries
+        for key, entry in entries.items():
+            if self._is_valid(entry):
+                entries[key] = (self.epoch,) + entry[1:]
+            else:
+                del entries[key]
+
+        self.cell_epochs.clear()
+        self._num_levels = 1
+        self._prune_size = max(self.PRUNE_SIZE, len(entries))
+
+    def invalidate(self):
+        '''
+        Invalidate all results.
+        '''
+        self.epoch += 1
+        self.cell_epochs.clear()
+        self._num_levels = 1
+        self._entries.clear()
+
+    def get(self, key):
+        '''
+        @return: results stored under key or None if there
+            are none or they are no longer valid
+        '''
+        entries = self._entries
+        entry = entries.pop(key, None)
+
+        # results that are not asked for again would stay (along
+        # with the geoms in them) until pushed out by newer ones
+        if entries:
+            oldest = next(iter(entries))
+            if not self._is_valid(entries[oldest]):
+                del entries[oldest]
+
+        if entry is not None and self._is_valid(entry):
+            entries[key] = entry
+            self.hits += 1
+            return entry[-1]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, bbox, results):
+        '''
+        Store results of a query of bbox (a tuple).
+        '''
+        cell_range = self._get_cell_range(bbox)
+        if cell_range is None or \
+            self._count_cells(cell_range, 0) > self.MAX_QUERY_CELLS:
+            return
+
+        cells = self._get_cells(cell_range, 0)
+
+        entries = self._entries
+        entries[key] = self.epoch, cells, cell_range, results
+
+        if len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+class SpatialIndex:
+    '''
+    Index of generators and geoms by bound box.
+
+    Between L{begin_batch} and L{end_batch}, additions are buffered
+    and written to the index only once the batch ends (or before the
+    next query), by which time a generator's bound box has stopped
+    growing. So a generator adding n geoms costs n + 1 insertions
+    instead of 3n + 1 index operations.
+
+    Large loads (L{bulk_load}, L{rebuild} and flushes of batches
+    which at least double the size of the index) create the backend
+    afresh with all entries. The rtree backend packs them using
+    sort-tile-recursive bulk loading, which is faster than inserting
+    one entry at a time and gives a tree with less overlap between
+    nodes (and so faster queries).
+
+    Bound boxes are kept by a backend (see L{indexbackend}) under
+    the handles of nodes in L{node_map}.
+
+    Secondary indexes (tag -> geoms, generator class -> generators and
+    generator -> geoms) let L{SpatialResults} filter by id sets instead
+    of looking at every object found. Tags of a geom are read when it
+    is indexed, so they have to be assigned before it is added.
+
+    Results of bound box queries are kept in a L{QueryCache} (when
+    given one), which the index tells of every modification.
+    '''
+
+    #: flushes of fewer additions than this are
+    #   always done by insertion
+    BULK_LOAD_MIN = 1000
+
+    #: initial radius of the region expanded by L{nearest}
+    #   when fewer than the geoms asked for are found
+    SEARCH_RADIUS = 10.0
+
+    def __init__(self, backend=None, query_cache=None):
+        '''
+        @param backend: see L{indexbackend.get_backend}
+
+        @param query_cache: L{QueryCache} (None to not cache)
+        '''
+        self.make_backend = get_backend(backend)
+
+        self.query_cache = query_cache
+
+        #: L{indexbackend.IndexBackend}
+        self.index = self.make_backend()
+
+        #: L{NodeStore} of generators and geoms
+        self.node_map = NodeStore()
+
+        #: tag -> ids of geoms
+        self.tag_map = {}
+
+        #: ids of geoms without tags
+        self.untagged = set()
+
+        #: generator class -> ids of generators
+        self.class_map = {}
+
+        #: id(gen_obj) -> ids of its geoms
+        self.gen_geoms = {}
+
+        #: called with the query bound box before every query
+        self.before_query = None
+
+        #: returns the BoundBox enclosing all that before_query
+        #   could add to the index (None if nothing)
+        self.pending_bounds = None
+
+        # nesting level of batches
+        self._batch_depth = 0
+
+        # id -> (gen_obj, geom) to be added when the batch ends
+        self._pending = OrderedDict()
+
+    def begin_batch(self):
+        self._batch_depth += 1
+
+    def end_batch(self):
+        self._batch_depth -= 1
+
+        if not self._batch_depth:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write buffered additions to the index.
+        '''
+        if not self._pending:
+            return
+
+        pending = self._pending
+
+        if len(pending) >= max(len(self.node_map), self.BULK_LOAD_MIN):
+            self.rebuild()
+            return
+
+        self._pending = OrderedDict()
+
+        for gen_obj, geom in pending.itervalues():
+            self._add(gen_obj, geom)
+
+    def _register(self, node):
+        _id = node.id
+
+        if not node.geom:
+            _add_to_map(self.class_map, node.gen_obj.__class__, _id)
+            return
+
+        _add_to_map(self.gen_geoms, id(node.gen_obj), _id)
+
+        if not node.tags:
+            self.untagged.add(_id)
+
+        for tag in node.tags:
+            _add_to_map(self.tag_map, tag, _id)
+
+    def _unregister(self, node):
+        _id = node.id
+
+        if not node.geom:
+            _remove_from_map(self.class_map, node.gen_obj.__class__, _id)
+            return
+
+        _remove_from_map(self.gen_geoms, id(node.gen_obj), _id)
+        self.untagged.discard(_id)
+
+        for tag in node.tags:
+            _remove_from_map(self.tag_map, tag, _id)
+
+    def _make_node(self, gen_obj, geom):
         bbox = geom.get_bound_box() if geom else gen_obj.bbox.as_tuple()
         _id = id(geom) if geom else id(gen_obj)
         node = IndexNode(_id, gen_obj, geom)
-        self.index.insert(_id, bbox)
-        self.node_map[_id] = (BoundBox(*bbox), node)
+
+        handle = self.node_map.add(node, bbox)
+        self._register(node)
+        return handle, bbox
+
+    def _remove_node(self, _id):
+        bbox, node = self.node_map.pop(_id)
+        self._unregister(node)
+        return bbox, node
+
+    def _modified(self, bbox):
+        if self.query_cache is not None:
+            self.query_cache.modify(bbox)
+
+    def _add(self, gen_obj, geom):
+        _id = id(geom) if geom else id(gen_obj)
+        if _id in self.node_map:
+            bbox, node = self._remove_node(_id)
+            self.index.delete(node.handle, bbox)
+            self._modified(bbox)
+
+        handle, bbox = self._make_node(gen_obj, geom)
+        self.index.insert(handle, bbox)
+        self._modified(bbox)
+
+    def bulk_load(self, items):
+        '''
+        Add many generators and geoms at once. The index is
+        rebuilt from scratch (along with the entries already in
+        it), so this pays off for loads which are large in
+        comparison to the index (eg: when re-creating a build
+        tree from cached or serialized records).
+
+        @param items: iterable of (gen_obj, geom) tuples;
+            geom is None for generators
+        '''
+        for gen_obj, geom in items:
+            _id = id(geom) if geom else id(gen_obj)
+            self._pending[_id] = gen_obj, geom
+
+        self.rebuild()
+
+    def rebuild(self):
+        '''
+        Build the index from scratch out of the entries in it
+        (including buffered additions). Also useful once many
+        incremental updates have degraded the shape of the tree.
+        '''
+        pending = self._pending
+        self._pending = OrderedDict()
+
+        for _id, (gen_obj, geom) in pending.iteritems():
+            # re-added by bulk_load
+            if _id in self.node_map:
+                self._remove_node(_id)
+
+            self._make_node(gen_obj, geom)
+
+        handles = self.node_map.get_handles()
+        bboxes = self.node_map.bboxes[handles].tolist()
+        self.index = self.make_backend(zip(handles, map(tuple, bboxes)))
+
+        if self.query_cache is not None:
+            self.query_cache.invalidate()
+
+    def add(self, gen_obj, geom=None):
+        if self._batch_depth:
+            # bound box is read when flushing
+            _id = id(geom) if geom else id(gen_obj)
+            self._pending[_id] = gen_obj, geom
+        else:
+            self._add(gen_obj, geom)
 
     def remove(self, gen_obj, geom=None):
         obj = geom if geom else gen_obj
         _id = id(obj)
 
-        try:
-            bbox, node = self.node_map.pop(_id)
-        except KeyError:
+        if self._pending.pop(_id, None):
+            return
+
+        if _id not in self.node_map:
             return
 
-        self.index.delete(_id, bbox.as_tuple())
+        bbox, node = self._remove_node(_id)
+        self.index.delete(node.handle, bbox)
+        self._modified(bbox)
 
     def update(self, gen_obj, geom=None):
         self.remove(gen_obj, geom)
         self.add(gen_obj, geom)
 
+    def update_tags(self, geom):
+        '''
+        Register geom under its current tags. Tags are read when
+        a geom is indexed, so this has to be called when they are
+        changed afterwards. The geom is not moved in the index.
+        '''
+        node = self.node_map.get(id(geom))
+
+        # buffered additions read tags when written
+        if node is None:
+            return
+
+        self._unregister(node)
+        node.tags = tuple(geom.tags)
+        self._register(node)
+
     def has(self, gen_obj, geom=None):
         obj = geom if geom else gen_obj
         _id = id(obj)
-        data = self.node_map.get(_id, None)
+        return _id in self.node_map or _id in self._pending
+
+    def _find(self, bbox, query, filter_fn=None):
+        '''
+        @param bbox: tuple
+
+        @return: generators and geoms matching query against
+            bbox (tested by the backend, see
+            L{indexbackend.match_boxes}) and filter_fn
+        '''
+        handles = self.index.query(bbox, query)
+        nodes = self.node_map.nodes
+
+        if filter_fn:
+            bboxes = self.node_map.bboxes[handles].tolist()
+            bbox = BoundBox(*bbox)
+            handles = [h for h, b in zip(handles, bboxes)
+                       if filter_fn(bbox, nodes[h].gen_obj, nodes[h].geom,
+                                    BoundBox(*b))]
 
-        return bool(data is not None)
+        geoms = []
+        generators = []
 
-    def _intersection(self, bbox):
-        if isinstance(bbox, BoundBox):
-            bbox = bbox.as_tuple()
+        for h in handles:
+            node = nodes[h]
 
-        results = self.index.intersection(bbox)
-        for index, _id in enumerate(results):
-            bbox, node = self.node_map[_id]
-            results[index] = node.gen_obj, node.geom, bbox
-        return results
+            if node.geom:
+                geoms.append(node.geom)
+            else:
+                generators.append(node.gen_obj)
 
-    def intersection(self, bbox, filter_fn=None):
-        geoms = []
-        generators = []
+        return generators, geoms
 
-        results = self._intersection(bbox)
+    def _query(self, bbox, query, filter_fn=None, exact=False):
+        if self.before_query:
+            self.before_query(bbox)
 
-        for gen_obj, geom, nbbox in results:
+        self.flush()
 
-            if filter_fn and not filter_fn(bbox, gen_obj, geom, nbbox):
-                continue
+        # results of custom filters are not cached
+        cache = self.query_cache if not filter_fn else None
+
+        tbbox = bbox.as_tuple() if isinstance(bbox, BoundBox) \
+                else tuple(bbox)
+
+        if cache is not None:
+            key = query, tbbox, exact
+
+            sr = cache.get(key)
+            if sr is not None:
+                return sr.copy()
+
+        generators, geoms = self._find(tbbox, query, filter_fn)
 
-            if geom:
-                geoms.append(geom)
+        sr = SpatialResults(generators, geoms, self)
+        if exact:
+            sr = sr.refine(bbox, query)
+
+        if cache is not None:
+            cache.put(key, tbbox, sr.copy())
+
+        return sr
+
+    def intersection(self, bbox, filter_fn=None, exact=False):
+        '''
+        @param filter_fn: if given, only generators and geoms for
+            which filter_fn(bbox, gen_obj, geom, bbox of geom or
+            generator) is True are kept (geom is None for
+            generators)
+
+        @param exact: test geoms found by bound box
+            against bbox exactly (see L{SpatialResults.refine})
+        '''
+        return self._query(bbox, 'intersection', filter_fn, exact)
+
+    def within(self, bbox, exact=False):
+        return self._query(bbox, 'within', exact=exact)
+
+    def surrounding(self, bbox, exact=False):
+        return self._query(bbox, 'surrounding', exact=exact)
+
+    def enclosing(self, bbox, exact=False):
+        return self._query(bbox, 'enclosing', exact=exact)
+
+    def _get_size(self):
+        return len(self.node_map) + len(self._pending)
+
+    def _search(self, search_fn):
+        '''
+        Run search_fn (which returns results and the region
+        they depend on) till expanding the region (see
+        L{before_query}) adds nothing more to the index.
+        '''
+        while True:
+            self.flush()
+            results, region = search_fn()
+
+            if not self.before_query:
+                return results, region
+
+            size = self._get_size()
+            self.before_query(region)
+
+            if self._get_size() == size:
+                return results, region
+
+    def _get_geoms(self, handles):
+        nodes = self.node_map.nodes
+        return [nodes[h].geom for h in handles if nodes[h].geom]
+
+    def _nearest(self, point, k, filters):
+        num = max(k * 4, 16)
+
+        while True:
+            handles = self.index.nearest(point, num)
+            geoms = self._get_geoms(handles)
+
+            if filters:
+                sr = SpatialResults((), geoms, self)
+                geoms = sr.get_geoms(**filters)
+
+            found = []
+            if geoms:
+                boxes = self.node_map.get_bboxes([id(g) for g in geoms])
+                found = zip(_get_distances(boxes, point).tolist(), geoms)
+                found.sort(key=lambda (distance, geom): distance)
+
+            if len(found) >= k or len(handles) < num:
+                return found[:k]
+
+            num *= 4
+
+    def nearest(self, point, k=1, **filters):
+        '''
+        Find the k geoms nearest to point (by distance to their
+        bound boxes).
+
+        @param filters: as for L{SpatialResults.get_geoms}
+
+        @return: list of (distance, geom) nearest first and
+            the region (BoundBox) that the result depends on
+        '''
+        # with fewer than k geoms found, the region that is expanded
+        # (see before_query) grows step by step, so only as much is
+        # expanded as it takes to find k geoms (or all there is)
+        radius = self.SEARCH_RADIUS
+
+        def search_fn():
+            found = self._nearest(point, k, filters)
+
+            if len(found) < k:
+                distance = found[-1][0] if found else 0
+                region = _get_box_around(point, max(radius, distance))
             else:
-                generators.append(gen_obj)
+                region = _get_box_around(point, found[-1][0])
+
+            return found, region
 
-        return SpatialResults(generators, geoms)
+        while True:
+            found, region = self._search(search_fn)
 
-    def within(self, bbox):
-        filter_fn = lambda bbox, gen_obj, geom, nbbox: bbox.contains(nbbox)
-        return self.intersection(bbox, filter_fn)
+            if len(found) >= k:
+                return found, region
 
-    def surrounding(self, bbox):
-        filter_fn = lambda bbox, gen_obj, geom, nbbox: not bbox.contains(nbbox)
-        return self.intersection(bbox, filter_fn)
+            pending = self.pending_bounds() if self.pending_bounds else None
+            if pending is None or region.contains(pending):
+                # anything added anywhere would be found
+                return found, BoundBox(*(_MIN_POINT + _MAX_POINT))
 
-    def enclosing(self, bbox):
-        filter_fn = lambda bbox, gen_obj, geom, nbbox: nbbox.contains(bbox)
-        return self.intersection(bbox, filter_fn)
+            radius = max(radius, (region.xmax - region.xmin) / 2) * 2
+
+    def _raycast(self, origin, direction, max_dist, region, filters):
+        handles = self.index.intersection(region.as_tuple())
+        geoms = self._get_geoms(handles)
+
+        if filters:
+            sr = SpatialResults((), geoms, self)
+            geoms = sr.get_geoms(**filters)
+
+        if not geoms:
+            return []
+
+        boxes = self.node_map.get_bboxes([id(g) for g in geoms])
+        distances = _get_ray_distances(origin, direction, boxes)
+
+        found = [(d, g) for d, g in zip(distances.tolist(), geoms)
+                 if d <= max_dist]
+        found.sort(key=lambda (distance, geom): distance)
+
+        return found
+
+    def raycast(self, origin, direction, max_dist, **filters):
+        '''
+        Find the geoms whose bound boxes are hit by a ray.
+
+        @param direction: need not be normalized
+
+        @param max_dist: length of the ray
+
+        @param filters: as for L{SpatialResults.get_geoms}
+
+        @return: list of (distance from origin at which the ray
+            enters the bound box, geom) nearest first and the
+            region (BoundBox) that the result depends on
+        '''
+        direction = _normalize(direction)
+        end = [o + d * max_dist for o, d in zip(origin, direction)]
+
+        region = BoundBox(*([min(a, b) for a, b in zip(origin, end)] +
+                            [max(a, b) for a, b in zip(origin, end)]))
+
+        search_fn = lambda: (self._raycast(origin, direction, max_dist,
+                                           region, filters), region)
+
+        return self._search(search_fn)
+
+class DeferredSubgen(object):
+    '''
+    A sub generator waiting for its region to be needed.
+    '''
+
+    __slots__ = ['id', 'parent', 'args', 'bbox']
+
+    def __init__(self, _id, parent, args, bbox):
+        self.id = _id
+
+        #: generator which asked for the sub generator
+        self.parent = parent
+
+        #: arguments for parent._subgen
+        self.args = args
+
+        #: declared BoundBox (global)
+        self.bbox = bbox
+
+    def run(self):
+        return self.parent._subgen(*self.args)
+
+class DeferredIndex:
+    '''
+    Spatial index of deferred sub generators by declared bound box.
+    '''
+
+    def __init__(self):
+        self.index = RtreeBackend()
+
+        self.entries = {}
+
+        # id(parent) -> ids of deferred sub generators
+        self.parent_map = {}
+
+        self._counter = itertools.count()
+
+    def add(self, parent, args, bbox):
+        _id = self._counter.next()
+        entry = DeferredSubgen(_id, parent, args, bbox)
+
+        self.entries[_id] = entry
+        self.parent_map.setdefault(id(parent), []).append(_id)
+        self.index.insert(_id, bbox.as_tuple())
+
+        return entry
+
+    def _remove(self, _id):
+        entry = self.entries.pop(_id)
+        self.index.delete(_id, entry.bbox.as_tuple())
+
+        ids = self.parent_map[id(entry.parent)]
+        ids.remove(_id)
+        if not ids:
+            del self.parent_map[id(entry.parent)]
+
+        return entry
+
+    def pop(self, region=None):
+        '''
+        Remove the entries whose bound boxes intersect
+        region (all if None).
+
+        @rtype: list
+        @return: entries in the order in which they were added
+        '''
+        if region is None:
+            ids = self.entries.keys()
+        else:
+            if isinstance(region, BoundBox):
+                region = region.as_tuple()
+            ids = self.index.intersection(region)
+
+        return [self._remove(_id) for _id in sorted(ids)]
+
+    def get(self, parent):
+        '''
+        @rtype: list
+        @return: entries of parent yet to be run
+        '''
+        ids = self.parent_map.get(id(parent), [])
+        return [self.entries[_id] for _id in ids]
+
+    def remove(self, parent):
+        for _id in self.parent_map.get(id(parent), [])[:]:
+            self._remove(_id)
+
+    def get_bound_box(self):
+        '''
+        @return: BoundBox enclosing the declared bound boxes
+            of all entries (None if there are none)
+        '''
+        if not self.entries:
+            return None
+
+        bbox = None
+        for entry in self.entries.itervalues():
+            if bbox is None:
+                bbox = entry.bbox.copy()
+            else:
+                bbox.merge(entry.bbox)
+
+        return bbox
+
+    def __len__(self):
+        return len(self.entries)
 
 TRUE_FN = lambda a, b: True
 
@@ -189,7 +1074,253 @@ def _make_tuple(value):
     else:
         return (value,)
 
+def _get_union(_map, keys):
+    ids = set()
+    for key in keys:
+        ids.update(_map.get(key, ()))
+    return ids
+
+def _intersect(ids, _ids):
+    return _ids if ids is None else ids & _ids
+
+def _select(objects, ids):
+    '''
+    @param objects: id -> object
+    @param ids: ids of objects to select (None for all)
+    '''
+    if ids is None:
+        return objects.values()
+
+    # look at whichever is fewer
+    if len(ids) < len(objects):
+        return [objects[_id] for _id in ids if _id in objects]
+
+    return [o for _id, o in objects.iteritems() if _id in ids]
+
+def unwrap(obj):
+    '''
+    @return: generator or geom that obj is a L{LocalView} of
+        (obj itself if it is not a view)
+    '''
+    return obj._obj if isinstance(obj, LocalView) else obj
+
+def _make_subjects(value):
+    return tuple(unwrap(v) for v in _make_tuple(value))
+
+def _get_vertex_coords(geom):
+    if isinstance(geom, Instance):
+        return geom.get_vertices().tolist()
+
+    surfaces = getattr(geom, 'surfaces', None)
+
+    if surfaces is None:
+        return [(v.x, v.y, v.z) for v in geom._get_gts_vertices()]
+
+    coords = []
+    for surface in surfaces.itervalues():
+        coords.extend(_get_vertex_coords(surface))
+    return coords
+
+class LocalView(object):
+    '''
+    A generator or geom as seen from the local frame of a generator
+    (through a matrix, the inverse of the generator's location).
+    Values which depend on the frame are computed when asked for and
+    the generator or geom itself is never modified. Generators and
+    geoms reached through a view are views as well. Attributes in the
+    global frame which a view cannot localize (L{GLOBAL_ATTRS}) are
+    not handed out; L{unwrap} gives them. All other attributes are
+    read from (and written to) the generator or geom.
+    '''
+
+    # underscored so as not to hide attributes of the object
+    __slots__ = ['_obj', '_matrix', '_cache']
+
+    #: attributes which are local to the view (read-only)
+    LOCAL_ATTRS = ()
+
+    #: attributes which are in the global frame
+    GLOBAL_ATTRS = ()
+
+    def __init__(self, obj, matrix):
+        object.__setattr__(self, '_obj', obj)
+        object.__setattr__(self, '_matrix', matrix)
+        object.__setattr__(self, '_cache', {})
+
+    def __getattr__(self, name):
+        if name in self.GLOBAL_ATTRS:
+            raise AttributeError('%s of a local view is in the global '
+                                 'frame (unwrap the view)' % name)
+
+        # reached when the local value could not be had
+        # (eg: the object has no such attribute)
+        if name in self.LOCAL_ATTRS:
+            raise AttributeError('%r has no local %s' % (self._obj, name))
+
+        return getattr(self._obj, name)
+
+    def __setattr__(self, name, value):
+        if name in self.LOCAL_ATTRS or name in self.GLOBAL_ATTRS:
+            raise AttributeError('%s of a local view cannot be set' % name)
+
+        setattr(self._obj, name, value)
+
+    def __eq__(self, other):
+        return self._obj == unwrap(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self._obj)
+
+    def __repr__(self):
+        return '<%s of %r>' % (self.__class__.__name__, self._obj)
+
+    def _get_cached(self, name, fn):
+        cache = self._cache
+
+        if name not in cache:
+            cache[name] = fn()
+
+        return cache[name]
+
+class GeneratorView(LocalView):
+    '''
+    L{LocalView} of a generator with local location and bound
+    boxes. Its geoms and the generators related to it are views.
+    '''
+
+    __slots__ = []
+
+    LOCAL_ATTRS = ('location', 'inv_location', 'bbox', 'subtree_bbox',
+                   'geoms', 'parent', 'children', 'ancestors')
+
+    @property
+    def location(self):
+        return self._get_cached('location',
+                    lambda: self._matrix.multiply(self._obj.location))
+
+    @property
+    def inv_location(self):
+        return self._get_cached('inv_location',
+                    lambda: self.location.inverse())
+
+    @property
+    def bbox(self):
+        return self._get_cached('bbox',
+                    lambda: self._obj.bbox.transform(self._matrix))
+
+    @property
+    def subtree_bbox(self):
+        return self._get_cached('subtree_bbox',
+                    lambda: self._obj.subtree_bbox.transform(self._matrix))
+
+    @property
+    def geoms(self):
+        return self._get_cached('geoms', lambda:
+                    dict((_id, GeomView(g, self._matrix))
+                         for _id, g in self._obj.geoms.iteritems()))
+
+    @property
+    def parent(self):
+        parent = self._obj.parent
+        return None if parent is None else GeneratorView(parent, self._matrix)
+
+    @property
+    def children(self):
+        return [GeneratorView(c, self._matrix) for c in self._obj.children]
+
+    @property
+    def ancestors(self):
+        return [GeneratorView(a, self._matrix) for a in self._obj.ancestors]
+
+class GeomView(LocalView):
+    '''
+    L{LocalView} of a geom with local vertices, meshes and bound box.
+    Parts of geoms (faces, edges and vertices as objects) are only
+    to be had from the geom itself.
+    '''
+
+    __slots__ = []
+
+    LOCAL_ATTRS = ('vertices', 'mesh', 'matrix', 'surfaces')
+
+    GLOBAL_ATTRS = ('faces', 'e1', 'e2', 'e3', 'v1', 'v2', 'normal',
+                    'x', 'y', 'z', 'position', 'distance',
+                    'translate', 'rotate', 'transform')
+
+    def get_vertices(self):
+        '''
+        @return: numpy array of local vertex coordinates
+            (one vertex per row)
+        '''
+        return self._get_cached('vertices', lambda:
+                    self._matrix.transform_points(
+                                      _get_vertex_coords(self._obj)))
+
+    @property
+    def vertices(self):
+        return [Vector(*v) for v in self.get_vertices().tolist()]
+
+    def get_bound_box(self):
+        vertices = self.get_vertices()
+
+        if not len(vertices):
+            return self._obj.get_bound_box()
+
+        lo = vertices.min(axis=0).tolist()
+        hi = vertices.max(axis=0).tolist()
+        return tuple(lo + hi)
+
+    def get_mesh_arrays(self, dtype=numpy.float32):
+        '''
+        Local mesh (see L{draw.Surface.get_mesh_arrays}).
+        '''
+        mesh = self._obj.get_mesh_arrays(numpy.float64)
+        return transform_mesh(mesh, self._matrix, dtype)
+
+    def get_meshes(self, dtype=numpy.float32):
+        '''
+        Local meshes of surfaces (see L{draw.Instance.get_meshes}).
+        '''
+        return [(name, transform_mesh(mesh, self._matrix, dtype))
+                for name, mesh in self._obj.get_meshes(numpy.float64)]
+
+    @property
+    def mesh(self):
+        return _get_mesh_lists(self.get_mesh_arrays(numpy.float64))
+
+    def get_triangles(self):
+        '''
+        @return: numpy array of local triangles (n x 3 x 3)
+        '''
+        positions, indices, normals, tcoords = \
+            self.get_mesh_arrays(numpy.float64)
+        return positions[indices]
+
+    @property
+    def matrix(self):
+        return self._get_cached('matrix',
+                    lambda: self._matrix.multiply(self._obj.matrix))
+
+    @property
+    def surfaces(self):
+        return self._get_cached('surfaces', lambda:
+                    dict((name, GeomView(s, self._matrix))
+                         for name, s in self._obj.surfaces.iteritems()))
+
 class SpatialResults:
+    '''
+    Generators and geoms found by a query. When the results come
+    from a L{SpatialIndex}, filters by type, tag, generator and
+    parent are applied using its secondary indexes, so the objects
+    looked at are only those which match them.
+
+    Results localized to a frame (see L{localize}) are handed out as
+    L{LocalView}s; filters and the generators and geoms dicts work
+    with the generators and geoms themselves.
+    '''
 
     GENERATOR_FILTERS = {
             '_type': lambda gen, _type: isinstance(gen, _type),
@@ -204,80 +1335,158 @@ class SpatialResults:
             'visible': lambda geom, visible: geom.visible==visible,
         }
 
-    def __init__(self, generators, geoms):
+    def __init__(self, generators, geoms, index=None, matrix=None):
 
         self.generators = dict([(id(g), g) for g in generators])
         self.geoms = dict([(id(g), g) for g in geoms])
 
+        #: L{SpatialIndex} the results come from
+        self.index = index
+
+        #: transform to the frame of the views handed out
+        #   (None to hand out generators and geoms)
+        self.matrix = matrix
+
+    def localize(self, matrix):
+        '''
+        @return: the same results seen through matrix
+            (eg: the inverse of a generator's location)
+        '''
+        sr = SpatialResults((), (), self.index, matrix)
+        sr.generators = self.generators
+        sr.geoms = self.geoms
+        return sr
+
+    def copy(self):
+        sr = SpatialResults((), (), self.index, self.matrix)
+        sr.generators = dict(self.generators)
+        sr.geoms = dict(self.geoms)
+        return sr
+
+    def refine(self, bbox, query, matrix=None):
+        '''
+        Narrow phase of a query: the same results with only those
+        geoms which match query ('intersection', 'within',
+        'surrounding' or 'enclosing') against bbox exactly (see
+        L{narrowphase.filter_geoms}). Generators are kept as they
+        are since they have no geometry of their own.
+
+        @param matrix: transform into the frame that bbox is
+            given in (None if global)
+        '''
+        geoms = narrowphase.filter_geoms(self.geoms.values(), bbox,
+                                         query, matrix)
+
+        sr = SpatialResults((), geoms, self.index, self.matrix)
+        sr.generators = self.generators
+        return sr
+
+    def _filter(self, objects, checks, filter_fn, view_class):
+        selected = []
+        matrix = self.matrix
+
+        for obj in objects:
+
+            skip_obj = False
+
+            for value, check_fn in checks:
+                if not check_fn(obj, value):
+                    skip_obj = True
+                    break
+
+            if skip_obj:
+                continue
+
+            if matrix is not None:
+                obj = view_class(obj, matrix)
+
+            if filter_fn(self, obj):
+                selected.append(obj)
+
+        return selected
+
     def get_generators(self, _type=None,
                              parent=None,
                              ancestor=None,
                              filter_fn=TRUE_FN):
-        generators = []
-
         checks = []
         f = self.GENERATOR_FILTERS
-        m = _make_tuple
+        m = _make_subjects
+        index = self.index
 
-        if _type:
-            checks.append((m(_type), f['_type']))
+        # ids of generators matching filters applied using
+        # the index (None if there are no such filters)
+        ids = None
 
-        if parent:
-            checks.append((m(parent), f['parent']))
+        if _type and index:
+            _type = m(_type)
+            classes = [c for c in index.class_map if issubclass(c, _type)]
+            ids = _get_union(index.class_map, classes)
 
-        if ancestor:
-            checks.append((m(ancestor), f['ancestor']))
+        elif _type:
+            checks.append((m(_type), f['_type']))
 
-        for generator in self.generators.itervalues():
+        if parent and index:
+            _ids = set(id(c) for p in m(parent) for c in p.children)
+            ids = _intersect(ids, _ids)
 
-            skip_gen = False
+        elif parent:
+            checks.append((m(parent), f['parent']))
 
-            for value, check_fn in checks:
-                if not check_fn(generator, value):
-                    skip_gen = True
-                    break
+        if ancestor and index:
+            anc_ids = set(id(a) for a in m(ancestor))
+            check_fn = lambda gen, anc_ids: \
+                any(id(a) in anc_ids for a in gen.ancestors)
+            checks.append((anc_ids, check_fn))
 
-            if not skip_gen and filter_fn(self, generator):
-                generators.append(generator)
+        elif ancestor:
+            checks.append((m(ancestor), f['ancestor']))
 
-        return generators
+        generators = _select(self.generators, ids)
+        return self._filter(generators, checks, filter_fn, GeneratorView)
 
     def get_geoms(self, _type=None,
                         tag=None,
                         generator=None,
                         visible=None,
                         filter_fn=TRUE_FN):
-        geoms = []
-
         checks = []
         f = self.GEOM_FILTERS
-        m = _make_tuple
+        m = _make_subjects
+        index = self.index
+
+        # ids of geoms matching filters applied using
+        # the index (None if there are no such filters)
+        ids = None
 
-        if _type:
+        if _type and index:
+            # matched by tags or (when untagged) by generator
+            _type = m(_type)
+            ids = _get_union(index.tag_map, _type)
+            _ids = _get_union(index.gen_geoms, [id(t) for t in _type])
+            ids.update(_ids & index.untagged)
+
+        elif _type:
             checks.append((m(_type), f['_type']))
 
-        if tag:
+        if tag and index:
+            ids = _intersect(ids, _get_union(index.tag_map, m(tag)))
+
+        elif tag:
             checks.append((m(tag), f['tag']))
 
-        if generator:
+        if generator and index:
+            _ids = _get_union(index.gen_geoms, [id(g) for g in m(generator)])
+            ids = _intersect(ids, _ids)
+
+        elif generator:
             checks.append((m(generator), f['generator']))
 
         if visible:
             checks.append((visible, f['visible']))
 
-        for geom in self.geoms.itervalues():
-
-            skip_geom = False
-
-            for value, check_fn in checks:
-                if not check_fn(geom, value):
-                    skip_geom = True
-                    break
-
-            if not skip_geom and filter_fn(self, geom):
-                geoms.append(geom)
-
-        return geoms
+        geoms = _select(self.geoms, ids)
+        return self._filter(geoms, checks, filter_fn, GeomView)
 
 class StopBuildException:
     '''
@@ -298,23 +1507,117 @@ class BuildSpace:
     BFS = 0
     DFS = 1
 
+    #: BFS, with independent subtrees built by a pool of
+    #   worker processes. Sub generators are seeded from their
+    #   parent's seed and index, so a subtree can be generated
+    #   anywhere as long as it does not query the output of
+    #   others; builds whose generators make spatial queries
+    #   go on like BFS (see L{parallel}).
+    PARALLEL = 2
+
+    #: priority orders; generators closer to the root or
+    #   expected to be larger are run first
+    SHALLOWEST_FIRST = 3
+    LARGEST_BBOX_FIRST = 4
+
+    SCHEDULERS = {
+        BFS: sched.FIFOScheduler,
+        DFS: sched.LIFOScheduler,
+        PARALLEL: sched.FIFOScheduler,
+        SHALLOWEST_FIRST: sched.ShallowestFirstScheduler,
+        LARGEST_BBOX_FIRST: sched.LargestBBoxFirstScheduler,
+    }
+
     STATE_READY = 0
     STATE_RUNNING = 1
     STATE_PAUSED = 2
     STATE_COMPLETED = 3
 
-    WAIT_INTERVAL = .1 # seconds
+    def __init__(self, strategy=BFS, processes=None, key=None,
+                       cache=None, budget=None, profiler=None,
+                       index=None, query_cache=True):
+        '''
+        @param strategy: one of BFS, DFS, PARALLEL, SHALLOWEST_FIRST,
+            LARGEST_BBOX_FIRST or a L{scheduler.Scheduler} object
+            (which is run like BFS).
+
+        @param key: if specified, generators are run in increasing
+            order of key(L{scheduler.QueueEntry}) (overrides strategy)
+
+        @param cache: L{cache.GenerationCache} to store output of
+            generators in and re-create generators from
 
-    def __init__(self, strategy=BFS):
+        @param budget: L{budget.BuildBudget} limiting the work done
+            by a build
+
+        @param profiler: L{profiler.BuildProfiler} to collect
+            per generator stats in
+
+        @param index: backend of the spatial index; 'rtree' (default),
+            'grid', 'numpy' or a callable creating backends (see
+            L{indexbackend.get_backend})
+
+        @param query_cache: L{QueryCache} to keep results of spatial
+            queries in, True for one with default settings or None
+            to not cache
+        '''
 
         self.state = self.STATE_READY
         self.root_gen = None
         self.materials = {}
         self.textures = {}
+
+        if key:
+            strategy = sched.PriorityScheduler(key)
+
+        if isinstance(strategy, sched.Scheduler):
+            self.queue = strategy
+            strategy = self.BFS
+        else:
+            self.queue = self.SCHEDULERS[strategy]()
+
         self.strategy = strategy
-        self.queue = []
 
-        self.index = SpatialIndex()
+        #: number of worker processes for PARALLEL strategy
+        self.processes = processes or multiprocessing.cpu_count()
+
+        self.cache = cache
+
+        if query_cache is True:
+            query_cache = QueryCache()
+
+        #: L{QueryCache} (None if queries are not cached)
+        self.query_cache = query_cache
+
+        self.index = SpatialIndex(index, query_cache)
+        self.index.before_query = self._expand_for_query
+
+        #: sub generators waiting to be expanded (see L{expand})
+        self.deferred = DeferredIndex()
+        self.index.pending_bounds = self.deferred.get_bound_box
+
+        #: read sets of generators (for incremental rebuilds)
+        self.deps = DependencyTracker()
+
+        #: set when the build has been stopped by L{stop}
+        self.stopped = False
+
+        #: build (an iterator) waiting to be run using L{step}
+        self.task = None
+
+        self.budget = budget
+        self.profiler = profiler
+
+        #: queued generators (L{scheduler.QueueEntry}) which were
+        #   not run because of the budget (see L{refine})
+        self.truncated = []
+
+        # guards state; notified on every change of state
+        # so that a paused build can wait for resumption
+        self._state_cond = threading.Condition()
+
+        # set while L{step} is running
+        self._stepping = False
 
         self.event_handlers = []
 
@@ -331,22 +1634,66 @@ class BuildSpace:
     def get_registered_material(self, material):
         return self.materials.get(material)
         
+    def _set_state(self, state):
+        c = self._state_cond
+        c.acquire()
+        try:
+            self.state = state
+            c.notifyAll()
+        finally:
+            c.release()
+
     def _wait(self):
-        while self.state == self.STATE_PAUSED:
-            time.sleep(self.WAIT_INTERVAL)
+        # let the host see everything built so far
+        self.flush_events()
+
+        c = self._state_cond
+        c.acquire()
+        try:
+            while self.state == self.STATE_PAUSED:
+                c.wait()
+        finally:
+            c.release()
 
     def notify_event(self, event, *args):
-        if self.state == self.STATE_PAUSED:
-            self._wait()
+        if self.state != self.STATE_RUNNING:
+
+            # when stepping, the host (which also pauses) is
+            # waiting for the step to return; step stops early
+            if self.state == self.STATE_PAUSED and not self._stepping:
+                self._wait()
 
-        elif self.state == self.STATE_COMPLETED:
-            raise StopBuildException
+            if self.state == self.STATE_COMPLETED:
+                raise StopBuildException
+
+        if self.budget is not None:
+            self.budget.count(event, args)
 
         for handler in self.event_handlers:
             handler(event, args)
 
-    def queue_generator(self, run_fn):
-        self.queue.append(run_fn)
+    def add_batch_handler(self, handler, flush_size=256,
+                                flush_interval=.1):
+        '''
+        Subscribe handler(events) to receive events in batches
+        (lists of (event, args) tuples). See L{events.EventBatcher}.
+
+        @rtype: L{events.EventBatcher}
+        '''
+        batcher = EventBatcher(handler, flush_size, flush_interval)
+        self.event_handlers.append(batcher)
+        return batcher
+
+    def flush_events(self):
+        '''
+        Deliver events held back by batching handlers.
+        '''
+        for handler in self.event_handlers:
+            if isinstance(handler, EventBatcher):
+                handler.flush()
+
+    def queue_generator(self, run_fn, parent=None, bbox=None):
+        self.queue.push(sched.QueueEntry(run_fn, parent, bbox))
 
     def process_queue(self):
 
@@ -356,41 +1703,277 @@ class BuildSpace:
         if not q:
             return False
 
-        run = q.pop(0) if s == self.BFS else q.pop(len(q) - 1)
+        entry = q.pop()
+
+        if self.budget is not None and not self.budget.allows(entry):
+            self.truncated.append(entry)
+            return None
+
+        gen_obj = entry.run_fn()
+
+        return gen_obj if s == self.DFS else None
+
+    def _check_budget(self):
+        '''
+        Stop the build if the budget is exhausted. Generators
+        waiting in the queue are truncated.
+        '''
+        budget = self.budget
+
+        if budget is None or not budget.is_exhausted():
+            return
+
+        self.truncated.extend(self.queue.drain())
+
+        log.info('build budget exceeded (%s); %d sub generators '
+                 'truncated' % (budget.exceeded, len(self.truncated)))
+
+        self.stop()
+
+    def drop_truncated(self, parent):
+        '''
+        Forget truncated sub generators of parent
+        (as parent is being removed).
+        '''
+        if self.truncated:
+            self.truncated = [e for e in self.truncated
+                                if e.parent is not parent]
+
+    def refine(self, budget=None):
+        '''
+        Run the generators truncated earlier (see L{truncated})
+        within budget (no limits if None).
+
+        @rtype: bool
+        @return: True if nothing had to be truncated again
+        '''
+        entries = self.truncated
+        self.truncated = []
+
+        # the budget of the build is back in place afterwards
+        previous_budget = self.budget
+
+        self.budget = budget
+        if budget is not None:
+            budget.start()
+
+        for entry in entries:
+            self.queue.push(entry)
+
+        self.state = self.STATE_RUNNING
+        self.stopped = False
+
+        try:
+            for _ in self.run_async():
+                pass
+        finally:
+            self.state = self.STATE_COMPLETED
+            self.budget = previous_budget
+
+        return not self.truncated
+
+    def _can_farm_out(self):
+        if self.strategy != self.PARALLEL or self.processes < 2:
+            return False
+
+        # work done by workers cannot be
+        # accounted for while it is happening
+        if self.budget is not None or self.profiler is not None:
+            return False
+
+        # wait for the frontier to be wide enough
+        # to keep all workers busy
+        if len(self.queue) < self.processes:
+            return False
+
+        # re-runs are not tied to a parent and
+        # have to be processed here
+        for entry in self.queue:
+            if entry.parent is None:
+                return False
+
+        import procodile.parallel as parallel
+        return parallel.can_build_subtrees()
+
+    def _farm_out(self):
+        '''
+        @rtype: bool
+        @return: False if the jobs could not be built apart
+            (and are back in the queue)
+        '''
+        import procodile.parallel as parallel
+
+        jobs = self.queue.drain()
+        if parallel.build_subtrees(self, jobs, self.processes):
+            return True
+
+        for entry in jobs:
+            self.queue.push(entry)
+
+        return False
+
+    def run_async(self):
+        '''
+        Same as L{run} for a build which is just starting (or a
+        re-run) but returns an iterator which runs one queued
+        generator (along with its sub generators in DFS) every
+        time it is advanced. This lets the host do other work
+        (eg: rendering) in between without using threads.
+        '''
+        # cleared once generators are found to make queries
+        farm_out = True
+
+        try:
+            while self.queue:
+                if farm_out and self._can_farm_out():
+                    farm_out = self._farm_out()
+                else:
+                    self.process_queue()
+                self._check_budget()
+                yield
+
+            self.on_build_done()
+
+        except StopBuildException:
+            pass
+
+    def step(self, budget_seconds=None):
+        '''
+        Advance L{task} for up to budget_seconds (till it is
+        done if None). At least one advance is made, so a slow
+        generator can exceed the budget.
+
+        @rtype: bool
+        @return: True if there is more work left
+        '''
+        task = self.task
+
+        if task is None:
+            return False
+
+        if self.state == self.STATE_PAUSED:
+            return True
+
+        if budget_seconds is not None:
+            deadline = time.time() + budget_seconds
+
+        self._stepping = True
+
+        try:
+            while True:
+                try:
+                    task.next()
+
+                except StopIteration:
+                    self.task = None
+                    return False
+
+                except:
+                    self.task = None
+                    raise
+
+                if self.state == self.STATE_PAUSED:
+                    return True
+
+                if budget_seconds is not None and \
+                    time.time() >= deadline:
+                    return True
+
+        finally:
+            self._stepping = False
+            self.flush_events()
 
-        gen_obj = run()
+    def expand(self, region=None):
+        '''
+        Run the deferred sub generators (see L{Generator.defer_subgen})
+        whose declared bound boxes intersect region (a BoundBox or
+        tuple in global co-ordinates; everything if None) along
+        with the ones that they in turn defer within region.
 
-        return None if s == self.BFS else gen_obj
+        @rtype: int
+        @return: number of deferred sub generators run
+        '''
+        entries = self.deferred.pop(region)
+
+        if not entries:
+            return 0
+
+        count = 0
+        queue = self.queue
+        state = self.state
+
+        # expansion runs to completion right away, even
+        # in the middle of a build (eg: for a query)
+        self.queue = sched.FIFOScheduler()
+
+        if state == self.STATE_COMPLETED:
+            self.state = self.STATE_RUNNING
+
+        try:
+            while entries:
+                for e in entries:
+                    self.queue_generator(e.run, e.parent, e.bbox)
+                count += len(entries)
+
+                while self.queue:
+                    self.process_queue()
+
+                entries = self.deferred.pop(region)
+
+        except StopBuildException:
+            if state != self.STATE_COMPLETED:
+                raise
+
+        finally:
+            self.queue = queue
+            if state == self.STATE_COMPLETED:
+                self.state = state
+                self.flush_events()
+
+        return count
+
+    def _expand_for_query(self, bbox):
+        if self.deferred:
+            self.expand(bbox)
 
     def run(self, re_run=False):
         try:
 
-            if self.strategy == self.BFS:
+            if self.strategy != self.DFS:
                 if self.root_gen is None or re_run:
+                    for _ in self.run_async():
+                        pass
+
+            else:
+                # sub generators are run as soon as they are
+                # queued; the build is done only when the
+                # outermost run returns
+                if self.root_gen is None or re_run:
+                    ret = None
                     while self.queue:
-                        self.process_queue()
+                        ret = self.process_queue()
                     self.on_build_done()
+                    return ret
 
-            elif self.strategy == self.DFS:
-                ret = self.process_queue()
-                self.on_build_done()
-                return ret
+                return self.process_queue()
 
         except StopBuildException:
             pass
 
     def on_build_done(self):
-        self.state = self.STATE_COMPLETED
+        self.flush_events()
+        self._set_state(self.STATE_COMPLETED)
 
     def pause(self):
-        self.state = self.STATE_PAUSED
+        self._set_state(self.STATE_PAUSED)
 
     def resume(self):
-        self.state = self.STATE_RUNNING
+        self._set_state(self.STATE_RUNNING)
 
     def stop(self):
-        self.queue[:] = [] # clear queue
-        self.state = self.STATE_COMPLETED
+        self.queue.clear()
+        self.stopped = True
+        self._set_state(self.STATE_COMPLETED)
 
     def serialize(self, **options):
         doc = XMLNode('buildspace')
@@ -400,27 +1983,52 @@ class BuildSpace:
         doc.serialize(stream)
         return stream.getvalue()
 
-    def query(self, match_fn):
+    def query(self, match_fn, region=None, prune=False):
+        '''
+        Find generators for which match_fn(info, root_info)
+        is True. If region is given, deferred sub generators
+        within it are expanded first (see L{expand}).
+
+        @param prune: consider only generators whose bound boxes
+            intersect region, skipping the subtrees of generators
+            whose subtree_bbox does not
+        '''
+        if region is not None:
+            self.expand(region)
+
         matches = []
         r = self.root_gen
 
         if not r:
             return matches
 
-        if match_fn(r.info, r.info):
+        if prune and region is not None:
+            region = BoundBox(region)
+        else:
+            region = None
+
+        if region and not r.subtree_bbox.intersects(region):
+            return matches
+
+        if match_fn(r.info, r.info) and \
+            (not region or r.bbox.intersects(region)):
             matches.append(r)
 
-        matches.extend(self._query(r.info, r, match_fn))
+        matches.extend(self._query(r.info, r, match_fn, region))
         return matches
 
-    def _query(self, rinfo, gen, match_fn):
+    def _query(self, rinfo, gen, match_fn, region=None):
         matches = []
         
         for sgen in gen.children:
-            if match_fn(sgen.info, rinfo):
+            if region and not sgen.subtree_bbox.intersects(region):
+                continue
+
+            if match_fn(sgen.info, rinfo) and \
+                (not region or sgen.bbox.intersects(region)):
                 matches.append(sgen)
 
-            matches.extend(self._query(rinfo, sgen, match_fn))
+            matches.extend(self._query(rinfo, sgen, match_fn, region))
 
         return matches
 
@@ -0,0 +1,406 @@
+'''
+Memoization of generator output.
+
+The output of a generator (the geoms it adds and the sub generators
+it asks for) is fully determined by its class, config, seed and
+location. When a build space has a cache, the output of every
+generator is stored (as a L{procedural.GeneratorRecord}) and
+generators with the same inputs are re-created from the stored
+record instead of running generate().
+
+Generators which perform spatial queries or modify geoms of other
+generators depend on more than their inputs and are never stored.
+
+L{GenerationCache} keeps records in memory for the duration of a
+session. L{DiskCache} stores them in a directory so that they can
+be used across sessions; its keys include the source code of the
+packages that generators come from and of procodile itself.
+
+G{importgraph}
+'''
+
+import os
+import sys
+import time
+import inspect
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+
+from procodile.utils import get_user_app_dir
+from procodile.loader import get_loader, _get_python_files
+from procodile.procedural import GeneratorRecord
+import procodile.snapshot as snapshot
+
+log = logging.getLogger()
+
+class GenerationCache:
+    '''
+    In-memory cache of generator records with LRU eviction
+    bounded by number of entries and total size (in bytes
+    of pickled records).
+    '''
+
+    def __init__(self, max_entries=10000, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, info):
+        '''
+        Compute cache key for generator described by
+        info (L{procedural.GeneratorInfo}) after recipes
+        have been applied to it.
+        '''
+        data = self._get_key_data(info)
+        return hashlib.sha1(snapshot.dumps(data)).hexdigest()
+
+    def _get_key_data(self, info):
+        g = info
+
+        # originals (given to _rungen) and the effect of
+        # recipes on them are both part of the key
+        return (GeneratorRecord.VERSION,
+                g._generator, sorted(g._config.items()), g._seed,
+                g.generator, sorted(g.config.items()), g.s_seed,
+                g.glocation.matrix)
+
+    def get(self, key):
+        '''
+        @rtype: GeneratorRecord
+        @return: a fresh copy of the stored record or None
+        '''
+        data = self._entries.pop(key, None)
+
+        if data is None:
+            self.misses += 1
+            return None
+
+        # mark as most recently used
+        self._entries[key] = data
+        self.hits += 1
+
+        return snapshot.loads(data)
+
+    def put(self, key, record):
+        data = snapshot.dumps(record)
+
+        self.remove(key)
+
+        if len(data) > self.max_bytes:
+            return
+
+        self._entries[key] = data
+        self.size += len(data)
+
+        self._evict()
+
+    def remove(self, key):
+        data = self._entries.pop(key, None)
+        if data is not None:
+            self.size -= len(data)
+
+    def _evict(self):
+        e = self._entries
+
+        while len(e) > self.max_entries or self.size > self.max_bytes:
+            key, data = e.popitem(last=False)
+            self.size -= len(data)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+def _get_class_files(_class):
+    '''
+    Source files which determine the behaviour of _class;
+    all python files of its package (and the packages that
+    it depends on) if it was loaded from a package.
+    '''
+    ident = getattr(_class, 'IDENT', None)
+    package_dir = ident.package_dir if ident else None
+
+    if not package_dir:
+        try:
+            fpath = inspect.getsourcefile(_class)
+        except TypeError:
+            fpath = None
+        return [fpath] if fpath else []
+
+    package_dirs = [package_dir]
+    pkg = get_loader().packages.get(package_dir.rstrip(os.path.sep))
+    if pkg:
+        package_dirs.extend(sorted(pkg._depends_on))
+
+    files = []
+    for d in package_dirs:
+        files.extend(sorted(_get_python_files(d)))
+
+    return files
+
+class _SourceDigest:
+    def __init__(self, files):
+        self.files = files
+        self.signature = None
+        self.digest = None
+        self.check_time = 0
+
+    def _get_signature(self):
+        signature = []
+
+        for fpath in self.files:
+            try:
+                stat = os.stat(fpath)
+            except OSError:
+                continue
+            signature.append((fpath, stat.st_mtime, stat.st_size))
+
+        return signature
+
+    def get(self, check_interval):
+        now = time.time()
+        if self.digest and now - self.check_time < check_interval:
+            return self.digest
+
+        self.check_time = now
+
+        signature = self._get_signature()
+        if signature == self.signature:
+            return self.digest
+
+        sha = hashlib.sha1()
+        for fpath, mtime, size in signature:
+            sha.update(fpath)
+            sha.update(open(fpath, 'rb').read())
+
+        self.signature = signature
+        self.digest = sha.hexdigest()
+        return self.digest
+
+class DiskCache(GenerationCache):
+    '''
+    Cache of generator records stored in a directory, one file
+    per record named by its key. Keys include a digest of the
+    source files of the generator's package and of procodile
+    (which makes the geoms and pickles them), so records become
+    unreachable (and are eventually evicted) as soon as either
+    is modified.
+
+    Least recently used records (by file modification time) are
+    evicted when the total size crosses max_bytes.
+
+    An in-memory cache (L{GenerationCache}) can be put in front of
+    the directory using memory.
+    '''
+
+    #: seconds for which a computed source digest is
+    #   trusted without checking file modification times.
+    SOURCE_CHECK_INTERVAL = 2
+
+    def __init__(self, cache_dir=None, max_bytes=1024 * 1024 * 1024,
+                       memory=None):
+
+        if not cache_dir:
+            cache_dir = os.path.join(get_user_app_dir(), 'buildcache')
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory = memory
+
+        self.hits = 0
+        self.misses = 0
+
+        self._digests = {}
+
+        library_dir = os.path.dirname(os.path.abspath(__file__))
+        self._library_digest = _SourceDigest(
+                                    sorted(_get_python_files(library_dir)))
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.size = sum(size for mtime, size, fpath in self._scan())
+        self._evict()
+
+    def _get_source_digest(self, _class):
+        digest = self._digests.get(_class)
+
+        if digest is None:
+            digest = _SourceDigest(_get_class_files(_class))
+            self._digests[_class] = digest
+
+        return digest.get(self.SOURCE_CHECK_INTERVAL)
+
+    def _get_key_data(self, info):
+        data = GenerationCache._get_key_data(self, info)
+
+        check_interval = self.SOURCE_CHECK_INTERVAL
+        sources = (self._library_digest.get(check_interval),
+                   self._get_source_digest(info._generator),
+                   self._get_source_digest(info.generator))
+
+        return data, sources
+
+    def _get_fpath(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _scan(self):
+        '''
+        @rtype: list
+        @return: (mtime, size, fpath) of all records
+        '''
+        entries = []
+
+        for dirpath, dirnames, fnames in os.walk(self.cache_dir):
+            for fname in fnames:
+                fpath = os.path.join(dirpath, fname)
+                try:
+                    stat = os.stat(fpath)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, fpath))
+
+        return entries
+
+    def get(self, key):
+        fpath = self._get_fpath(key)
+
+        if self.memory is not None and key in self.memory:
+            # mark as most recently used on disk too
+            try:
+                os.utime(fpath, None)
+            except OSError:
+                pass
+
+            self.hits += 1
+            return self.memory.get(key)
+
+        try:
+            data = open(fpath, 'rb').read()
+        except IOError:
+            self.misses += 1
+            return None
+
+        try:
+            record = snapshot.loads(data)
+
+        except (SystemExit, KeyboardInterrupt):
+            raise
+
+        except:
+            # eg: a class in the record no longer exists
+            log.exception('bad build cache entry %s' % fpath)
+            self.remove(key)
+            self.misses += 1
+            return None
+
+        # mark as most recently used
+        os.utime(fpath, None)
+        self.hits += 1
+
+        if self.memory is not None:
+            self.memory.put(key, record)
+
+        return record
+
+    def put(self, key, record):
+        data = snapshot.dumps(record)
+
+        if self.memory is not None:
+            self.memory.put(key, record)
+
+        self._remove_file(key)
+
+        if len(data) > self.max_bytes:
+            return
+
+        fpath = self._get_fpath(key)
+        dirpath = os.path.dirname(fpath)
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+
+        # write and rename so that readers never see
+        # a partially written record
+        fd, tmp_fpath = tempfile.mkstemp(dir=dirpath)
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+        if sys.platform == 'win32' and os.path.exists(fpath):
+            os.remove(fpath)
+        os.rename(tmp_fpath, fpath)
+
+        self.size += len(data)
+        self._evict()
+
+    def remove(self, key):
+        if self.memory is not None:
+            self.memory.remove(key)
+
+        self._remove_file(key)
+
+    def _remove_file(self, key):
+        fpath = self._get_fpath(key)
+
+        try:
+            size = os.path.getsize(fpath)
+            os.remove(fpath)
+        except OSError:
+            return
+
+        self.size -= size
+
+    def _evict(self):
+        if self.size <= self.max_bytes:
+            return
+
+        # evict down to 90% at once as this needs
+        # a scan of the cache dir
+        limit = self.max_bytes * 0.9
+
+        entries = self._scan()
+        entries.sort()
+        self.size = sum(size for mtime, size, fpath in entries)
+
+        for mtime, size, fpath in entries:
+            if self.size <= limit:
+                break
+
+            try:
+                os.remove(fpath)
+            except OSError:
+                continue
+
+            self.size -= size
+
+    def clear(self):
+        if self.memory is not None:
+            self.memory.clear()
+
+        for mtime, size, fpath in self._scan():
+            try:
+                os.remove(fpath)
+            except OSError:
+                pass
+
+        self.size = 0
+
+    def __len__(self):
+        return len(self._scan())
+
+    def __contains__(self, key):
+        return os.path.exists(self._get_fpath(key))
@@ -1,6 +1,10 @@
-from itertools import chain
+import numpy
 
-def make_collada(doc, positions, indices, normals):
+def make_collada(doc, meshes):
+    '''
+    @param meshes: one mesh per solid as given by
+        L{draw.Object.get_mesh_arrays}
+    '''
 
     asset = doc.asset
     asset.created.text = '2009-09-18T21:23:22Z'
@@ -35,7 +39,7 @@ def make_collada(doc, positions, indices, normals):
     visual_scene = doc.library_visual_scenes.visual_scene
     visual_scene.attrs = {'id': 'Scene', 'name': 'Scene'}
 
-    for i, p in enumerate(positions):
+    for i, (positions, indices, normals, tcoords) in enumerate(meshes):
         _id = 'solid-%s' % i
 
         geometry = doc.library_geometries.geometry
@@ -43,11 +47,11 @@ def make_collada(doc, positions, indices, normals):
 
         mesh = geometry.mesh
 
-        add_source(mesh, positions[i], '%s-positions' %_id)
-        add_source(mesh, normals[i], '%s-normals' %_id)
+        add_source(mesh, positions, '%s-positions' %_id)
+        add_source(mesh, normals, '%s-normals' %_id)
 
         add_vertices(mesh, _id)
-        add_triangles(mesh, indices[i], _id)
+        add_triangles(mesh, indices, _id)
 
         node = visual_scene.node
         node.attrs = {'layer': "L1", 'id': _id, 'name': _id}
@@ -90,7 +94,8 @@ def add_vertices(mesh, _id):
                             'source': "#%s-positions" %_id}
 
 def add_triangles(mesh, indices, _id):
-    data = list(chain(*[(str(x), str(x)) for t in indices for x in t ]))
+    # vertex and normal indices are the same
+    data = [str(x) for x in numpy.repeat(indices.ravel(), 2).tolist()]
     triangles = mesh.triangles
     triangles.attrs = {'count': len(indices), 'material': 'BlueSG'}
     triangles.input.attrs = {'offset': '0', 'semantic': 'VERTEX',
@@ -104,7 +109,7 @@ def add_source(mesh, data, _id):
     source = mesh.source
     source.attrs = {'id': _id, 'name': _id}
     float_array = source.float_array
-    data = list(chain(*data))
+    data = data.ravel().tolist()
     float_array.attrs = {'id': '%s-array' % _id, 'count': len(data)}
     float_array.text = ' '.join([str(x) for x in data])
 
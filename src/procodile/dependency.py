@@ -0,0 +1,177 @@
+'''
+Tracking of dependencies between generators for incremental rebuilds.
+
+Generators which perform spatial queries make decisions based on the
+output of other generators. The build space records the regions that
+every generator queried and the generators that were found there (the
+read set of the generator). While generators are being re-run, the
+regions and generators that are modified are recorded (the change set)
+and the generators whose read sets overlap the change set are the ones
+that need to be re-run to bring the build up to date.
+
+G{importgraph}
+'''
+
+from collections import OrderedDict
+
+def _intersects(a, b):
+    return a.xmin <= b.xmax and b.xmin <= a.xmax and \
+           a.ymin <= b.ymax and b.ymin <= a.ymax and \
+           a.zmin <= b.zmax and b.zmin <= a.zmax
+
+class ReadSet(object):
+    '''
+    What a generator has seen through spatial queries.
+    '''
+
+    __slots__ = ['regions', 'generators', 'epoch']
+
+    def __init__(self, epoch):
+        #: BoundBoxes (global) that were queried
+        self.regions = []
+
+        #: ids of generators which were found (directly or
+        #   through their geoms) in query results
+        self.generators = set()
+
+        #: recording epoch during which the generator ran
+        self.epoch = epoch
+
+    def overlaps(self, changes, key=None):
+        '''
+        @param key: id of the generator which made the reads;
+            changes made by its sub generators are left out
+        '''
+        for gen_id, ancestors, changed in changes.changes:
+            if key is not None and key in ancestors:
+                continue
+
+            if gen_id in self.generators:
+                return True
+
+            if changed is None:
+                continue
+
+            for region in self.regions:
+                if _intersects(region, changed):
+                    return True
+
+        return False
+
+class ChangeSet(object):
+    '''
+    What has been modified while recording.
+    '''
+
+    __slots__ = ['changes']
+
+    def __init__(self):
+        #: (id of generator which was modified or removed,
+        #   ids of its ancestors, BoundBox (global) of geoms
+        #   added or removed or None) in the order of modification
+        self.changes = []
+
+    def __nonzero__(self):
+        return bool(self.changes)
+
+class DependencyTracker:
+    '''
+    Read sets of the generators in a build space.
+    '''
+
+    def __init__(self):
+        #: id(gen_obj) -> (gen_obj, ReadSet) in order of first read
+        self.readers = OrderedDict()
+
+        #: ChangeSet being recorded (None when not recording)
+        self.changes = None
+
+        self.epoch = 0
+
+    def add_read(self, gen_obj, bbox, results=None):
+        '''
+        Record that gen_obj has queried bbox (global) and
+        found results (L{buildspace.SpatialResults}).
+        '''
+        key = id(gen_obj)
+        entry = self.readers.get(key)
+
+        if entry is None:
+            entry = gen_obj, ReadSet(self.epoch)
+            self.readers[key] = entry
+
+        read_set = entry[1]
+        read_set.regions.append(bbox.copy())
+
+        if results is None:
+            return
+
+        generators = read_set.generators
+        generators.update(results.generators.iterkeys())
+
+        for geom in results.geoms.itervalues():
+            generators.add(id(geom.generator))
+
+    def get_regions(self, gen_obj):
+        entry = self.readers.get(id(gen_obj))
+        return list(entry[1].regions) if entry else []
+
+    def on_change(self, gen_obj, bbox=None):
+        '''
+        gen_obj has been modified; bbox (global) is the
+        region affected (if any).
+        '''
+        changes = self.changes
+        if changes is None:
+            return
+
+        ancestors = set(id(a) for a in gen_obj.ancestors)
+        changes.changes.append((id(gen_obj), ancestors, bbox))
+
+    def remove(self, gen_obj):
+        '''
+        gen_obj has been removed from the build space.
+        '''
+        self.readers.pop(id(gen_obj), None)
+        self.on_change(gen_obj)
+
+    def start_recording(self):
+        self.epoch += 1
+        self.changes = ChangeSet()
+
+    def stop_recording(self):
+        '''
+        @rtype: ChangeSet
+        @return: changes since L{start_recording}
+        '''
+        changes, self.changes = self.changes, None
+        return changes
+
+    def get_dependents(self, changes):
+        '''
+        Generators whose read sets overlap changes. Generators
+        which ran while the changes were being recorded have
+        seen them already. Changes made by the sub generators
+        of a generator do not affect it.
+
+        @rtype: list
+        @return: generators in the order of their first query
+        '''
+        dependents = []
+
+        if not changes:
+            return dependents
+
+        for key, (gen_obj, read_set) in self.readers.iteritems():
+
+            if read_set.epoch == self.epoch:
+                continue
+
+            if read_set.overlaps(changes, key):
+                dependents.append(gen_obj)
+
+        return dependents
+
+    def clear(self):
+        self.readers.clear()
+        self.changes = None
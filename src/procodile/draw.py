@@ -4,19 +4,46 @@ Drawing API - Uses GTS for CAD functionality.
 G{importgraph}
 '''
 
+import copy
 import math
+from collections import OrderedDict
 
+import numpy
 import gts as _gts
 
-from procodile.utils import Vector, drange, fequals
+from procodile.utils import Vector, Matrix, drange, fequals
 
 NUM_MERIDIANS = 20
 PI = math.pi
 
 class Object(object):
+    '''
+    Base of geoms wrapping GTS objects.
+
+    Transforms (L{translate}, L{rotate} and L{transform}) are not
+    applied to the vertices right away. They are composed into a
+    pending matrix which is applied (along with turning the vertex
+    normals) when the GTS object is next needed (through _obj), so a
+    geom moved around many times has its vertices rewritten once.
+    Bound boxes are worked out without applying pending transforms.
+
+    Parts of an object (wrappers from eg: L{vertices}, faces given
+    to L{Surface.add}, L{Fan.center}) apply the pending transforms
+    of the object when read. Parts share their vertices with the
+    object, so transforms of parts are applied right away.
+
+    The bound box of an object is cached. Translations (and other
+    transforms keeping it axis aligned) move the cached box; other
+    rotations, L{Surface.add}, L{Surface.remove} and moving vertices
+    through its parts drop it.
+    '''
 
     def __init__(self):
 
+        # transform (4x4 numpy array) yet to be applied
+        # to the vertices of the GTS object
+        self._pending = None
+
         #: Underlying GTS object
         self._obj = None
         
@@ -43,47 +70,132 @@ class Object(object):
         #   will be sent to this object if defined.
         self._update_target = None
    
+    def _get_obj(self):
+        self._flush()
+        return self._gts_obj
+
+    def _set_obj(self, obj):
+        self._gts_obj = obj
+        self._pending = None
+        self._bbox = None
+
+    def _del_obj(self):
+        del self._gts_obj
+        del self._pending
+        del self._bbox
+
+    _obj = property(_get_obj, _set_obj, _del_obj)
+
+    def _flush(self):
+        '''
+        Apply pending transforms of this object and of
+        the objects that it is a part of.
+        '''
+        if self._update_target is not None:
+            self._update_target._flush()
+
+        if self._pending is not None:
+            self._apply_pending()
+
+    def _apply_pending(self):
+        matrix = self._pending
+        self._pending = None
+
+        vertices = self._list_gts_vertices(self._gts_obj)
+        if not vertices:
+            return
+
+        coords = numpy.array([(v.x, v.y, v.z) for v in vertices])
+        coords = numpy.dot(coords, matrix[:3, :3].T) + matrix[:3, 3]
+
+        for v, (x, y, z) in zip(vertices, coords.tolist()):
+            v.x, v.y, v.z = x, y, z
+
+        # normals turn with the object
+        ids = [i for i, n in self.vnormals.iteritems() if n is not None]
+        if ids:
+            normals = [self.vnormals[i] for i in ids]
+            normals = _transform_normals(normals, matrix)
+            self.vnormals = dict(self.vnormals)
+            self.vnormals.update(zip(ids, map(tuple, normals.tolist())))
+
+            if self._update_target is not None:
+                for i in ids:
+                    self._update_target._update_normal(i, self.vnormals[i])
+
+    def _add_transform(self, matrix):
+        if self._update_target is not None:
+            self._flush()
+            self._pending = matrix
+            self._apply_pending()
+            self._invalidate_bbox()
+            return
+
+        pending = self._pending
+        self._pending = matrix if pending is None else \
+                        numpy.dot(matrix, pending)
+
+        if self._bbox is not None:
+            self._bbox = _transform_bbox(self._bbox, matrix)
+
+    def _set_container(self, container):
+        '''
+        Make this object a part of container (whose vertices
+        it shares).
+        '''
+        self._update_target = container
+
+        # parts do not cache their bound box
+        self._bbox = None
+
+    def _invalidate_bbox(self):
+        '''
+        Drop the cached bound box of this object and of
+        the objects that it is a part of.
+        '''
+        self._bbox = None
+
+        if self._update_target is not None:
+            self._update_target._invalidate_bbox()
+
     def translate(self, x, y, z):
-        # TODO: the vertex normals of object
-        # have to be tranformed too.
-        self._obj.translate(x, y, z)
+        self._add_transform(Matrix.get_translation_matrix((x, y, z), False))
 
     def rotate(self, dx, dy, dz, angle):
-        # TODO: the vertex normals of object
-        # have to be tranformed too.
-        self._obj.rotate(dx, dy, dz, angle)
+        '''
+        Rotate by angle about the axis (dx, dy, dz) through the origin.
+        '''
+        self._add_transform(Matrix.get_rotation_matrix((angle, (dx, dy, dz))))
 
     def transform(self, matrix):
-        # TODO: Check this logic. It is almost definitely
-        #   broken ;)
-        translation = matrix.get_translation()
-        angle, axis, point = matrix.get_rotation()
-
-        self._obj.translate(*translation)
-        dx, dy, dz = axis
-        self._obj.rotate(dx, dy, dz, angle) #TODO: what about "point"?
-
-        # TODO: the vertex normals of object
-        # have to be tranformed too.
+        '''
+        @param matrix: L{utils.Matrix} to transform vertices by
+        '''
+        self._add_transform(numpy.asarray(matrix.matrix, dtype=float))
 
     def get_bound_box(self):
+        if self._bbox is not None:
+            return self._bbox
+
+        # wrappers of parts are not told when the object they
+        # are a part of is transformed, so they do not cache
+        if self._update_target is not None:
+            self._update_target._flush()
 
-        vertices = self.vertices
+        vertices = self._list_gts_vertices(self._gts_obj)
+        coords = numpy.array([(v.x, v.y, v.z) for v in vertices])
 
-        xvalues = [v.x for v in vertices]
-        min_x = min(xvalues)
-        max_x = max(xvalues)
+        matrix = self._pending
+        if matrix is not None:
+            coords = numpy.dot(coords, matrix[:3, :3].T) + matrix[:3, 3]
 
-        yvalues = [v.y for v in vertices]
-        min_y = min(yvalues)
-        max_y = max(yvalues)
+        bbox = tuple(coords.min(axis=0).tolist() +
+                     coords.max(axis=0).tolist())
 
-        zvalues = [v.z for v in vertices]
-        min_z = min(zvalues)
-        max_z = max(zvalues)
+        if self._update_target is None:
+            self._bbox = bbox
 
-        return (min_x, min_y, min_z,
-                max_x, max_y, max_z)
+        return bbox
 
     def _update_normal(self, vertex_id, normal):
         self.vnormals[vertex_id] = normal
@@ -95,18 +207,149 @@ class Object(object):
         if self._update_target:
             self._update_target._update_tcoord(vertex_id, tcoord)
 
+    # transforms do not change the identity of the GTS
+    # object, so these do not apply pending transforms
+
     def __eq__(self, other):
-        return other._obj.id == self._obj.id
+        return other._gts_obj.id == self._gts_obj.id
 
     def __ne__(self, other):
             return not self.__eq__(other)
 
     def __hash__(self):
-        return self._obj.id
+        return self._gts_obj.id
 
     @property
     def id(self):
-        return self._obj.id
+        return self._gts_obj.id
+
+    def __getstate__(self):
+        obj = self._obj
+        state = self.__dict__.copy()
+
+        # generator and update target belong to the build
+        # that the object lives in and are not carried along
+        state['generator'] = None
+        state['_update_target'] = None
+
+        del state['_gts_obj']
+        del state['_pending']
+        state['_obj'] = None
+
+        if obj is not None:
+            vertices = self._get_gts_vertices()
+            ids = [v.id for v in vertices]
+            state['_obj'] = self._pack(vertices)
+            state['vnormals'] = [self.vnormals.get(i) for i in ids]
+            state['tcoords'] = [self.tcoords.get(i) for i in ids]
+
+        return state
+
+    def __setstate__(self, state):
+        data = state.pop('_obj')
+        self.__dict__.update(state)
+        self._obj = None
+
+        if data is None:
+            return
+
+        # vertex data is keyed by ids of GTS objects which
+        # are different for the re-created GTS object
+        self._obj, vertices = self._unpack(data)
+        self._bbox = state.get('_bbox')
+        vnormals = zip(vertices, state['vnormals'])
+        tcoords = zip(vertices, state['tcoords'])
+        self.vnormals = dict((v.id, n) for v, n in vnormals if n is not None)
+        self.tcoords = dict((v.id, t) for v, t in tcoords if t is not None)
+
+    def _get_gts_vertices(self):
+        return self._list_gts_vertices(self._obj)
+
+    def _list_gts_vertices(self, obj):
+        '''
+        @return: GTS vertices of obj (the underlying GTS object)
+        '''
+        return [v._obj for v in self.vertices]
+
+    def _pack(self, vertices):
+        '''
+        Reduce the underlying GTS object to plain data.
+        '''
+        raise NotImplementedError
+
+    def _unpack(self, data):
+        '''
+        Re-create the underlying GTS object from data
+        produced by _pack.
+
+        @return: GTS object, GTS vertices (in the order
+            they were given to _pack)
+        '''
+        raise NotImplementedError
+
+def _transform_bbox(bbox, matrix):
+    '''
+    @param matrix: affine transform (4x4 numpy array)
+
+    @return: bbox transformed by matrix if the transform keeps
+        boxes axis aligned (eg: translations, rotations by
+        multiples of 90 degrees about the axes), else None
+    '''
+    # plain python is quicker than numpy at this size
+    lo, hi = [], []
+
+    for row, offset in zip(matrix[:3, :3].tolist(), matrix[:3, 3].tolist()):
+        axes = [i for i, v in enumerate(row) if abs(v) >= 1e-12]
+
+        # every axis has to map onto an axis
+        if len(axes) > 1:
+            return None
+
+        if not axes:
+            a = b = offset
+        else:
+            i = axes[0]
+            a = row[i] * bbox[i] + offset
+            b = row[i] * bbox[i + 3] + offset
+
+        lo.append(min(a, b))
+        hi.append(max(a, b))
+
+    return tuple(lo + hi)
+
+def _transform_normals(normals, matrix):
+    '''
+    @param normals: n x 3
+    @param matrix: affine transform (4x4 numpy array)
+
+    @return: normals transformed by matrix (n x 3 numpy array)
+    '''
+    # normals go by the inverse transpose so that they stay
+    # perpendicular to the faces under non-uniform scaling
+    # (rows are transformed, hence no transpose here)
+    normals = numpy.dot(normals, numpy.linalg.inv(matrix[:3, :3]))
+    lengths = numpy.sqrt((normals * normals).sum(axis=1))
+    lengths[lengths == 0] = 1
+    return normals / lengths[:, numpy.newaxis]
+
+def _pack_edges(edges, vertices):
+    index = dict((v.id, i) for i, v in enumerate(vertices))
+    positions = [(v.x, v.y, v.z) for v in vertices]
+    edges = [(index[e.v1.id], index[e.v2.id]) for e in edges]
+    return positions, edges
+
+def _unpack_edges(data):
+    positions, edges = data
+    vertices = [_gts.Vertex(*p) for p in positions]
+
+    # an edge shared by faces of a surface is
+    # re-created only once
+    _edges = {}
+    for i, j in edges:
+        if (i, j) not in _edges:
+            _edges[(i, j)] = _gts.Edge(vertices[i], vertices[j])
+
+    return vertices, [_edges[e] for e in edges]
 
 class Vertex(Object):
 
@@ -130,6 +373,7 @@ class Vertex(Object):
 
     def _set_x(self, value):
         self._obj.x = value
+        self._invalidate_bbox()
     
     x = property(_get_x, _set_x)
 
@@ -138,6 +382,7 @@ class Vertex(Object):
 
     def _set_y(self, value):
         self._obj.y = value
+        self._invalidate_bbox()
     
     y = property(_get_y, _set_y)
     
@@ -146,6 +391,7 @@ class Vertex(Object):
 
     def _set_z(self, value):
         self._obj.z = value
+        self._invalidate_bbox()
     
     z = property(_get_z, _set_z)
 
@@ -156,6 +402,7 @@ class Vertex(Object):
     def _set_position(self, position):
         o = self._obj
         o.x, o.y, o.z = position
+        self._invalidate_bbox()
 
     position = property(_get_position, _set_position)
 
@@ -184,6 +431,17 @@ class Vertex(Object):
     def distance(self, object):
         return self._obj.distance(object._obj)
 
+    def _list_gts_vertices(self, obj):
+        return [obj]
+
+    def _pack(self, vertices):
+        o = self._obj
+        return (o.x, o.y, o.z)
+
+    def _unpack(self, data):
+        v = _gts.Vertex(*data)
+        return v, [v]
+
 def _wrap_vertex(vertex, container):
     v = Vertex()
     v._obj = vertex
@@ -249,6 +507,16 @@ class Edge(Object):
     def vertices(self):
         return (self.v1, self.v2)
 
+    def _list_gts_vertices(self, obj):
+        return [obj.v1, obj.v2]
+
+    def _pack(self, vertices):
+        return _pack_edges([self._obj], vertices)
+
+    def _unpack(self, data):
+        vertices, edges = _unpack_edges(data)
+        return edges[0], vertices
+
 class Face(Object):
 
     def __init__(self, *args):
@@ -271,8 +539,11 @@ class Face(Object):
 
     @property
     def mesh(self):
+        # not through Surface.add, which would
+        # make the face a part of s
         s = Surface()
-        s.add(self)
+        s._obj.add(self._obj)
+        _merge_vertex_data(s, (self,))
         return s.mesh
 
     @property
@@ -295,6 +566,44 @@ class Face(Object):
     def normal(self):
         return self._obj.normal()
 
+    def _list_gts_vertices(self, obj):
+        return list(obj.vertices())
+
+    def _pack(self, vertices):
+        o = self._obj
+        return _pack_edges([o.e1, o.e2, o.e3], vertices)
+
+    def _unpack(self, data):
+        vertices, edges = _unpack_edges(data)
+        return _gts.Face(*edges), vertices
+
+def _get_mesh_lists(mesh):
+    positions, indices, normals, tcoords = mesh
+
+    vertices = [tuple(p) for p in positions.tolist()]
+    indices = tuple(tuple(i) for i in indices.tolist())
+    normals = [tuple(n) for n in normals.tolist()]
+    tcoords = [None if t[0] != t[0] else tuple(t)
+               for t in tcoords.tolist()]
+
+    return vertices, indices, normals, tcoords
+
+def transform_mesh(mesh, matrix, dtype=numpy.float32):
+    '''
+    @param mesh: as returned by L{Surface.get_mesh_arrays}
+    @param matrix: L{utils.Matrix}
+
+    @return: mesh transformed by matrix
+    '''
+    positions, indices, normals, tcoords = mesh
+    m = numpy.asarray(matrix.matrix, dtype=float)
+
+    positions = matrix.transform_points(positions)
+    normals = _transform_normals(normals, m)
+
+    return (positions.astype(dtype), indices,
+            normals.astype(dtype), tcoords.astype(dtype))
+
 class Surface(Object):
 
     def __init__(self, *args):
@@ -336,42 +645,110 @@ class Surface(Object):
         for p in _parts:
             self._obj.add(p._obj)
             _merge_vertex_data(self, (p,))
+            p._set_container(self)
+
+        self._invalidate_bbox()
 
     def remove(self, part):
         self._obj.remove(part)
+        self._invalidate_bbox()
         # FIXME: the tcoords and vertex normals of removed part
         #   have to be purged.
 
-    @property
-    def mesh(self):
-        vertices = self.vertices
-        _vertices = tuple([v._obj for v in vertices])
-        indices = self._obj.face_indices(_vertices)
-        tcoords = [self.tcoords.get(v.id) for v in vertices]
-
-        no_normal_verts = [v for v in vertices if v.id not in self.vnormals]
-        _vnormals = {}
+    def get_mesh_arrays(self, dtype=numpy.float32):
+        '''
+        Mesh of the surface as numpy arrays. Normals of vertices
+        which have not been given one are the sums of the normals
+        of the faces around them weighted by face area.
+
+        GTS enumerates vertices and faces in an order of its own
+        (different for copies of a surface, eg: one re-created
+        from a pickle), so vertices are sorted by position, tcoord
+        and normal and faces by their vertices. The mesh of a
+        surface does not depend on how it came about.
+
+        @param dtype: type of positions, normals and tcoords
+
+        @return: positions (n x 3), indices (m x 3, uint32;
+            vertices of triangles), normals (n x 3) and
+            tcoords (n x 2; nan where not given)
+        '''
+        vertices = tuple(self._obj.vertices())
+        num_vertices = len(vertices)
 
-        for v in no_normal_verts:
-            fnormals = [f.normal() for f in v._obj.faces()]
-            fnormals = [Vector(*fn).normalize() for fn in fnormals]
+        positions = numpy.array([(v.x, v.y, v.z) for v in vertices],
+                                dtype=float).reshape(-1, 3)
+        indices = numpy.array(self._obj.face_indices(vertices),
+                              dtype=numpy.uint32).reshape(-1, 3)
 
-            vnormal = Vector()
-            for fn in fnormals:
-                vnormal = vnormal + fn
+        vnormals = numpy.empty((num_vertices, 3))
+        vnormals[:] = numpy.nan
 
-            vnormal = vnormal.normalize()
+        tcoords = numpy.empty((num_vertices, 2))
+        tcoords[:] = numpy.nan
 
-            vnormal = (vnormal.x, vnormal.y, vnormal.z)
-            _vnormals[v.id] = vnormal
+        _vnormals = self.vnormals
+        _tcoords = self.tcoords
 
-        normals = []
         for index, v in enumerate(vertices):
-            n = self.vnormals.get(v.id) or _vnormals[v.id]
-            normals.append(n)
-            vertices[index] = v.position
-       
-        return vertices, indices, normals, tcoords
+            n = _vnormals.get(v.id)
+            if n is not None:
+                vnormals[index] = n
+
+            t = _tcoords.get(v.id)
+            if t is not None:
+                tcoords[index] = t
+
+        # canonical order of vertices; lexsort takes
+        # the primary key last
+        keys = numpy.column_stack((positions, tcoords, vnormals))
+        order = numpy.lexsort(keys.T[::-1])
+
+        rank = numpy.empty(num_vertices, dtype=numpy.uint32)
+        rank[order] = numpy.arange(num_vertices, dtype=numpy.uint32)
+
+        positions = positions[order]
+        vnormals = vnormals[order]
+        tcoords = tcoords[order]
+        indices = rank[indices]
+
+        # faces start at their lowest vertex (keeping the
+        # winding) and are sorted by their vertices
+        first = indices.argmin(axis=1)[:, numpy.newaxis]
+        rows = numpy.arange(len(indices))[:, numpy.newaxis]
+        indices = indices[rows, (first + numpy.arange(3)) % 3]
+        indices = indices[numpy.lexsort(indices.T[::-1])]
+
+        # the length of the cross product of two edges
+        # is twice the area of the triangle
+        triangles = positions[indices]
+        fnormals = numpy.cross(triangles[:, 1] - triangles[:, 0],
+                               triangles[:, 2] - triangles[:, 0])
+
+        # add the normal of every face to each of its vertices
+        corners = indices.ravel()
+        fnormals = numpy.repeat(fnormals, 3, axis=0)
+        normals = numpy.column_stack([
+            numpy.bincount(corners, fnormals[:, i], minlength=num_vertices)
+            for i in range(3)]).reshape(-1, 3)
+
+        lengths = numpy.sqrt((normals * normals).sum(axis=1))
+        normals /= numpy.where(lengths > 0, lengths, 1)[:, numpy.newaxis]
+
+        # normals given to vertices are kept
+        given = ~numpy.isnan(vnormals[:, 0])
+        normals[given] = vnormals[given]
+
+        return (positions.astype(dtype), indices,
+                normals.astype(dtype), tcoords.astype(dtype))
+
+    @property
+    def mesh(self):
+        '''
+        L{get_mesh_arrays} as lists of tuples (None
+        for vertices without tcoords).
+        '''
+        return _get_mesh_lists(self.get_mesh_arrays(numpy.float64))
 
     @property
     def vertices(self):
@@ -389,7 +766,31 @@ class Surface(Object):
         for f in self._obj.faces():
             f.revert()
 
+    def _list_gts_vertices(self, obj):
+        return list(obj.vertices())
+
+    def _pack(self, vertices):
+        edges = []
+        for f in self._obj.faces():
+            edges.extend((f.e1, f.e2, f.e3))
+        return _pack_edges(edges, vertices)
+
+    def _unpack(self, data):
+        vertices, edges = _unpack_edges(data)
+
+        s = _gts.Surface()
+        for index in xrange(0, len(edges), 3):
+            s.add(_gts.Face(*edges[index:index+3]))
+
+        return s, vertices
+
 class SurfaceGroup(Object):
+    '''
+    Named surfaces transformed together. The bound box of the group
+    is cached like that of other objects; surfaces transformed or
+    modified on their own (rather than through the group) need
+    L{_invalidate_bbox} of the group to be called.
+    '''
     
     def __init__(self):
         self.surfaces = {}
@@ -400,6 +801,8 @@ class SurfaceGroup(Object):
         del self._obj
         del self._update_target
 
+        self._bbox = None
+
     def _get_unused_name(self):
         for i in xrange(10000000000):
             if str(i) not in self.surfaces:
@@ -408,6 +811,7 @@ class SurfaceGroup(Object):
     def add(self, surface, name=None):
         name = name or self._get_unused_name()
         self.surfaces[name] = surface
+        self._bbox = None
 
     def remove(self, surface):
         if isinstance(surface, (str, unicode)) and surface in self.surfaces:
@@ -422,17 +826,17 @@ class SurfaceGroup(Object):
             if name:
                 del self.surfaces[name]
 
-    def translate(self, x, y, z):
-        for name, surface in self.surfaces.iteritems():
-            surface.translate(x, y, z)
+        self._bbox = None
 
-    def rotate(self, dx, dy, dz, angle):
-        for name, surface in self.surfaces.iteritems():
-            surface.rotate(dx, dy, dz, angle)
+    def _add_transform(self, matrix):
+        for surface in self.surfaces.itervalues():
+            surface._add_transform(matrix)
 
-    def transform(self, matrix):
-        for name, surface in self.surfaces.iteritems():
-            surface.transform(matrix)
+        if self._bbox is not None:
+            self._bbox = _transform_bbox(self._bbox, matrix)
+
+    def _invalidate_bbox(self):
+        self._bbox = None
 
     def _get_material(self):
         return dict((n, s.material) for n, s in self.surfaces.iteritems())
@@ -448,19 +852,12 @@ class SurfaceGroup(Object):
     material = property(_get_material, _set_material)
 
     def get_bound_box(self):
-        bboxes = []
+        if self._bbox is None:
+            bboxes = [s.get_bound_box() for s in self.surfaces.itervalues()]
+            self._bbox = tuple(map(min, zip(*bboxes)[:3]) +
+                               map(max, zip(*bboxes)[3:]))
 
-        for name, surface in self.surfaces.iteritems():
-            bboxes.append(surface.get_bound_box())
-
-        min_x = min(b[0] for b in bboxes)
-        min_y = min(b[1] for b in bboxes)
-        min_z = min(b[2] for b in bboxes)
-        max_x = max(b[3] for b in bboxes)
-        max_y = max(b[4] for b in bboxes)
-        max_z = max(b[5] for b in bboxes)
-
-        return (min_x, min_y, min_z, max_x, max_y, max_z)
+        return self._bbox
 
     @property
     def area(self):
@@ -478,12 +875,162 @@ class SurfaceGroup(Object):
     def __hash__(self):
         return hash(self._canonical_form())
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['generator'] = None
+        return state
+
+    def __setstate__(self, state):
+        self._bbox = None
+        self.__dict__.update(state)
+
+class _SurfaceTemplate(object):
+    '''
+    Canonical mesh of a surface (in packed form, as for pickling)
+    from which copies are stamped.
+    '''
+
+    # attributes which are not copied as they are
+    SKIP = set(['_gts_obj', '_pending', '_bbox', 'vnormals', 'tcoords', 'tags',
+                'generator', 'visible', 'material', '_update_target'])
+
+    def __init__(self, surface):
+        self.cls = surface.__class__
+
+        vertices = surface._get_gts_vertices()
+        index = dict((v.id, i) for i, v in enumerate(vertices))
+
+        self.data = surface._pack(vertices)
+        self.vnormals = [surface.vnormals.get(v.id) for v in vertices]
+        self.tcoords = [surface.tcoords.get(v.id) for v in vertices]
+
+        #: attributes holding vertices of the surface (eg:
+        #   Disc.disc_vertices) -> their indices
+        self.vertex_attrs = {}
+
+        #: other attributes (eg: Disc.radius)
+        self.attrs = {}
+
+        for name, value in surface.__dict__.iteritems():
+            if name in self.SKIP:
+                continue
+
+            if isinstance(value, Vertex) and value.id in index:
+                self.vertex_attrs[name] = index[value.id]
+
+            elif isinstance(value, list) and value and \
+                all(isinstance(v, Vertex) and v.id in index for v in value):
+                self.vertex_attrs[name] = [index[v.id] for v in value]
+
+            else:
+                self.attrs[name] = value
+
+    def stamp(self, surface=None):
+        '''
+        Give surface (a new one if None) a copy of the mesh.
+        '''
+        if surface is None:
+            surface = self.cls.__new__(self.cls)
+            Object.__init__(surface)
+            surface.__dict__.update(copy.deepcopy(self.attrs))
+
+        surface._obj, vertices = surface._unpack(self.data)
+
+        vnormals = zip(vertices, self.vnormals)
+        tcoords = zip(vertices, self.tcoords)
+        surface.vnormals = dict((v.id, n) for v, n in vnormals
+                                if n is not None)
+        surface.tcoords = dict((v.id, t) for v, t in tcoords
+                               if t is not None)
+
+        for name, indices in self.vertex_attrs.iteritems():
+            if isinstance(indices, list):
+                value = [_wrap_vertex(vertices[i], surface) for i in indices]
+            else:
+                value = _wrap_vertex(vertices[indices], surface)
+            setattr(surface, name, value)
+
+        return surface
+
+class MeshTemplates(object):
+    '''
+    Meshes of primitives (L{Box}, L{Cylinder}, L{Cone}, L{Disc},
+    L{Rectangle}) by type and dimensions. The first primitive of
+    a kind is made as usual and its mesh is kept; all of them
+    (the first included) get copies of the mesh, so later ones do
+    not work it out again. The least recently used templates are
+    dropped beyond max_entries.
+    '''
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+
+        # key -> template in order of use
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def make(self, primitive, key):
+        '''
+        Give primitive (being initialized) its mesh, either
+        from the template under key or by making it
+        (primitive._make_mesh) and keeping it as one.
+        '''
+        entries = self._entries
+        template = entries.pop(key, None)
+
+        if template is None:
+            self.misses += 1
+            primitive._make_mesh()
+
+            if isinstance(primitive, SurfaceGroup):
+                template = [(name, _SurfaceTemplate(s))
+                            for name, s in primitive.surfaces.iteritems()]
+
+                for name, t in template:
+                    primitive.remove(name)
+            else:
+                template = _SurfaceTemplate(primitive)
+
+        else:
+            self.hits += 1
+
+        # the mesh just made is replaced by a copy as well, so
+        # that primitives come out the same either way
+        if isinstance(primitive, SurfaceGroup):
+            for name, t in template:
+                primitive.add(t.stamp(), name)
+        else:
+            template.stamp(primitive)
+
+        if self.max_entries:
+            entries[key] = template
+
+            if len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+#: templates used by primitives
+templates = MeshTemplates()
+
 class Rectangle(Surface):
     
     def __init__(self, length=1, height=1):
         Surface.__init__(self)
 
-        x, z = length, height
+        self.length = length
+        self.height = height
+
+        templates.make(self, (self.__class__, length, height))
+
+    def _make_mesh(self):
+        x, z = self.length, self.height
 
         a = Vertex(0, 0, 0); a.tcoord = (0.0, 0.0)
         b = Vertex(x, 0, 0); b.tcoord = (1.0, 0.0)
@@ -552,6 +1099,9 @@ class Fan(Surface):
 
         self.add(s)
 
+        for v in vertices[:-1] + [c]:
+            v._set_container(self)
+
     def _compute_normal(self, center, vertices):
         
         normals = []
@@ -579,9 +1129,14 @@ class Disc(Fan):
         if meridians < 3:
             raise Exception('meridians should be >= 3')
 
+        Surface.__init__(self)
+        templates.make(self, (self.__class__, radius, meridians))
+
+    def _make_mesh(self):
         center = Vertex(0, 0, 0)
         center.tcoord = (0.0, 0.0)
-        self.disc_vertices = self.compute_vertices(radius, meridians)
+        self.disc_vertices = self.compute_vertices(self.radius,
+                                                   self.meridians)
 
         Fan.__init__(self, self.disc_vertices, center)
     
@@ -671,7 +1226,7 @@ class Box(SurfaceGroup):
         self.depth = depth
         self.height = height
 
-        self._make_mesh()
+        templates.make(self, (self.__class__, length, depth, height))
 
     def _make_mesh(self):
         x, y, z = self.length, self.depth, self.height
@@ -796,7 +1351,8 @@ class Cylinder(SurfaceGroup):
         self.meridians = meridians
         self.segments = segments
 
-        self._make_mesh()
+        key = self.__class__, radius, height, meridians, segments
+        templates.make(self, key)
 
     def _radius_at_height(self, height):
         return self.radius
@@ -876,3 +1432,181 @@ class Cone(Cylinder):
 
         self.add(bcap, 'bottom')
         self.add(side, 'side')
+
+class Prototype(object):
+    '''
+    Shape shared by many L{Instance}s: a Surface or SurfaceGroup in
+    a frame of its own. Its meshes are extracted once (when first
+    needed) and reused by all instances, so the prototype must not
+    be modified once it has been instanced.
+    '''
+
+    def __init__(self, geom):
+        if not isinstance(geom, (Surface, SurfaceGroup)):
+            raise Exception('bad arguments')
+
+        self.geom = geom
+
+        self._meshes = None
+        self._vertices = None
+
+    @property
+    def surfaces(self):
+        '''
+        @return: list of (name, surface); name is None
+            when the prototype is a single surface
+        '''
+        geom = self.geom
+
+        if isinstance(geom, SurfaceGroup):
+            return sorted(geom.surfaces.iteritems())
+
+        return [(None, geom)]
+
+    def get_meshes(self):
+        '''
+        @return: list of (name, mesh) for L{surfaces}; mesh as
+            returned by L{Surface.get_mesh_arrays} (float64)
+        '''
+        if self._meshes is None:
+            self._meshes = [(name, s.get_mesh_arrays(numpy.float64))
+                            for name, s in self.surfaces]
+        return self._meshes
+
+    def get_vertices(self):
+        '''
+        @return: numpy array of the positions of all
+            vertices (one per row)
+        '''
+        if self._vertices is None:
+            positions = [mesh[0] for name, mesh in self.get_meshes()]
+            self._vertices = numpy.concatenate(positions).reshape(-1, 3)
+        return self._vertices
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+
+        # re-created when needed
+        state['_meshes'] = None
+        state['_vertices'] = None
+
+        return state
+
+class Instance(object):
+    '''
+    A placement of a L{Prototype}. Holds only a matrix (from the
+    frame of the prototype) along with the material, tags and the
+    like, so memory and the time spent making meshes grow with the
+    number of distinct shapes rather than the number of geoms.
+
+    Instances are added to generators like any other geom; meshes,
+    vertices and bound boxes are those of the prototype
+    transformed by the matrix.
+    '''
+
+    def __init__(self, prototype, matrix=None):
+        '''
+        @param prototype: L{Prototype} or a Surface or SurfaceGroup
+            to make one of
+
+        @param matrix: L{utils.Matrix} placing the prototype
+            (identity if None)
+        '''
+        if not isinstance(prototype, Prototype):
+            prototype = Prototype(prototype)
+
+        self.prototype = prototype
+        self.matrix = Matrix(matrix) if matrix is not None else Matrix()
+
+        #: Tags assigned to geom by generator; These are
+        #   useful for spatial querying.
+        self.tags = []
+
+        #: The generator which produced this geom
+        self.generator = None
+
+        #: If False, then this geom will not be rendered.
+        self.visible = True
+
+        #: Material (None for those of the prototype)
+        self.material = None
+
+        # bound box (if known); moved along by transforms
+        # which keep it axis aligned (see Object._add_transform)
+        self._bbox = None
+
+    def _add_transform(self, matrix):
+        self.matrix = matrix.multiply(self.matrix)
+
+        if self._bbox is not None:
+            m = numpy.asarray(matrix.matrix, dtype=float)
+            self._bbox = _transform_bbox(self._bbox, m)
+
+    def translate(self, x, y, z):
+        self._add_transform(Matrix.get_translation_matrix((x, y, z)))
+
+    def rotate(self, dx, dy, dz, angle):
+        rotation = Matrix.get_rotation_matrix((angle, (dx, dy, dz)), True)
+        self._add_transform(rotation)
+
+    def transform(self, matrix):
+        self._add_transform(matrix)
+
+    def get_vertices(self):
+        '''
+        @return: numpy array of vertex positions (one per row)
+        '''
+        return self.matrix.transform_points(self.prototype.get_vertices())
+
+    @property
+    def vertices(self):
+        return [Vertex(p) for p in self.get_vertices().tolist()]
+
+    def get_bound_box(self):
+        if self._bbox is None:
+            points = self.get_vertices()
+            self._bbox = tuple(points.min(axis=0).tolist() +
+                               points.max(axis=0).tolist())
+        return self._bbox
+
+    def get_meshes(self, dtype=numpy.float32):
+        '''
+        @return: list of (name, mesh) of the surfaces of the
+            prototype; mesh as returned by
+            L{Surface.get_mesh_arrays}
+        '''
+        return [(name, transform_mesh(mesh, self.matrix, dtype))
+                for name, mesh in self.prototype.get_meshes()]
+
+    def get_mesh_arrays(self, dtype=numpy.float32):
+        '''
+        Meshes of all surfaces of the prototype in one (see
+        L{Surface.get_mesh_arrays}).
+        '''
+        meshes = [mesh for name, mesh in self.get_meshes(dtype)]
+
+        offsets = numpy.cumsum([0] + [len(m[0]) for m in meshes])
+        indices = [m[1] + numpy.uint32(o) for m, o in zip(meshes, offsets)]
+
+        parts = zip(*meshes)
+        return (numpy.concatenate(parts[0]).reshape(-1, 3),
+                numpy.concatenate(indices).reshape(-1, 3),
+                numpy.concatenate(parts[2]).reshape(-1, 3),
+                numpy.concatenate(parts[3]).reshape(-1, 2))
+
+    @property
+    def mesh(self):
+        return _get_mesh_lists(self.get_mesh_arrays(numpy.float64))
+
+    def get_triangles(self):
+        '''
+        @return: numpy array of triangles (n x 3 x 3)
+        '''
+        positions, indices, normals, tcoords = \
+            self.get_mesh_arrays(numpy.float64)
+        return positions[indices]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['generator'] = None
+        return state
@@ -0,0 +1,96 @@
+'''
+Batched delivery of build space events.
+
+Calling every event handler for every event costs a lot on big
+builds. An L{EventBatcher} collects events and hands them over to
+its handler as a list of (event, args) tuples once enough of them
+have piled up (flush size) or enough time has passed (flush
+interval). The build space also flushes batchers when the build is
+done or waits while paused and at the end of every L{BuildSpace.step}.
+
+Within a batch, an addition followed by a deletion of the same
+geom (or generator) cancel each other out and neither is delivered.
+
+G{importgraph}
+'''
+
+import time
+
+# deletion event -> corresponding addition event
+_ADD_EVENTS = {
+    'del_geom': 'add_geom',
+    'del_gen': 'add_gen',
+}
+
+def _get_subject(event, args):
+    # geom for geom events, generator for generator events
+    return args[1] if event.endswith('_geom') else args[0]
+
+class EventBatcher:
+    '''
+    Event handler (see L{BuildSpace.event_handlers}) which
+    passes events on to handler(events) in batches.
+    '''
+
+    def __init__(self, handler, flush_size=256, flush_interval=0.1):
+        '''
+        @param flush_size: number of events in a batch
+
+        @param flush_interval: maximum time (seconds) for which
+            an event is held back (events are only looked at when
+            a new one arrives, so the last ones wait for a flush
+            by the build space)
+        '''
+        self.handler = handler
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self._events = []
+        self._num_events = 0
+
+        # (addition event, id(subject)) -> index in _events
+        self._additions = {}
+
+        self._last_flush = time.time()
+
+    def __call__(self, event, args):
+        add_event = _ADD_EVENTS.get(event)
+
+        if add_event:
+            key = add_event, id(_get_subject(event, args))
+            index = self._additions.pop(key, None)
+
+            if index is not None:
+                self._events[index] = None
+                self._num_events -= 1
+                return
+
+        elif event in ('add_geom', 'add_gen'):
+            key = event, id(_get_subject(event, args))
+            self._additions[key] = len(self._events)
+
+        self._events.append((event, args))
+        self._num_events += 1
+
+        if self._num_events >= self.flush_size or \
+            time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+
+        if not self._events:
+            return
+
+        events = self._events
+        num_events = self._num_events
+
+        self._events = []
+        self._num_events = 0
+        self._additions = {}
+
+        if num_events != len(events):
+            events = [e for e in events if e is not None]
+
+        if events:
+            self.handler(events)
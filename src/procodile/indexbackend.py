@@ -0,0 +1,420 @@
+'''
+Storage of bound boxes by id for L{buildspace.SpatialIndex}.
+
+A backend keeps (id, bbox) entries, bbox being a tuple of
+(xmin, ymin, zmin, xmax, ymax, zmax), and finds the ids of the
+entries intersecting, within, surrounding or enclosing a bbox or
+nearest to a point. Backends available are:
+
+ - L{RtreeBackend} ('rtree'): an R-tree (default)
+ - L{GridBackend} ('grid'): a uniform grid of hashed cells with
+   vectorized tests on the entries found in the cells; suits content
+   of similar sizes laid out over a regular grid (eg: cities)
+ - L{NumpyBackend} ('numpy'): a vectorized test of all entries;
+   suits small scenes
+
+A backend is created with the entries to start with (possibly
+many, which it can load in bulk).
+
+G{importgraph}
+'''
+
+import math
+
+import numpy
+from rtree import index as rtree
+
+#: kinds of bbox queries (see L{IndexBackend.query})
+QUERIES = ('intersection', 'within', 'surrounding', 'enclosing')
+
+def match_boxes(boxes, bbox, query):
+    '''
+    Test many bound boxes against bbox at once.
+
+    @param boxes: numpy array of bound boxes (one per row)
+
+    @param query: one of L{QUERIES}
+
+    @return: boolean numpy array; True for boxes which intersect
+        bbox ('intersection'), are inside it ('within'), intersect
+        it without being inside it ('surrounding') or contain it
+        ('enclosing')
+    '''
+    lo = numpy.asarray(bbox[:3], dtype=float)
+    hi = numpy.asarray(bbox[3:], dtype=float)
+    blo, bhi = boxes[:, :3], boxes[:, 3:]
+
+    if query == 'enclosing':
+        return (blo <= lo).all(axis=1) & (bhi >= hi).all(axis=1)
+
+    mask = (blo <= hi).all(axis=1) & (bhi >= lo).all(axis=1)
+
+    if query == 'intersection':
+        return mask
+
+    inside = (blo >= lo).all(axis=1) & (bhi <= hi).all(axis=1)
+
+    if query == 'within':
+        return mask & inside
+
+    if query == 'surrounding':
+        return mask & ~inside
+
+    raise ValueError('unknown query "%s"' % query)
+
+class IndexBackend:
+    '''
+    Interface of spatial index backends.
+    '''
+
+    def __init__(self, entries=None):
+        '''
+        @param entries: list of (id, bbox) to start with
+        '''
+        raise NotImplementedError
+
+    def insert(self, _id, bbox):
+        raise NotImplementedError
+
+    def delete(self, _id, bbox):
+        raise NotImplementedError
+
+    def intersection(self, bbox):
+        '''
+        @rtype: list
+        @return: ids of entries intersecting bbox
+        '''
+        raise NotImplementedError
+
+    def query(self, bbox, query):
+        '''
+        @param query: one of L{QUERIES} (see L{match_boxes})
+
+        @rtype: list
+        @return: ids of entries matching query against bbox
+        '''
+        raise NotImplementedError
+
+    def nearest(self, point, num):
+        '''
+        @return: ids of (at least) the num entries nearest to
+            point (by distance to their bbox), nearest first.
+            Entries at the same distance as the last one may
+            be included as well.
+        '''
+        raise NotImplementedError
+
+    def get_size(self):
+        raise NotImplementedError
+
+class RtreeBackend(IndexBackend):
+    '''
+    R-tree (libspatialindex). Entries given on creation are
+    loaded in bulk using sort-tile-recursive packing.
+    '''
+
+    def __init__(self, entries=None):
+        p = rtree.Property()
+        p.dimension = 3
+
+        # stream loading does not accept an empty stream
+        if not entries:
+            self.index = rtree.Index(None, properties=p)
+        else:
+            stream = ((_id, bbox, None) for _id, bbox in entries)
+            self.index = rtree.Index(stream, properties=p)
+
+    def insert(self, _id, bbox):
+        self.index.insert(_id, bbox)
+
+    def delete(self, _id, bbox):
+        self.index.delete(_id, bbox)
+
+    def intersection(self, bbox):
+        # newer rtree versions return an iterator
+        return list(self.index.intersection(bbox))
+
+    def query(self, bbox, query):
+        if query == 'intersection':
+            return self.intersection(bbox)
+
+        # entries matching any of the queries intersect bbox
+        items = list(self.index.intersection(bbox, objects=True))
+        if not items:
+            return []
+
+        boxes = numpy.array([item.bbox for item in items], dtype=float)
+        mask = match_boxes(boxes.reshape(-1, 6), bbox, query)
+
+        return [item.id for item, match in zip(items, mask) if match]
+
+    def nearest(self, point, num):
+        return list(self.index.nearest(tuple(point) * 2, num))
+
+    def get_size(self):
+        return self.index.get_size()
+
+# bbox of unused rows; never intersects anything
+_EMPTY = (numpy.inf, numpy.inf, numpy.inf,
+          -numpy.inf, -numpy.inf, -numpy.inf)
+
+class NumpyBackend(IndexBackend):
+    '''
+    Entries in arrays (one row per entry) tested all at
+    once on every query.
+    '''
+
+    #: initial number of rows
+    CAPACITY = 64
+
+    def __init__(self, entries=None):
+        entries = entries or []
+        capacity = max(self.CAPACITY, len(entries))
+
+        self.ids = numpy.zeros(capacity, dtype=numpy.int64)
+        self.boxes = numpy.empty((capacity, 6))
+        self.boxes[:] = _EMPTY
+
+        # id -> row
+        self.rows = {}
+
+        # rows of deleted entries (for reuse)
+        self.free = []
+
+        # rows before this have been used
+        self.end = 0
+
+        if entries:
+            n = len(entries)
+            self.ids[:n] = [_id for _id, bbox in entries]
+            self.boxes[:n] = [bbox for _id, bbox in entries]
+            self.rows = dict((_id, row) for row, (_id, bbox) in
+                             enumerate(entries))
+            self.end = n
+
+    def _grow(self):
+        capacity = len(self.ids) * 2
+
+        ids = numpy.zeros(capacity, dtype=numpy.int64)
+        ids[:self.end] = self.ids[:self.end]
+
+        boxes = numpy.empty((capacity, 6))
+        boxes[:] = _EMPTY
+        boxes[:self.end] = self.boxes[:self.end]
+
+        self.ids, self.boxes = ids, boxes
+
+    def insert(self, _id, bbox):
+        if self.free:
+            row = self.free.pop()
+        else:
+            if self.end == len(self.ids):
+                self._grow()
+            row = self.end
+            self.end += 1
+
+        self.ids[row] = _id
+        self.boxes[row] = bbox
+        self.rows[_id] = row
+
+        return row
+
+    def delete(self, _id, bbox):
+        row = self.rows.pop(_id, None)
+        if row is None:
+            return None
+
+        self.boxes[row] = _EMPTY
+        self.free.append(row)
+
+        return row
+
+    def _test(self, rows, bbox, query='intersection'):
+        '''
+        @return: rows (of those given; all if None)
+            matching query against bbox (see L{match_boxes})
+        '''
+        boxes = self.boxes[:self.end] if rows is None else self.boxes[rows]
+        mask = match_boxes(boxes, bbox, query)
+
+        if rows is None:
+            return numpy.flatnonzero(mask)
+
+        return rows[mask]
+
+    def intersection(self, bbox):
+        return self.query(bbox, 'intersection')
+
+    def query(self, bbox, query):
+        return self.ids[self._test(None, bbox, query)].tolist()
+
+    def nearest(self, point, num):
+        boxes = self.boxes[:self.end]
+        point = numpy.asarray(point, dtype=float)
+
+        # distance along each axis (0 inside the box);
+        # infinite for unused rows
+        d = numpy.maximum(boxes[:, :3] - point, point - boxes[:, 3:])
+        d = numpy.maximum(d, 0)
+        distances = (d * d).sum(axis=1)
+
+        num = min(num, len(self.rows))
+        if num <= 0:
+            return []
+
+        rows = numpy.argpartition(distances, num - 1)[:num]
+        rows = rows[numpy.argsort(distances[rows])]
+
+        return self.ids[rows].tolist()
+
+    def get_size(self):
+        return len(self.rows)
+
+class GridBackend(NumpyBackend):
+    '''
+    Uniform grid of cubic cells (hashed, so only occupied cells
+    take memory). An entry is listed in every cell it overlaps,
+    except for entries overlapping too many cells which are kept
+    aside and tested on every query. A query gathers the entries
+    of the cells it overlaps and tests them using L{NumpyBackend}.
+    '''
+
+    #: entries overlapping more cells than this
+    #   are not listed in cells
+    MAX_CELLS = 64
+
+    def __init__(self, entries=None, cell_size=10.0):
+        '''
+        @param cell_size: edge length of cells; about the size
+            of the typical entry works best
+        '''
+        self.cell_size = float(cell_size)
+
+        # (i, j, k) -> set of rows
+        self.cells = {}
+
+        # rows not listed in cells
+        self.large = set()
+
+        NumpyBackend.__init__(self, entries)
+
+        for _id, row in self.rows.iteritems():
+            self._add_cells(row, entries[row][1])
+
+    def _get_cell_range(self, bbox, max_cells):
+        '''
+        @return: ranges of cell indices (along x, y and z)
+            covered by bbox or None if there are more
+            than max_cells
+        '''
+        s = self.cell_size
+
+        try:
+            lo = [int(math.floor(v / s)) for v in bbox[:3]]
+            hi = [int(math.floor(v / s)) for v in bbox[3:]]
+        except (OverflowError, ValueError):
+            # infinite or nan
+            return None
+
+        num_cells = 1
+        for l, h in zip(lo, hi):
+            num_cells *= max(h - l + 1, 0)
+
+        if num_cells > max_cells:
+            return None
+
+        return [xrange(l, h + 1) for l, h in zip(lo, hi)]
+
+    def _iter_cells(self, bbox, max_cells=None):
+        if max_cells is None:
+            max_cells = self.MAX_CELLS
+
+        cell_range = self._get_cell_range(bbox, max_cells)
+        if cell_range is None:
+            return None
+
+        xr, yr, zr = cell_range
+        return [(i, j, k) for i in xr for j in yr for k in zr]
+
+    def _add_cells(self, row, bbox):
+        cells = self._iter_cells(bbox)
+
+        if cells is None:
+            self.large.add(row)
+            return
+
+        for cell in cells:
+            rows = self.cells.get(cell)
+            if rows is None:
+                rows = self.cells[cell] = set()
+            rows.add(row)
+
+    def insert(self, _id, bbox):
+        row = NumpyBackend.insert(self, _id, bbox)
+        self._add_cells(row, bbox)
+
+    def delete(self, _id, bbox):
+        row = NumpyBackend.delete(self, _id, bbox)
+        if row is None:
+            return
+
+        if row in self.large:
+            self.large.remove(row)
+            return
+
+        for cell in self._iter_cells(bbox):
+            rows = self.cells.get(cell)
+            if rows is None:
+                continue
+
+            rows.discard(row)
+            if not rows:
+                del self.cells[cell]
+
+    def query(self, bbox, query):
+        # entries matching any of the queries intersect bbox and
+        # so are listed in the cells it overlaps (or are large).
+        # A query covering more cells than are occupied is better
+        # off testing all entries.
+        cells = self._iter_cells(bbox, len(self.cells))
+        if cells is None:
+            return NumpyBackend.query(self, bbox, query)
+
+        rows = set(self.large)
+        get = self.cells.get
+        for cell in cells:
+            _rows = get(cell)
+            if _rows:
+                rows.update(_rows)
+
+        if not rows:
+            return []
+
+        rows = numpy.fromiter(rows, dtype=numpy.intp, count=len(rows))
+        return self.ids[self._test(rows, bbox, query)].tolist()
+
+#: backend name -> class
+BACKENDS = {
+    'rtree': RtreeBackend,
+    'grid': GridBackend,
+    'numpy': NumpyBackend,
+}
+
+def get_backend(backend):
+    '''
+    @param backend: name of a backend (see L{BACKENDS}) or a callable
+        creating a backend (given a list of entries), eg: a backend
+        class or a functools.partial of one with its options
+
+    @return: callable creating backends
+    '''
+    if backend is None:
+        return RtreeBackend
+
+    if isinstance(backend, basestring):
+        try:
+            return BACKENDS[backend]
+        except KeyError:
+            raise ValueError('unknown spatial index backend "%s"' % backend)
+
+    return backend
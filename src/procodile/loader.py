@@ -241,6 +241,32 @@ class Loader:
 
         return pkg
 
+    def locate_class(self, _class):
+        '''
+        Find the loaded package whose module defines _class.
+        Modules of packages are not present in sys.modules, so
+        this is how such classes can be referred to by name.
+
+        @rtype: tuple
+        @return: (package path, module name) or None if _class
+            does not come from a loaded package
+        '''
+        module_name = _class.__module__
+
+        for path, pkg in self.packages.iteritems():
+            module = pkg._modules.get(module_name)
+            if getattr(module, _class.__name__, None) is _class:
+                return path, module_name
+
+        return None
+
+    def lookup_class(self, package_path, module_name, class_name):
+        '''
+        Inverse of L{locate_class}.
+        '''
+        pkg = self.packages[self._clean_path(package_path)]
+        return getattr(pkg._modules[module_name], class_name)
+
 __loader__ = Loader()
 LOADER = __loader__
 
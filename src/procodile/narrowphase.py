@@ -0,0 +1,197 @@
+'''
+Exact tests of geoms against query boxes (narrow phase).
+
+The spatial index finds geoms by their axis aligned bound boxes,
+which for rotated or irregular geoms includes many that do not
+come anywhere near the query box. The functions here test the
+triangles of candidate geoms against the box, for all candidates
+at once using numpy.
+
+Geoms are reduced to triangles: surfaces to their faces, edges and
+vertices to degenerate triangles. Tests that need to know whether
+a point is inside a geom (a box deep inside a solid touches none of
+its triangles) assume that surfaces are closed.
+
+G{importgraph}
+'''
+
+import numpy
+
+from procodile.draw import SurfaceGroup, Surface, Face, Edge, Vertex, \
+                           Instance
+
+#: direction of rays cast to count crossings of surfaces; chosen
+#   to avoid running along edges of axis aligned geometry
+RAY_DIRECTION = numpy.array([0.8017, 0.5347, 0.2673])
+
+def get_triangles(geom):
+    '''
+    @rtype: numpy array
+    @return: triangles (n x 3 x 3) making up geom
+    '''
+    if isinstance(geom, SurfaceGroup):
+        triangles = [get_triangles(s) for s in geom.surfaces.itervalues()]
+        triangles = [t for t in triangles if len(t)]
+        if not triangles:
+            return numpy.zeros((0, 3, 3))
+        return numpy.concatenate(triangles)
+
+    if isinstance(geom, Instance):
+        return geom.get_triangles()
+
+    obj = geom._obj
+
+    if isinstance(geom, Surface):
+        vertices = tuple(obj.vertices())
+        if not vertices:
+            return numpy.zeros((0, 3, 3))
+
+        coords = numpy.array([(v.x, v.y, v.z) for v in vertices])
+        indices = numpy.array(obj.face_indices(vertices), dtype=int)
+        return coords[indices].reshape(-1, 3, 3)
+
+    if isinstance(geom, Face):
+        vertices = obj.vertices()
+
+    elif isinstance(geom, Edge):
+        vertices = (obj.v1, obj.v2, obj.v2)
+
+    elif isinstance(geom, Vertex):
+        vertices = (obj, obj, obj)
+
+    else:
+        vertices = geom._get_gts_vertices()
+
+    return numpy.array([[(v.x, v.y, v.z) for v in vertices[:3]]])
+
+def _get_box(bbox):
+    bbox = numpy.asarray(bbox, dtype=float)
+    center = (bbox[:3] + bbox[3:]) / 2
+    half = (bbox[3:] - bbox[:3]) / 2
+    return center, half
+
+def intersect_box(triangles, bbox):
+    '''
+    Separating axis test of triangles against a box.
+
+    @param bbox: (xmin, ymin, zmin, xmax, ymax, zmax)
+    @return: bool array; True for triangles touching the box
+    '''
+    center, half = _get_box(bbox)
+
+    v = triangles - center
+    edges = [v[:, 1] - v[:, 0], v[:, 2] - v[:, 1], v[:, 0] - v[:, 2]]
+
+    # box face normals
+    separated = (v.min(axis=1) > half).any(axis=1) | \
+                (v.max(axis=1) < -half).any(axis=1)
+
+    # triangle normal
+    normal = numpy.cross(edges[0], edges[1])
+    d = (normal * v[:, 0]).sum(axis=1)
+    r = (numpy.abs(normal) * half).sum(axis=1)
+    separated |= numpy.abs(d) > r
+
+    # cross products of box axes and triangle edges
+    for axis in numpy.eye(3):
+        for edge in edges:
+            a = numpy.cross(axis, edge)
+            p = (v * a[:, numpy.newaxis, :]).sum(axis=2)
+            r = (numpy.abs(a) * half).sum(axis=1)
+            separated |= (p.min(axis=1) > r) | (p.max(axis=1) < -r)
+
+    return ~separated
+
+def contains_point(triangles, point):
+    '''
+    Is point inside the closed surface made up of triangles?
+    Counts crossings of a ray from point (Moller-Trumbore).
+    '''
+    if not len(triangles):
+        return False
+
+    d = RAY_DIRECTION
+    v0 = triangles[:, 0]
+    e1 = triangles[:, 1] - v0
+    e2 = triangles[:, 2] - v0
+
+    pvec = numpy.cross(d, e2)
+    det = (e1 * pvec).sum(axis=1)
+    valid = numpy.abs(det) > 1e-12
+    inv_det = 1.0 / numpy.where(valid, det, 1)
+
+    tvec = numpy.asarray(point, dtype=float) - v0
+    u = (tvec * pvec).sum(axis=1) * inv_det
+
+    qvec = numpy.cross(tvec, e1)
+    w = numpy.dot(qvec, d) * inv_det
+    t = (e2 * qvec).sum(axis=1) * inv_det
+
+    hits = valid & (u >= 0) & (w >= 0) & (u + w <= 1) & (t > 0)
+    return bool(hits.sum() % 2)
+
+def _contains_box(bbox, triangles):
+    vertices = triangles.reshape(-1, 3)
+    return bool((vertices >= bbox[:3]).all() and (vertices <= bbox[3:]).all())
+
+def filter_geoms(geoms, bbox, query, matrix=None):
+    '''
+    Keep the geoms which match query exactly.
+
+    @param bbox: query box (BoundBox or tuple)
+
+    @param query: 'intersection' (geoms touching or containing
+        the box), 'within' (geoms inside the box), 'surrounding'
+        (geoms touching the box but not inside it) or 'enclosing'
+        (geoms containing the box)
+
+    @param matrix: transform of geoms into the frame that the box
+        is given in (L{utils.Matrix}; None if already there)
+    '''
+    if not geoms:
+        return []
+
+    if hasattr(bbox, 'as_tuple'):
+        bbox = bbox.as_tuple()
+    bbox = numpy.asarray(bbox, dtype=float)
+    center = (bbox[:3] + bbox[3:]) / 2
+
+    triangles = [get_triangles(g) for g in geoms]
+    counts = [len(t) for t in triangles]
+    triangles = numpy.concatenate(triangles)
+
+    if matrix is not None:
+        triangles = matrix.transform_points(triangles).reshape(-1, 3, 3)
+
+    # all triangles are tested at once; owners[i] is the
+    # index of the geom that triangle i belongs to
+    owners = numpy.repeat(numpy.arange(len(geoms)), counts)
+    touching = intersect_box(triangles, bbox)
+    touches = numpy.bincount(owners[touching], minlength=len(geoms)) > 0
+
+    offsets = numpy.cumsum([0] + counts)
+    get_tris = lambda i: triangles[offsets[i]:offsets[i + 1]]
+
+    selected = []
+
+    for i, geom in enumerate(geoms):
+        if query == 'intersection':
+            match = touches[i] or contains_point(get_tris(i), center)
+
+        elif query == 'within':
+            match = _contains_box(bbox, get_tris(i))
+
+        elif query == 'surrounding':
+            match = (touches[i] or contains_point(get_tris(i), center)) \
+                    and not _contains_box(bbox, get_tris(i))
+
+        elif query == 'enclosing':
+            match = not touches[i] and contains_point(get_tris(i), center)
+
+        else:
+            raise ValueError('unknown query "%s"' % query)
+
+        if match:
+            selected.append(geom)
+
+    return selected
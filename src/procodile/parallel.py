@@ -0,0 +1,102 @@
+'''
+Generation of independent generator subtrees in a pool
+of worker processes (see L{BuildSpace.PARALLEL}).
+
+Workers are forked from the building process, so each of them
+starts with a copy of the build space as it was when the subtrees
+were handed out. A worker builds one subtree serially and sends
+back its generator records and geoms, which are then replayed into
+the build space in queue order. The resulting build tree is the
+same as that of a serial (BFS) build with the same seed.
+
+G{importgraph}
+'''
+
+import os
+import multiprocessing
+
+from procodile.procedural import make_record, replay
+from procodile.scheduler import FIFOScheduler
+import procodile.snapshot as snapshot
+
+# build space and queued jobs being farmed out; inherited
+# by worker processes when they are forked.
+_BSPACE = None
+_JOBS = None
+
+def can_build_subtrees():
+    '''
+    Workers need to inherit the state of the build and
+    the queued jobs (closures), which requires fork().
+    '''
+    return hasattr(os, 'fork')
+
+def _build_subtree(index):
+    bspace = _BSPACE
+    entry = _JOBS[index]
+
+    # the subtree is built in isolation; nothing produced
+    # here must reach the event handlers of the host process
+    bspace.event_handlers = []
+    bspace.strategy = bspace.BFS
+    bspace.queue = FIFOScheduler()
+
+    readers = set(bspace.deps.readers)
+
+    gen_obj = entry.run_fn()
+
+    while bspace.queue:
+        bspace.process_queue()
+
+    # the subtree has queried the build space
+    if set(bspace.deps.readers) - readers:
+        return None
+
+    record = make_record(gen_obj) if gen_obj else None
+    return snapshot.dumps(record)
+
+def build_subtrees(bspace, jobs, processes):
+    '''
+    Build the subtrees of queued jobs (L{scheduler.QueueEntry})
+    using a pool of processes and add them to bspace.
+
+    @rtype: bool
+    @return: False if a subtree made spatial queries; nothing is
+        added to bspace then and the jobs have to be run serially
+    '''
+    global _BSPACE, _JOBS
+    _BSPACE, _JOBS = bspace, jobs
+
+    # every job gets a fresh worker so that subtrees
+    # built earlier in a worker cannot affect later ones
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+
+    try:
+        results = pool.map(_build_subtree, range(len(jobs)))
+        pool.close()
+
+    except:
+        pool.terminate()
+        raise
+
+    finally:
+        pool.join()
+        _BSPACE = _JOBS = None
+
+    if None in results:
+        return False
+
+    # subtrees are written to the spatial index together
+    # (packed in bulk if they are large enough)
+    bspace.index.begin_batch()
+
+    try:
+        for entry, data in zip(jobs, results):
+            record = snapshot.loads(data)
+            if record:
+                replay(record, bspace, entry.parent, entry.parent.log)
+
+    finally:
+        bspace.index.end_batch()
+
+    return True
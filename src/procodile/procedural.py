@@ -5,10 +5,14 @@ G{importgraph}
 '''
 
 import os
+import time
 import logging
+from collections import OrderedDict
+
+import numpy
 
 from procodile.utils import ProcodileException, DotAccessDict, Matrix
-from procodile.draw import SurfaceGroup
+from procodile.draw import SurfaceGroup, Instance
 import procodile.buildspace as bs
 import procodile.pick as pick
 
@@ -46,6 +50,13 @@ class GeneratorInfo:
         self.location = None # local location
         self.glocation  = None # global location
 
+        # when set, the generator is re-created from
+        # this record instead of running generate()
+        self.record = None
+
+        # key of generator's output in build space cache
+        self.cache_key = None
+
 class Generator:
     '''
     Abstract class representation
@@ -85,6 +96,12 @@ class Generator:
 
     RECIPE_CONFIG = None
 
+    #: If False, output of this generator will never be cached
+    #   (see L{procodile.cache}). Generators whose output depends
+    #   on anything other than their class, config, seed and
+    #   location (eg: time, shared state) must set this to False.
+    CACHEABLE = True
+
     #: Will be assigned value of type GeneratorIdentification by Loader.
     #   This is for internal use only.
     IDENT = None
@@ -107,34 +124,74 @@ class Generator:
         self.picker = picker
         self.bspace = bspace
 
-        self.geoms = {}
+        self.geoms = OrderedDict()
         self.matrix = None
 
         x, y, z = self.location.get_translation()
         self.bbox = bs.BoundBox(x, y, z, x, y, z)
 
+        #: bbox of the generator and all generators below it
+        #   (union of bbox and subtree_bbox of children)
+        self.subtree_bbox = self.bbox.copy()
+
         self.ancestors = []
         self._compute_ancestors()
         self.children = []
         self._num_subgens = 0
 
-        self.gen_trans = {}
-        self.geom_trans = {}
+        # sub generators asked for by generate(); recorded
+        # only if output of this generator is to be cached
+        self._subgen_calls = []
+        self._cacheable = self.CACHEABLE
+
+        #: L{profiler.GeneratorStats} when build space is profiled
+        self.stats = None
+
         self.inv_location = self.location.inverse()
 
         parent = info.parent
         if parent:
             parent.children.append(self)
+            parent._grow_subtree_bbox(self.subtree_bbox)
 
         if not parent:
             self.bspace.root_gen = self
 
         bspace.notify_event('add_gen', self, self.parent)
 
-        self.generate(self.config)
+        profiler = bspace.profiler
+        if profiler:
+            profiler.on_generator_start(self)
+
+        # index is written to once the generator is done
+        bspace.index.begin_batch()
+
+        try:
+            if info.record:
+                self._replay(info.record)
+            else:
+                self.generate(self.config)
+
+            bspace.index.update(self)
 
-        bspace.index.update(self)
-        self.reset_trans()
+        finally:
+            if profiler:
+                index_start_time = time.time()
+
+            bspace.index.end_batch()
+
+            if profiler:
+                profiler.on_index_written(self,
+                                          time.time() - index_start_time)
+
+            # also when the build is stopped (or generate()
+            # fails) so that the stats of later generators
+            # are not put under this one
+            if profiler:
+                profiler.on_generator_end(self)
+
+        if info.cache_key and not info.record and self._cacheable:
+            bspace.cache.put(info.cache_key, make_record(self, False))
 
     @classmethod
     def get_recipe_config(self):
@@ -159,19 +216,29 @@ class Generator:
                 self.RECIPE_CONFIG = [rc, _rc]
 
     def _serialize_mesh(self, geom, **options):
-        vertices, indices, normals, tcoords = geom.mesh
+        mesh = geom.get_mesh_arrays(numpy.float64)
+        positions, indices, normals, tcoords = mesh
+
+        # written as L{draw.Surface.mesh} would be
+        rows = lambda a: map(tuple, a.tolist())
 
-        mesh = '%s;\n%s;\n%s;' % (repr(vertices),
-                              repr(normals),
-                              repr(indices))
+        mesh = '%s;\n%s;\n%s;' % (repr(rows(positions)),
+                                repr(rows(normals)),
+                                repr(tuple(rows(indices))))
         return mesh
 
     def _serialize_geoms(self, gen, **options):
         gen_geoms = gen.geoms
-        for g in self.geoms.itervalues():
+        geoms = self.geoms.values()
+        if not geoms:
+            return
+
+        node_map = self.bspace.index.node_map
+        bboxes = node_map.get_bboxes([id(g) for g in geoms]).tolist()
 
-            gbbox, gnode = self.bspace.index.node_map[id(g)]
-            gbbox = ', '.join('%.2f' % i for i in gbbox.as_tuple())
+        for g, gbbox in zip(geoms, bboxes):
+
+            gbbox = ', '.join('%.2f' % i for i in gbbox)
             loc = g.matrix.get_formatted()
             geom = gen_geoms.geom
 
@@ -185,7 +252,7 @@ class Generator:
     def serialize(self, doc, **options):
         gen = doc.generator
 
-        bbox, node = self.bspace.index.node_map[id(self)]
+        bbox = self.bspace.index.node_map.get_bbox(id(self))
         bbox = ', '.join('%.2f' % i for i in bbox.as_tuple())
 
         gen.attrs = (('id', self.id),
@@ -216,6 +283,10 @@ class Generator:
 
         bspace = self.bspace
 
+        profiler = bspace.profiler
+        if profiler:
+            start_time = time.time()
+
         # compute global position of geom
         if not _global:
             # TODO: delete line: geom.matrix = self.location.multiply(geom.matrix)
@@ -235,21 +306,37 @@ class Generator:
         bbox = geom.get_bound_box()
         bbox = bs.BoundBox(*bbox)
         self.bbox.merge(bbox)
+        self._grow_subtree_bbox(bbox)
+
+        if profiler:
+            index_start_time = time.time()
+
         index.update(self)
 
         # (re)add geom into spatial index
         index.update(self, geom)
+
+        if profiler:
+            index_time = time.time() - index_start_time
+
+        bspace.deps.on_change(self, bbox)
      
         self._register_material(geom)
            
         bspace.notify_event('add_geom', self, geom)
 
+        if profiler:
+            time_taken = time.time() - start_time
+            profiler.on_add_geom(self, geom, time_taken, index_time)
+
     def _register_material(self, geom):
         bspace = self.bspace
         pdir = self.IDENT.package_dir
 
         if isinstance(geom, SurfaceGroup):
             geoms = geom.surfaces.values()
+        elif isinstance(geom, Instance) and not geom.material:
+            geoms = [s for name, s in geom.prototype.surfaces]
         else:
             geoms = [geom]
         
@@ -278,6 +365,7 @@ class Generator:
         index = self.bspace.index
 
         for geom in geoms:
+            geom = bs.unwrap(geom)
             _id = id(geom)
 
             if _id in self.geoms:
@@ -286,120 +374,170 @@ class Generator:
             index.remove(self, geom)
             geom.generator = None
 
+            bbox = bs.BoundBox(*geom.get_bound_box())
+            self.bspace.deps.on_change(self, bbox)
+
             self.bspace.notify_event('del_geom', self, geom)
 
-        # recompute bbox
-        self.bbox = bs.BoundBox()
+        # recompute bbox (starting at the location as in __init__)
+        x, y, z = self.location.get_translation()
+        self.bbox = bs.BoundBox(x, y, z, x, y, z)
         for geom in self.geoms.itervalues():
             bbox = geom.get_bound_box()
             bbox = bs.BoundBox(*bbox)
             self.bbox.merge(bbox)
 
+        self._update_subtree_bbox()
         index.update(self)
 
+    def _grow_subtree_bbox(self, bbox):
+        gen = self
+        while gen and not gen.subtree_bbox.contains(bbox):
+            gen.subtree_bbox.merge(bbox)
+            gen = gen.parent
+
+    def _update_subtree_bbox(self):
+        '''
+        Recompute subtree_bbox (when it may have shrunk)
+        and that of ancestors.
+        '''
+        gen = self
+        while gen:
+            bbox = gen.bbox.copy()
+            for child in gen.children:
+                bbox.merge(child.subtree_bbox)
+
+            if bbox.as_tuple() == gen.subtree_bbox.as_tuple():
+                break
+
+            gen.subtree_bbox = bbox
+            gen = gen.parent
+
     def replace_geom(self, old_geom, new_geom):
-        _id = id(old_geom)
-
-        if _id in self.geom_trans:
-            #  TODO: delete lines
-            # old_geom, gmatrix = self.geom_trans.pop(_id)
-            # old_geom.matrix = gmatrix
-            # new_geom.matrix = self.location.multiply(new_geom.matrix)
-            
-            old_geom = self.geom_trans.pop(_id)
-            old_geom.transform(self.location)
-            new_geom.transform(self.location)
+        '''
+        Replace old_geom (of any generator; eg: as found by
+        a spatial query) with new_geom (in the local frame
+        of this generator).
+        '''
+        old_geom = bs.unwrap(old_geom)
+        gen_obj = old_geom.generator
 
-        else:
+        if gen_obj is None or id(old_geom) not in gen_obj.geoms:
             raise ProceduralException('unknown geom: %s' % old_geom)
 
-        gen_obj = old_geom.generator
-        _gid = id(gen_obj)
+        if gen_obj is not self:
+            self._cacheable = False
 
-        if _gid in self.gen_trans:
-            gen_obj, glocation, gbbox = self.gen_trans.pop(_gid)
-            gen_obj.location = glocation
-            gen_obj.bbox = gbbox
+        new_geom.transform(self.location)
 
         gen_obj.del_geoms(old_geom)
         gen_obj.add_geom(new_geom, _global=True)
 
-        self.transform_generator(gen_obj)
-        self.transform_geom(new_geom)
-
     def _get_global_bbox(self, bbox):
         return bs.BoundBox(bbox).transform(self.location)
 
-    def _do_spatial_query(self, bbox, query):
-        bbox = self._get_global_bbox(bbox) if bbox else self.bbox
-        query_fn = getattr(self.bspace.index, query)
-        sr = query_fn(bbox)
-        self.transform_results(sr)
-        return sr
+    def _do_spatial_query(self, bbox, query, exact):
+        # output now depends on other generators
+        self._cacheable = False
 
-    def get_intersection(self, bbox=None):
-        return self._do_spatial_query(bbox, 'intersection')
+        gbbox = self._get_global_bbox(bbox) if bbox else self.bbox
+        index = self.bspace.index
 
-    def get_within(self, bbox=None):
-        return self._do_spatial_query(bbox, 'within')
+        # the global bbox of a local bbox in a rotated frame is
+        # larger than it, so the exact test is done locally. A
+        # geom inside the global bbox may still stick out of the
+        # local one, so which geoms surround it is left to the
+        # exact test.
+        if exact and bbox and query == 'surrounding':
+            sr = index.intersection(gbbox)
+            sr.generators = index.surrounding(gbbox).generators
+        else:
+            sr = getattr(index, query)(gbbox)
 
-    def get_surrounding(self, bbox=None):
-        return self._do_spatial_query(bbox, 'surrounding')
+        if exact and bbox:
+            sr = sr.refine(bs.BoundBox(bbox), query, self.inv_location)
+        elif exact:
+            sr = sr.refine(gbbox, query)
 
-    def get_enclosing(self, bbox=None):
-        return self._do_spatial_query(bbox, 'enclosing')
+        self.bspace.deps.add_read(self, gbbox, sr)
 
-    def reset_trans(self):
-        for generator, glocation , gbbox in self.gen_trans.itervalues():
-            generator.location = glocation
-            generator.bbox = gbbox
+        # generators and geoms are seen in the local frame
+        # of this generator without being modified
+        return sr.localize(self.inv_location)
 
-        self.gen_trans = {}
+    def get_intersection(self, bbox=None, exact=False):
+        '''
+        Generators and geoms whose bound boxes intersect bbox
+        (local; bbox of this generator if None). The other
+        queries are similar.
 
-        for geom, gmatrix in self.geom_trans.itervalues():
-            geom.transform(self.location)
+        @param exact: also test the triangles of geoms against
+            bbox, leaving out geoms which only come close to it
+            (see L{buildspace.SpatialResults.refine})
 
-        self.geom_trans = {}
+        @rtype: L{buildspace.SpatialResults}
+        '''
+        return self._do_spatial_query(bbox, 'intersection', exact)
 
-    def transform_generator(self, generator):
-        _id = id(generator)
+    def get_within(self, bbox=None, exact=False):
+        return self._do_spatial_query(bbox, 'within', exact)
 
-        if _id in self.gen_trans or generator == self:
-            return
+    def get_surrounding(self, bbox=None, exact=False):
+        return self._do_spatial_query(bbox, 'surrounding', exact)
 
-        glocation = generator.location
-        gbbox = generator.bbox
+    def get_enclosing(self, bbox=None, exact=False):
+        return self._do_spatial_query(bbox, 'enclosing', exact)
 
-        lbbox = gbbox.transform(self.inv_location)
-        llocation = self.inv_location.multiply(generator.location)
+    def _get_global_direction(self, direction):
+        # rotation part of the location only
+        origin = self.location.transform((0, 0, 0))
+        point = self.location.transform(direction)
+        return [p - o for p, o in zip(point, origin)]
 
-        self.gen_trans[_id] = generator, glocation, gbbox
-        generator.location = llocation
-        generator.bbox = lbbox
+    def _make_views(self, found, region):
+        self._cacheable = False
 
-    def transform_geom(self, geom):
+        geoms = [geom for distance, geom in found]
+        self.bspace.deps.add_read(self, region, bs.SpatialResults((), geoms))
 
-        _id = id(geom)
+        inv_location = self.inv_location
+        return [(distance, bs.GeomView(geom, inv_location))
+                for distance, geom in found]
 
-        if _id in self.geom_trans:
-            return
+    def get_nearest(self, point, k=1, **filters):
+        '''
+        Find the k geoms nearest to point (by distance to
+        their bound boxes).
 
-        # TODO: delete lines: gmatrix = geom.matrix
-        # lmatrix = self.inv_location.multiply(gmatrix)
+        @param point: (x, y, z) in the local frame
 
-        # self.geom_trans[_id] = geom, gmatrix
-        # geom.matrix = lmatrix
-        
-        self.geom_trans[_id] = geom
-        geom.transform(self.inv_location)
+        @param filters: as for L{buildspace.SpatialResults.get_geoms}
 
-    def transform_results(self, results):
+        @rtype: list
+        @return: (distance, L{buildspace.GeomView}) nearest first
+        '''
+        point = self.location.transform(point)
+        found, region = self.bspace.index.nearest(point, k, **filters)
+        return self._make_views(found, region)
 
-        for generator in results.get_generators():
-            self.transform_generator(generator)
+    def raycast(self, origin, direction, max_dist, **filters):
+        '''
+        Find the geoms whose bound boxes are hit by the ray
+        from origin along direction (both in the local frame)
+        within max_dist.
+
+        @param filters: as for L{buildspace.SpatialResults.get_geoms}
 
-        for geom in results.get_geoms():
-            self.transform_geom(geom)
+        @rtype: list
+        @return: (distance from origin, L{buildspace.GeomView})
+            nearest first
+        '''
+        direction = self._get_global_direction(direction)
+        origin = self.location.transform(origin)
+
+        index = self.bspace.index
+        found, region = index.raycast(origin, direction, max_dist, **filters)
+        return self._make_views(found, region)
 
     def _subgen(self, generator, config, seed, name,
                 location, index):
@@ -413,8 +551,8 @@ class Generator:
                          log=self.log)
         return gen_obj
 
-    def subgen(self, sub_gen_name, location, *config_args,
-                    **config_kwargs):
+    def _make_subgen_args(self, sub_gen_name, location,
+                          config_args, config_kwargs):
 
         generator = self.get_sub_generator(sub_gen_name)
         index = self._num_subgens
@@ -426,8 +564,45 @@ class Generator:
 
         location = Matrix(location)
 
-        gen_obj = self._subgen(generator, config, seed,
-                        sub_gen_name, location, index)
+        return generator, config, seed, sub_gen_name, location, index
+
+    def subgen(self, sub_gen_name, location, *config_args,
+                    **config_kwargs):
+
+        args = self._make_subgen_args(sub_gen_name, location,
+                                      config_args, config_kwargs)
+
+        if self.info.cache_key:
+            self._subgen_calls.append((args, None))
+
+        gen_obj = self._subgen(*args)
+
+        self._num_subgens += 1
+
+    def defer_subgen(self, sub_gen_name, location, bbox,
+                     *config_args, **config_kwargs):
+        '''
+        Same as L{subgen} except that the sub generator is run only
+        when its region is needed: when a spatial query, a region
+        query of the build space or L{BuildSpace.expand} touches
+        bbox. The sub generator gets the same seed as it would have
+        from subgen, so the result does not depend on when (or
+        whether) it is expanded.
+
+        @param bbox: BoundBox or tuple in the generator's co-ordinates
+            which encloses everything that the sub generator (and its
+            sub generators) will add
+        '''
+
+        args = self._make_subgen_args(sub_gen_name, location,
+                                      config_args, config_kwargs)
+
+        bbox = self._get_global_bbox(bbox)
+
+        if self.info.cache_key:
+            self._subgen_calls.append((args, bbox))
+
+        self.bspace.deferred.add(self, args, bbox)
 
         self._num_subgens += 1
 
@@ -491,6 +666,24 @@ class Generator:
     def generate(self, config):
         pass
 
+    def _replay(self, record):
+        for region in record.reads:
+            self.bspace.deps.add_read(self, region)
+
+        for geom in record.geoms:
+            self.add_geom(geom, _global=True)
+
+        for child in record.children:
+            replay(child, self.bspace, self, self.log)
+
+        for args in record.subgens:
+            self._subgen(*args)
+
+        for args, bbox in record.deferred:
+            self.bspace.deferred.add(self, args, bbox)
+
+        self._num_subgens = record.num_subgens
+
     @classmethod
     def get_sub_generator(self, name):
         '''
@@ -511,12 +704,16 @@ class Generator:
 
         if self.parent:
             self.parent.children.remove(self)
+            self.parent._update_subtree_bbox()
         else:
             self.bspace.root_gen = None
 
         geoms = self.geoms.values()
         self.del_geoms(*geoms)
         self.bspace.index.remove(self)
+        self.bspace.deps.remove(self)
+        self.bspace.deferred.remove(self)
+        self.bspace.drop_truncated(self)
         
         self.bspace.notify_event('del_gen', self, self.parent)
 
@@ -606,6 +803,10 @@ def _rungen(generator, config, seed=0,
         rc = [(g, x) for x in rc]
         recipes.extend(rc)
 
+    profiler = bspace.profiler
+    if profiler:
+        start_time = time.time()
+
     for root_info, recipe_config in reversed(recipes):
         recipe_config.apply(g, root_info, on_seed_changed)
 
@@ -613,6 +814,9 @@ def _rungen(generator, config, seed=0,
             # recipe wants to inhibit
             return
 
+    if profiler:
+        profiler.on_recipes_applied(g, time.time() - start_time)
+
     # checking if g.generator has changed after applying recipe
     if g.generator != generator:
         new_config = dict(g.generator.get_config())
@@ -624,14 +828,178 @@ def _rungen(generator, config, seed=0,
 
         g.config = new_config
 
+    cache = bspace.cache
+    if cache is not None:
+        g.cache_key = cache.make_key(g)
+        g.record = cache.get(g.cache_key)
+
     gen_obj = g.generator(g, recipes, bspace, g.picker, log)
 
     return gen_obj
 
+class GeneratorRecord:
+    '''
+    Snapshot of a generator and the subtree below it. Holds
+    everything needed to re-create the subtree (see L{replay})
+    without running generate(). Records can be pickled using
+    L{procodile.snapshot}.
+    '''
+
+    #: changed whenever attributes are added or removed (or
+    #   the geoms that records hold would come out differently)
+    #   so that stored records of the older kind are not used
+    VERSION = 5
+
+    def __init__(self):
+        # Generator class (after recipe application)
+        self.generator = None
+
+        self.id = None
+        self.name = None
+        self.index = None
+        self.seed = None
+        self.s_seed = None
+        self.config = None
+        self.materials = None
+        self.location = None # local location
+
+        # original values (as given to _rungen)
+        self._generator = None
+        self._config = None
+        self._seed = None
+
+        self.num_subgens = 0
+
+        #: geoms (in global co-ordinates) in the order of addition
+        self.geoms = []
+
+        #: records of sub generators
+        self.children = []
+
+        #: regions (global BoundBoxes) queried by the generator
+        self.reads = []
+
+        #: sub generators to be run (as arguments for
+        #   Generator._subgen) when only the generator
+        #   itself has been recorded
+        self.subgens = []
+
+        #: deferred sub generators (as (arguments for
+        #   Generator._subgen, global BoundBox))
+        self.deferred = []
+
+def make_record(gen_obj, deep=True):
+    '''
+    Capture the subtree rooted at gen_obj. If not deep, only
+    gen_obj is captured along with the sub generators that it
+    asked for (see L{Generator._subgen_calls}).
+
+    @rtype: GeneratorRecord
+    '''
+    info = gen_obj.info
+
+    r = GeneratorRecord()
+    r.generator = gen_obj.__class__
+    r.id = info.id
+    r.name = info.name
+    r.index = info.index
+    r.seed = info.seed
+    r.s_seed = info.s_seed
+    r.config = gen_obj.config
+    r.materials = info.materials
+    r.location = info.location
+
+    r._generator = info._generator
+    r._config = info._config
+    r._seed = info._seed
+
+    r.num_subgens = gen_obj._num_subgens
+    r.geoms = gen_obj.geoms.values()
+    r.reads = gen_obj.bspace.deps.get_regions(gen_obj)
+
+    if deep:
+        r.children = [make_record(c) for c in gen_obj.children]
+
+        # deferred sub generators which have been expanded
+        # are among the children
+        pending = gen_obj.bspace.deferred.get(gen_obj)
+        r.deferred = [(e.args, e.bbox) for e in pending]
+
+    else:
+        calls = gen_obj._subgen_calls
+        r.subgens = [args for args, bbox in calls if bbox is None]
+        r.deferred = [(args, bbox) for args, bbox in calls
+                                   if bbox is not None]
+
+    return r
+
+def replay(record, bspace=None, parent=None, log=None):
+    '''
+    Re-create the subtree captured in record (by L{make_record})
+    in bspace under parent. Geoms of the record are added as is,
+    so a record must be replayed only once.
+    '''
+
+    if not bspace:
+        bspace = bs.BuildSpace()
+
+    if parent:
+        depth = parent.depth + 1
+        glocation = parent.location.multiply(record.location)
+    else:
+        depth = 0
+        glocation = record.location
+
+    g = GeneratorInfo()
+
+    g.id = record.id
+    g.generator = record.generator
+    g.index = record.index
+    g.seed = record.seed
+    g.s_seed = record.s_seed
+    g.config = record.config
+    g.materials = record.materials
+    g.location = record.location
+    g.glocation = glocation
+    g.parent = parent
+    g.depth = depth
+    g.name = record.name
+    g.picker = pick.Picker(record.s_seed)
+
+    g._seed = record._seed
+    g._config = record._config
+    g._generator = record._generator
+
+    g.record = record
+
+    rc = record._generator.RECIPE_CONFIG
+    rc = (rc if isinstance(rc, list) else [rc]) if rc else []
+    recipes = [(g, x) for x in rc]
+
+    return g.generator(g, recipes, bspace, g.picker, log)
+
+def _iter_build(bspace):
+    try:
+        for _ in bspace.run_async():
+            yield
+    finally:
+        bspace.state = bspace.STATE_COMPLETED
+
 def rungen(generator, config, seed=0,
            name=None, location=None,
            bspace=None, picker=None,
-           parent=None, index=0, log=None):
+           parent=None, index=0, log=None, defer=False,
+           budget=None):
+    '''
+    Run generator in bspace.
+
+    @param budget: L{budget.BuildBudget} for the build (replaces
+        the budget of bspace)
+
+    @param defer: if True (and this is the root generator), the
+        build is only set up as bspace.task and the caller runs it
+        in slices using L{BuildSpace.step}.
+    '''
 
     if not bspace:
         bspace = bs.BuildSpace()
@@ -640,10 +1008,22 @@ def rungen(generator, config, seed=0,
         return _rungen(generator, config, seed, name, location,
                        bspace, picker, parent, index, log)
 
-    bspace.queue_generator(run_fn)
+    bspace.queue_generator(run_fn, parent)
 
     if not parent: # is root gen
         bspace.state = bspace.STATE_RUNNING
+        bspace.stopped = False
+
+        if budget is not None:
+            bspace.budget = budget
+
+        if bspace.budget is not None:
+            bspace.budget.start()
+            bspace.truncated = []
+
+        if defer:
+            bspace.task = _iter_build(bspace)
+            return
 
     try:
         return bspace.run()
@@ -674,10 +1054,10 @@ def _make_rerun_fn(generator):
 
     return run_fn
 
-def re_rungen(generator):
-    return re_rungens([generator])
+def re_rungen(generator, defer=False):
+    return re_rungens([generator], defer=defer)
 
-def re_run_rootgen(generator):
+def re_run_rootgen(generator, defer=False):
     g = generator
 
     bspace = g.bspace
@@ -695,9 +1075,10 @@ def re_run_rootgen(generator):
         log = g.log
        
         return rungen(gen_class, config, seed, name, location,
-                        bspace=g.bspace, log=log)
+                        bspace=g.bspace, log=log, defer=defer)
     finally:
-        bspace.state = bspace.STATE_COMPLETED
+        if not bspace.task:
+            bspace.state = bspace.STATE_COMPLETED
 
 def _filter_redundant_generators(generators):
     gens = set(generators)
@@ -716,22 +1097,79 @@ def _filter_redundant_generators(generators):
 
     return o_gens
 
-def re_rungens(generators):
+def _get_gen_path(generator):
+    path = [a.id for a in reversed(generator.ancestors)]
+    path.append(generator.id)
+    return tuple(path)
+
+def re_rungens(generators, propagate=True, defer=False):
+    '''
+    Re-run generators along with their sub generators.
+
+    @param propagate: if True, generators whose spatial queries
+        have seen the regions or generators modified by the
+        re-run are re-run too (see L{dependency}), until there
+        are no more such generators. A generator is re-run at
+        most once, so cyclic dependencies cannot loop forever.
+
+    @param defer: if True, the re-run is only set up as
+        bspace.task (see L{rungen})
+    '''
     bspace = generators[0].bspace
     _ensure_rerun_state(bspace)
 
     generators = _filter_redundant_generators(generators)
 
     if len(generators) == 1 and generators[0] == bspace.root_gen:
-        return re_run_rootgen(generators[0])
+        return re_run_rootgen(generators[0], defer)
 
-    for g in generators:
-        run_fn = _make_rerun_fn(g)
-        bspace.queue_generator(run_fn)
+    task = _iter_re_rungens(bspace, generators, propagate)
 
-    bspace.state = bspace.STATE_RUNNING
+    if defer:
+        bspace.state = bspace.STATE_RUNNING
+        bspace.task = task
+        return
+
+    for _ in task:
+        pass
+
+def _iter_re_rungens(bspace, generators, propagate):
+    deps = bspace.deps
+    done = set()
+
+    bspace.stopped = False
+
+    if bspace.budget is not None:
+        bspace.budget.start()
 
     try:
-        return bspace.run(re_run=True)
+        while generators:
+            for g in generators:
+                done.add(_get_gen_path(g))
+                run_fn = _make_rerun_fn(g)
+                bspace.queue_generator(run_fn)
+
+            bspace.state = bspace.STATE_RUNNING
+
+            deps.start_recording()
+            try:
+                for _ in bspace.run_async():
+                    yield
+            finally:
+                changes = deps.stop_recording()
+
+            if not propagate or bspace.stopped:
+                break
+
+            generators = []
+            for g in deps.get_dependents(changes):
+                if _get_gen_path(g) in done:
+                    log.warning('not re-running %s again (cyclic '
+                                'dependency)' % g.name)
+                    continue
+                generators.append(g)
+
+            generators = _filter_redundant_generators(generators)
+
     finally:
         bspace.state = bspace.STATE_COMPLETED
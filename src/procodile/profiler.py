@@ -0,0 +1,244 @@
+'''
+Profiling of builds per generator.
+
+When a build space has a L{BuildProfiler}, every generator gets a
+L{GeneratorStats} (as gen_obj.stats) recording:
+
+ - time spent in generate() (or in re-creating the generator
+   from a cached record), excluding sub generators run from
+   within it (as in DFS)
+ - time spent in add_geom and the part of it spent updating
+   the spatial index
+ - time spent applying recipes
+ - number of geoms and vertices added
+ - growth of the peak memory use of the process while the
+   generator ran (where the platform provides it)
+
+The stats can be reported as a tree mirroring the build tree
+(L{BuildProfiler.get_report}), aggregated per generator class
+(L{BuildProfiler.get_class_report}) or written as collapsed
+stacks for flamegraph tools (L{BuildProfiler.write_collapsed}).
+
+G{importgraph}
+'''
+
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+from procodile.budget import count_vertices
+
+def _get_peak_memory():
+    '''
+    @return: peak memory use of the process in KB
+        (0 when not known)
+    '''
+    if resource is None:
+        return 0
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class GeneratorStats(object):
+    __slots__ = ['class_name', 'name', 'total_time', 'child_time',
+                 'geom_time', 'index_time', 'recipe_time',
+                 'num_geoms', 'num_vertices', 'peak_mem_growth',
+                 '_start_time', '_start_mem']
+
+    def __init__(self, class_name, name):
+        self.class_name = class_name
+        self.name = name
+
+        #: time from start to end of generation (including
+        #   sub generators run from within it)
+        self.total_time = 0.0
+
+        #: part of total_time spent in sub generators
+        self.child_time = 0.0
+
+        self.geom_time = 0.0
+        self.index_time = 0.0
+        self.recipe_time = 0.0
+
+        self.num_geoms = 0
+        self.num_vertices = 0
+
+        #: growth of the peak memory use of the process (KB)
+        #   while the generator ran; memory which the generator
+        #   allocated within the earlier peak is not seen
+        self.peak_mem_growth = 0
+
+        self._start_time = 0.0
+        self._start_mem = 0
+
+    @property
+    def self_time(self):
+        return self.total_time - self.child_time
+
+    def add(self, stats):
+        for attr in ('total_time', 'child_time', 'geom_time',
+                     'index_time', 'recipe_time', 'num_geoms',
+                     'num_vertices', 'peak_mem_growth'):
+            setattr(self, attr, getattr(self, attr) + getattr(stats, attr))
+
+    def format(self):
+        ms = lambda t: '%.2fms' % (t * 1000)
+
+        return '%s (%s): self %s, total %s, add_geom %s ' \
+               '(index %s), recipes %s, geoms %d, vertices %d, ' \
+               'peak memory +%dKB' % (self.class_name, self.name,
+                    ms(self.self_time), ms(self.total_time),
+                    ms(self.geom_time), ms(self.index_time),
+                    ms(self.recipe_time), self.num_geoms,
+                    self.num_vertices, self.peak_mem_growth)
+
+class BuildProfiler:
+    '''
+    Collects L{GeneratorStats} for the generators of a build space.
+    '''
+
+    def __init__(self, count_vertices=True):
+        '''
+        @param count_vertices: counting vertices of every geom
+            is not cheap and can be turned off
+        '''
+        self.count_vertices = count_vertices
+
+        #: stats of all generators run so far (in order of start)
+        self.stats = []
+
+        # stats of generators being generated (innermost last)
+        self._stack = []
+
+        # id(GeneratorInfo) -> time spent applying recipes
+        self._recipe_times = {}
+
+    def on_recipes_applied(self, info, time_taken):
+        self._recipe_times[id(info)] = time_taken
+
+    def on_generator_start(self, gen_obj):
+        stats = GeneratorStats(gen_obj.__class__.__name__, gen_obj.name)
+        stats.recipe_time = self._recipe_times.pop(id(gen_obj.info), 0.0)
+        stats._start_mem = _get_peak_memory()
+        stats._start_time = time.time()
+
+        gen_obj.stats = stats
+        self.stats.append(stats)
+        self._stack.append(stats)
+
+    def on_generator_end(self, gen_obj):
+        stats = self._stack.pop()
+
+        stats.total_time = time.time() - stats._start_time
+        stats.peak_mem_growth = _get_peak_memory() - stats._start_mem
+
+        if self._stack:
+            self._stack[-1].child_time += stats.total_time
+
+    def on_add_geom(self, gen_obj, geom, time_taken, index_time):
+        stats = getattr(gen_obj, 'stats', None)
+        if stats is None:
+            return
+
+        stats.geom_time += time_taken
+        stats.index_time += index_time
+        stats.num_geoms += 1
+
+        if self.count_vertices:
+            stats.num_vertices += count_vertices(geom)
+
+    def on_index_written(self, gen_obj, time_taken):
+        '''
+        Additions of gen_obj are written to the spatial index
+        together once it is done (see L{buildspace.SpatialIndex.begin_batch}).
+        '''
+        stats = getattr(gen_obj, 'stats', None)
+        if stats is None:
+            return
+
+        stats.index_time += time_taken
+
+    def _get_report(self, gen_obj, lines, depth):
+        stats = getattr(gen_obj, 'stats', None)
+        line = stats.format() if stats else '%s (%s): not profiled' % \
+                    (gen_obj.__class__.__name__, gen_obj.name)
+        lines.append('  ' * depth + line)
+
+        for child in gen_obj.children:
+            self._get_report(child, lines, depth + 1)
+
+    def get_report(self, root_gen):
+        '''
+        @rtype: str
+        @return: stats of generators as a tree
+            mirroring the build tree
+        '''
+        lines = []
+        self._get_report(root_gen, lines, 0)
+        return '\n'.join(lines)
+
+    def get_class_stats(self):
+        '''
+        @rtype: dict
+        @return: generator class name -> (number of generators,
+            L{GeneratorStats} with the sum of their stats)
+        '''
+        class_stats = {}
+
+        for stats in self.stats:
+            name = stats.class_name
+            count, total = class_stats.get(name, (0, None))
+
+            if total is None:
+                total = GeneratorStats(name, '*')
+
+            total.add(stats)
+            class_stats[name] = count + 1, total
+
+        return class_stats
+
+    def get_class_report(self):
+        '''
+        @rtype: str
+        @return: stats per generator class, by self time
+        '''
+        items = self.get_class_stats().values()
+        items.sort(key=lambda (count, total): -total.self_time)
+
+        lines = ['%6d x %s' % (count, total.format())
+                 for count, total in items]
+        return '\n'.join(lines)
+
+    def _write_collapsed(self, gen_obj, stream, path):
+        path = path + [gen_obj.__class__.__name__]
+        stats = getattr(gen_obj, 'stats', None)
+
+        if stats:
+            # microseconds; flamegraph tools need integers
+            value = int(round(stats.self_time * 1000000))
+            stream.write('%s %d\n' % (';'.join(path), value))
+
+        for child in gen_obj.children:
+            self._write_collapsed(child, stream, path)
+
+    def write_collapsed(self, root_gen, stream):
+        '''
+        Write self time of generators as collapsed stacks
+        (one "Root;Child;Grandchild microseconds" line per
+        generator) as expected by flamegraph.pl and similar
+        tools.
+
+        @param stream: file-like object or file path
+        '''
+        if isinstance(stream, basestring):
+            stream = open(stream, 'w')
+            try:
+                self._write_collapsed(root_gen, stream, [])
+            finally:
+                stream.close()
+
+        else:
+            self._write_collapsed(root_gen, stream, [])
@@ -0,0 +1,206 @@
+'''
+Scheduling of queued generators in a build space.
+
+A scheduler holds the generators that are waiting to be run
+(as L{QueueEntry} objects) and decides the order in which they
+are run. Breadth-first and depth-first orders are deque based
+and cost O(1) per generator. Priority orders are heap based.
+
+G{importgraph}
+'''
+
+import heapq
+import itertools
+from collections import deque
+
+class QueueEntry(object):
+    '''
+    A generator waiting to be run.
+    '''
+
+    __slots__ = ['run_fn', 'parent', 'depth', 'bbox']
+
+    def __init__(self, run_fn, parent=None, bbox=None):
+        #: callable which runs the generator
+        self.run_fn = run_fn
+
+        #: parent generator object (None for root or re-runs)
+        self.parent = parent
+
+        #: depth of the generator in the build tree
+        self.depth = parent.depth + 1 if parent else 0
+
+        #: BoundBox that the generator is expected to occupy (if known)
+        self.bbox = bbox
+
+    def get_bbox(self):
+        '''
+        Expected bound box of the generator; the bound box of
+        parent if not declared.
+        '''
+        if self.bbox is None and self.parent:
+            return self.parent.bbox
+        return self.bbox
+
+class Scheduler(object):
+    '''
+    Abstract scheduler.
+    '''
+
+    def push(self, entry):
+        raise NotImplementedError
+
+    def pop(self):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        '''
+        Iterate over the entries (in no particular order)
+        without removing them.
+        '''
+        raise NotImplementedError
+
+    def drain(self):
+        '''
+        Remove all entries.
+
+        @rtype: list
+        @return: entries in the order in which they would
+            have been popped.
+        '''
+        entries = []
+        while len(self):
+            entries.append(self.pop())
+        return entries
+
+class FIFOScheduler(Scheduler):
+    '''
+    Breadth-first order.
+    '''
+
+    def __init__(self):
+        self._queue = deque()
+
+    def push(self, entry):
+        self._queue.append(entry)
+
+    def pop(self):
+        return self._queue.popleft()
+
+    def clear(self):
+        self._queue.clear()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __iter__(self):
+        return iter(self._queue)
+
+class LIFOScheduler(FIFOScheduler):
+    '''
+    Depth-first order.
+    '''
+
+    def pop(self):
+        return self._queue.pop()
+
+class PriorityScheduler(Scheduler):
+    '''
+    Entries with lower key(entry) are run first. Entries with
+    equal keys are run in the order in which they were queued.
+    '''
+
+    def __init__(self, key):
+        self.key = key
+        self._heap = []
+        self._counter = itertools.count()
+
+    def push(self, entry):
+        item = (self.key(entry), self._counter.next(), entry)
+        heapq.heappush(self._heap, item)
+
+    def pop(self):
+        return heapq.heappop(self._heap)[-1]
+
+    def clear(self):
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        return (item[-1] for item in self._heap)
+
+def depth_key(entry):
+    return entry.depth
+
+def bbox_extent(bbox):
+    '''
+    Squared length of the diagonal of bbox. Unlike volume this
+    does not vanish for flat items (eg: plots, roads).
+    '''
+    if bbox is None:
+        return 0
+
+    dx = bbox.xmax - bbox.xmin
+    dy = bbox.ymax - bbox.ymin
+    dz = bbox.zmax - bbox.zmin
+    return dx * dx + dy * dy + dz * dz
+
+def largest_bbox_key(entry):
+    return -bbox_extent(entry.get_bbox())
+
+class ShallowestFirstScheduler(PriorityScheduler):
+    '''
+    Generators closer to the root are run first.
+    '''
+
+    def __init__(self):
+        PriorityScheduler.__init__(self, depth_key)
+
+class LargestBBoxFirstScheduler(PriorityScheduler):
+    '''
+    Generators expected to occupy larger regions are run first
+    so that coarse structure appears before fine detail.
+
+    Generators without a declared bound box go by that of their
+    parent, which is still growing while the parent runs (and
+    queues them). They are keyed only when the next one is popped,
+    by which time the parent has finished.
+    '''
+
+    def __init__(self):
+        PriorityScheduler.__init__(self, largest_bbox_key)
+
+        # entries yet to be keyed in the order of push
+        self._unkeyed = []
+
+    def push(self, entry):
+        if entry.bbox is None and entry.parent:
+            self._unkeyed.append(entry)
+        else:
+            PriorityScheduler.push(self, entry)
+
+    def pop(self):
+        unkeyed, self._unkeyed = self._unkeyed, []
+        for entry in unkeyed:
+            PriorityScheduler.push(self, entry)
+
+        return PriorityScheduler.pop(self)
+
+    def clear(self):
+        PriorityScheduler.clear(self)
+        self._unkeyed = []
+
+    def __len__(self):
+        return PriorityScheduler.__len__(self) + len(self._unkeyed)
+
+    def __iter__(self):
+        return itertools.chain(PriorityScheduler.__iter__(self),
+                               self._unkeyed)
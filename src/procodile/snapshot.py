@@ -0,0 +1,51 @@
+'''
+Pickling of build data (generator records, geoms) so that
+it can be moved between processes or stored.
+
+Classes defined in packages are not importable by name (the
+loader keeps package modules out of sys.modules), so they are
+pickled as references to the package which loaded them.
+
+G{importgraph}
+'''
+
+import sys
+import types
+import pickle
+import cStringIO
+
+from procodile.loader import get_loader
+
+CLASS_TYPES = (type, types.ClassType)
+
+class _Pickler(pickle.Pickler):
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, CLASS_TYPES):
+            return None
+
+        if obj.__module__ in sys.modules:
+            return None
+
+        location = get_loader().locate_class(obj)
+        if not location:
+            return None
+
+        package_path, module_name = location
+        return (package_path, module_name, obj.__name__)
+
+class _Unpickler(pickle.Unpickler):
+
+    def persistent_load(self, pid):
+        package_path, module_name, class_name = pid
+        return get_loader().lookup_class(package_path, module_name,
+                                         class_name)
+
+def dumps(obj):
+    stream = cStringIO.StringIO()
+    _Pickler(stream, pickle.HIGHEST_PROTOCOL).dump(obj)
+    return stream.getvalue()
+
+def loads(data):
+    stream = cStringIO.StringIO(data)
+    return _Unpickler(stream).load()
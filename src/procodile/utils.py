@@ -19,6 +19,8 @@ import unicodedata
 from math import fabs, sqrt, acos
 import ctypes
 
+import numpy
+
 import procodile.transformations as trans
 
 ALPHANUM = string.letters + string.digits
@@ -396,6 +398,10 @@ class DotAccessDict(dict):
         dict.__init__(self, *args, **kwargs)
         self.__dict__ = self
 
+    def __reduce__(self):
+        # __dict__ is the dict itself; pickle the items only
+        return (self.__class__, (dict(self),))
+
 def get_ancestors(_class):
     '''
     Get all the ancestors of given class.
@@ -631,13 +637,24 @@ class Matrix:
     def scale(self, inplace=True):
         pass
 
-    def transform(self):
+    def transform(self, point):
         x, y, z = point
         point = (x, y, z, 1)
 
         point = numpy.dot(self.matrix, point)
         return tuple(point[:3])
 
+    def transform_points(self, points):
+        '''
+        Transform many points at once.
+
+        @param points: sequence (or numpy array) of (x, y, z)
+        @return: numpy array of transformed points (one per row)
+        '''
+        m = numpy.asarray(self.matrix, dtype=float)
+        points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+        return numpy.dot(points, m[:3, :3].T) + m[:3, 3]
+
     def equals(self, matrix):
         # TODO: check if this comparison works
         matrix = self._ensure_matrix(matrix)
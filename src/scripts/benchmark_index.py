@@ -0,0 +1,131 @@
+'''
+Benchmark of spatial index backends (see L{procodile.indexbackend}).
+
+For every workload and backend, reports the time taken to insert
+entries one at a time, to create the backend with all entries at
+once (bulk load), to run queries and to delete half of the entries.
+
+Workloads:
+ - city: buildings of similar size on a regular grid of blocks,
+   queried with regions of the size of a few buildings
+ - mixed: randomly placed entries of widely varying sizes
+ - small: a few hundred entries
+
+Usage: python benchmark_index.py [-n NUM_ENTRIES] [-q NUM_QUERIES]
+'''
+
+import time
+import random
+import optparse
+import functools
+
+from procodile.indexbackend import RtreeBackend, NumpyBackend, GridBackend
+
+def make_city(r, num_entries):
+    entries = []
+
+    side = int(num_entries ** 0.5) or 1
+    for i in xrange(num_entries):
+        # 10 x 10 lots with 2 units of road between blocks of 4 x 4
+        gx, gy = i % side, i / side
+        x = gx * 10 + (gx / 4) * 2 + r.uniform(0, 2)
+        y = gy * 10 + (gy / 4) * 2 + r.uniform(0, 2)
+        w, d, h = r.uniform(5, 8), r.uniform(5, 8), r.uniform(5, 40)
+        entries.append((i, (x, y, 0, x + w, y + d, h)))
+
+    extent = side * 10 * 1.2
+    make_query = lambda: _make_box(r, extent, 30)
+
+    return entries, make_query, 10
+
+def _make_box(r, extent, size):
+    x, y = r.uniform(0, extent), r.uniform(0, extent)
+    z = r.uniform(0, 10)
+    return (x, y, z, x + size, y + size, z + size)
+
+def make_mixed(r, num_entries):
+    extent = (num_entries ** 0.5) * 10
+    entries = []
+
+    for i in xrange(num_entries):
+        size = r.expovariate(1 / 5.0)
+        entries.append((i, _make_box(r, extent, size)))
+
+    make_query = lambda: _make_box(r, extent, r.uniform(5, 50))
+
+    return entries, make_query, 10
+
+def make_small(r, num_entries):
+    return make_mixed(r, min(num_entries, 300))
+
+WORKLOADS = [
+    ('city', make_city),
+    ('mixed', make_mixed),
+    ('small', make_small),
+]
+
+def get_backends(cell_size):
+    return [
+        ('rtree', RtreeBackend),
+        ('grid', functools.partial(GridBackend, cell_size=cell_size)),
+        ('numpy', NumpyBackend),
+    ]
+
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+def run_backend(make_backend, entries, queries):
+    backend = make_backend()
+
+    def insert():
+        for _id, bbox in entries:
+            backend.insert(_id, bbox)
+
+    def query():
+        for q in queries:
+            backend.intersection(q)
+
+    def delete():
+        for _id, bbox in entries[::2]:
+            backend.delete(_id, bbox)
+
+    t_insert = timed(insert)
+    t_bulk = timed(make_backend, entries)
+    t_query = timed(query)
+    t_delete = timed(delete)
+
+    return t_insert, t_bulk, t_query, t_delete
+
+def main(options):
+    r = random.Random(options.seed)
+    ms = lambda t: '%10.1f' % (t * 1000)
+
+    print '%-8s %-8s %10s %10s %10s %10s' % ('workload', 'backend',
+            'insert ms', 'bulk ms', 'query ms', 'delete ms')
+
+    for name, make_workload in WORKLOADS:
+        entries, make_query, cell_size = make_workload(r,
+                                                options.num_entries)
+        queries = [make_query() for i in xrange(options.num_queries)]
+
+        for backend_name, make_backend in get_backends(cell_size):
+            times = run_backend(make_backend, entries, queries)
+            print '%-8s %-8s %s' % (name, backend_name,
+                                    ' '.join(ms(t) for t in times))
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+
+    parser.add_option('-n', '--num-entries', type='int', default=100000,
+                      help='number of entries in the index')
+
+    parser.add_option('-q', '--num-queries', type='int', default=1000,
+                      help='number of queries to run')
+
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help='seed for generating workloads')
+
+    (options, args) = parser.parse_args()
+    main(options)
@@ -2,17 +2,18 @@ import os
 import math
 import time
 import logging
-import threading
 import ctypes
 from itertools import chain
 
+import numpy
 import Image #PIL
 import wx
 import ogre.renderer.OGRE as ogre
 
 from procodile.utils import log_method_call as logmt
 from procodile.procedural import rungen, re_rungens
-from procodile.draw import SurfaceGroup
+from procodile.draw import SurfaceGroup, Instance
+from procodile.cache import DiskCache, GenerationCache
 import procodile.buildspace as buildspace
 from procodile.recipe import RecipeBasedGenerator
 
@@ -27,8 +28,22 @@ def get_scene_manager():
 def get_mesh_manager():
     return ogre.MeshManager.getSingleton()
 
+# shared by all documents so that re-opening a recipe
+# re-uses the generators built earlier (even in
+# previous sessions)
+BUILD_CACHE = None
+
+def get_build_cache():
+    global BUILD_CACHE
+
+    if BUILD_CACHE is None:
+        BUILD_CACHE = DiskCache(memory=GenerationCache())
+
+    return BUILD_CACHE
+
 class BuildTreeOverlay:
     MAX_COMPUTATION_TIME_PER_FRAME = 1 / 30.
+    MAX_BUILD_TIME_PER_FRAME = 1 / 60.
     MAX_ACTIONS_PILEUP = 100
 
     STATE_READY = 0
@@ -59,50 +74,37 @@ class BuildTreeOverlay:
 
         self._actions = None
         self._bspace = None
-        self._thread = None
 
         self.build_time_elapsed = 0
         self._build_start_time = 0
         self._next_callback_time = 1
 
-        self._flow_control_pause = False
         self._build_completed = False
         self._build_completed_sent = False
         self.on_first_gen_created = None
 
-    def _queue_action(self, action):
+    def _queue_action(self, handler, *args):
         if self._actions is None:
             return
 
-        self._actions.append(action)
+        self._actions.append((handler, args))
 
     def on_frame_started(self, event):
 
         if self._actions is None:
             return
 
-        # flow control
-        # ensure that the background generation thread
-        # does not steal all the cpu. if the actions
-        # queue crossed threshold, pause generation until
-        # it clears
-        bs = self._bspace
-        bs_paused = bs.state == bs.STATE_PAUSED
-
-        if len(self._actions) > self.MAX_ACTIONS_PILEUP:
-            if not bs_paused:
-                bs.pause()
-                self._flow_control_pause = True
-
-        else:
-            if bs_paused and self._flow_control_pause:
-                bs.resume()
-                self._flow_control_pause = False
-
         # when paused, do not perform any action
         if self.state == self.STATE_PAUSED:
             return
 
+        # flow control
+        # generate only while the actions queue is short
+        # so that the scene keeps up with the build
+        if self.state == self.STATE_RUNNING and \
+            len(self._actions) <= self.MAX_ACTIONS_PILEUP:
+            self._step_build()
+
         # consume actions
         time_left = self.MAX_COMPUTATION_TIME_PER_FRAME
 
@@ -113,7 +115,8 @@ class BuildTreeOverlay:
 
             try:
                 start_time = time.time()
-                action()
+                handler, args = action
+                handler(*args)
                 time_taken = time.time() - start_time
                 time_left = time_left - time_taken
                 if time_left <= 0:
@@ -134,35 +137,30 @@ class BuildTreeOverlay:
     def on_frame_ended(self, event):
         pass
 
-    def event_handler(self, event, args):
+    def events_handler(self, events):
         self.build_time_elapsed = time.time() - self._build_start_time
 
-        if math.floor(self.build_time_elapsed) == self._next_callback_time:
+        if math.floor(self.build_time_elapsed) >= self._next_callback_time:
             self.doc.on_time_elapsed(self.build_time_elapsed)
-            self._next_callback_time += 1
-
-        handler = None
-
-        if event == 'add_gen':
-            handler = self.handle_add_gen
+            self._next_callback_time = \
+                math.floor(self.build_time_elapsed) + 1
 
-        elif event == 'del_gen':
-            handler = self.handle_del_gen
-
-        elif event == 'add_geom':
-            handler = self.handle_add_geom
-
-        elif event == 'del_geom':
-            handler = self.handle_del_geom
-
-        elif event == 'add_material':
-            handler = self.handle_add_material
+        if self._actions is None:
+            return
 
-        elif event == 'add_texture':
-            handler = self.handle_add_texture
+        handlers = {
+            'add_gen': self.handle_add_gen,
+            'del_gen': self.handle_del_gen,
+            'add_geom': self.handle_add_geom,
+            'del_geom': self.handle_del_geom,
+            'add_material': self.handle_add_material,
+            'add_texture': self.handle_add_texture,
+        }
 
-        if handler and self._actions is not None:
-            self._actions.append(lambda: handler(*args))
+        # actions are run later (see on_frame_started)
+        self._actions.extend((handlers[event], args)
+                             for event, args in events
+                             if event in handlers)
 
     def handle_add_gen(self, gen_obj, parent_obj):
 
@@ -332,20 +330,25 @@ class BuildTreeOverlay:
         self.materials.add(material_name)
 
     @logmt
-    def _do_build(self, gen_infos=None):
-
+    def _start_build(self, gen_infos=None):
+        '''
+        Set up the build which is then run a slice at
+        a time on every frame (see L{_step_build}).
+        '''
         bspace = self._bspace
 
         try:
 
             if gen_infos:
-                re_rungens([g.generator for g in gen_infos])
+                re_rungens([g.generator for g in gen_infos],
+                           defer=True)
 
             else:
                 g = self.gen_class
                 config = g.make_config()
                 seed = 0
-                rungen(g, config, seed, g.__name__, bspace=bspace)
+                rungen(g, config, seed, g.__name__, bspace=bspace,
+                       defer=True)
 
         except (SystemExit, KeyboardInterrupt):
             raise
@@ -353,8 +356,27 @@ class BuildTreeOverlay:
         except:
             log.exception('during build')
 
+        self._build_start_time = time.time()
+
+        if not bspace.task:
+            self._on_build_done()
+
+    def _step_build(self):
+        try:
+            more = self._bspace.step(self.MAX_BUILD_TIME_PER_FRAME)
+
+        except (SystemExit, KeyboardInterrupt):
+            raise
+
+        except:
+            log.exception('during build')
+            more = False
+
+        if not more:
+            self._on_build_done()
+
+    def _on_build_done(self):
         self.state = self.STATE_COMPLETED
-        self._thread = None
         self._build_completed = True
 
         if not self._actions:
@@ -369,13 +391,10 @@ class BuildTreeOverlay:
         self.state = self.STATE_RUNNING
 
         self._actions = []
-        self._bspace = buildspace.BuildSpace()
-        self._bspace.event_handlers.append(self.event_handler)
+        self._bspace = buildspace.BuildSpace(cache=get_build_cache())
+        self._bspace.add_batch_handler(self.events_handler)
 
-        self._thread = threading.Thread(target=self._do_build,
-                                        name='build_%x' % id(self))
-        self._thread.start()
-        self._build_start_time = time.time()
+        self._start_build()
 
     @logmt
     def rebuild(self, gen_infos, on_first_gen_created=None):
@@ -387,16 +406,10 @@ class BuildTreeOverlay:
         self.state = self.STATE_RUNNING
         self.on_first_gen_created = on_first_gen_created
 
-        fn = lambda: self._do_build(gen_infos)
-        self._thread = threading.Thread(target=fn,
-                                        name='rebuild_%x' % id(self))
-        self._thread.start()
-        self._build_start_time = time.time()
+        self._start_build(gen_infos)
         
     @logmt
     def pause(self):
-        self._flow_control_pause = False
-
         if self.state != self.STATE_RUNNING:
             return
 
@@ -418,21 +431,11 @@ class BuildTreeOverlay:
             return
 
         self._bspace.stop()
+        self._bspace.task = None
 
         self._actions = None
-        self._thread = None
         self.state = self.STATE_COMPLETED
 
-        # wait for thread to die
-        timeout = 10
-        wait_time = .1
-        while self._thread and timeout >= 0:
-            time.sleep(wait_time)
-            timeout -= wait_time
-
-        if timeout < 0:
-            log.error('timedout waiting for thread to stop')
-
     @logmt
     def cleanup(self):
         if self.state == self.STATE_READY:
@@ -637,41 +640,38 @@ class GeomInfo:
     def is_rendered(self):
         return bool(self._meshes)
 
-    def _make_mesh(self, geom, name, material_name):
+    def _make_mesh(self, mesh, name, material_name):
+        '''
+        @param mesh: as returned by L{procodile.draw.Surface.get_mesh_arrays}
+        '''
         sm = get_scene_manager()
 
-        mesh = geom.mesh
-        if not mesh:
+        positions, indices, normals, tcoords = mesh
+        if not len(indices):
             return None
-        
-        vertices, indices, normals, tcoords = mesh
 
-        obj = sm.createManualObject(name)
-        obj.setDynamic(True)
-        obj.begin(material_name, ogre.RenderOperation.OT_TRIANGLE_LIST)
-
-        num_vertices = len(vertices)
+        num_vertices = len(positions)
         num_triangles = len(indices)
 
-        for vindex, vertindices in enumerate(indices):
-            for index in vertindices:
-                vertex = vertices[index]
-                normal = normals[index]
+        # z-up to y-up; every corner of a triangle
+        # gets a vertex of its own
+        corners = indices.ravel()
+        positions = positions[corners][:, [0, 2, 1]] * (1, 1, -1)
+        normals = normals[corners][:, [0, 2, 1]] * (1, 1, -1)
+        tcoords = numpy.nan_to_num(tcoords[corners])
 
-                x, y, z = vertex
-                vertex = x, z, -y
+        rows = zip(positions.tolist(), normals.tolist(), tcoords.tolist())
 
-                x, y, z = normal
-                normal = x, z, -y
+        obj = sm.createManualObject(name)
+        obj.setDynamic(True)
+        obj.begin(material_name, ogre.RenderOperation.OT_TRIANGLE_LIST)
 
-                obj.position(*vertex)
+        for i in xrange(0, len(rows), 3):
+            for position, normal, tcoord in rows[i:i+3]:
+                obj.position(*position)
                 obj.normal(*normal)
+                obj.textureCoord(*tcoord)
 
-                if tcoords:
-                    tcoord = tcoords[index] or (0.0, 0.0)
-                    obj.textureCoord(*tcoord)
-
-            i = vindex * 3
             obj.triangle(i, i+1, i+2)
 
         obj.end()
@@ -687,21 +687,32 @@ class GeomInfo:
         self.num_triangles = 0
         self.num_vertices = 0
 
-        if isinstance(g, SurfaceGroup):
-            geoms = g.surfaces.values()
+        # (mesh arrays, material) of every surface
+        if isinstance(g, Instance):
+            surfaces = dict(g.prototype.surfaces)
+            parts = [(mesh, g.material or surfaces[sname].material)
+                     for sname, mesh in g.get_meshes()]
+        elif isinstance(g, SurfaceGroup):
+            parts = [(s.get_mesh_arrays(), s.material)
+                     for s in g.surfaces.values()]
         else:
-            geoms = [g]
+            parts = [(g.get_mesh_arrays(), g.material)]
 
-        for index, geom in enumerate(geoms):
+        for index, (mesh_arrays, material) in enumerate(parts):
 
             mname = '%s_%s' % (name, index)
 
             material_name = 'default'
-            if geom.material:
-                material_name = 'material_%x' % id(geom.material)
+            if material:
+                material_name = 'material_%x' % id(material)
+
+            data = self._make_mesh(mesh_arrays, mname, material_name)
+            if data is None:
+                continue
+
+            # one per entity (see render)
             self._materials.append(material_name)
 
-            data = self._make_mesh(geom, mname, material_name)
             mesh, num_t, num_v = data
             self._meshes.append((mname, mesh))
             self.num_triangles += num_t
@@ -0,0 +1,96 @@
+'''
+Generators used by tests which run builds.
+'''
+
+import math
+
+from procodile.buildspace import BoundBox
+from procodile.draw import Box, Cylinder, Prototype, Instance
+from procodile.loader import GeneratorIdentification
+from procodile.procedural import Generator
+from procodile.utils import Matrix
+
+BLOCK = Prototype(Box(1, 1, 1))
+POST = Prototype(Cylinder(0.25, 2, 8))
+
+class Base(Generator):
+    IDENT = GeneratorIdentification()
+
+class Block(Base):
+    CONFIG = (
+                ('height', (1, 3)),
+             )
+
+    def generate(self, config):
+        for level in xrange(config.height):
+            block = Instance(BLOCK)
+            block.translate(0, 0, level)
+            self.add_geom(block)
+
+        post = Instance(POST)
+        post.rotate(1, 0, 0, 0.3)
+        self.add_geom(post)
+
+class Row(Base):
+    CONFIG = (
+                ('count', 3),
+             )
+
+    SUB_GENERATORS = {
+        'block': Block,
+    }
+
+    def generate(self, config):
+        for i in xrange(config.count):
+            self.subgen('block', (i * 2, 0, 0))
+
+class Grid(Base):
+    CONFIG = (
+                ('rows', 4),
+             )
+
+    SUB_GENERATORS = {
+        'row': Row,
+    }
+
+    def generate(self, config):
+        self.add_geom(Instance(BLOCK))
+
+        for i in xrange(config.rows):
+            self.subgen('row', ((0, i * 2, 0), (0, 0, math.pi / 8 * i)))
+
+#: bound box (local) enclosing everything a Row adds
+ROW_EXTENT = (-1, -1, -1, 6, 2, 4)
+
+class DeferredGrid(Grid):
+    '''
+    Grid whose rows are run only when needed.
+    '''
+
+    def generate(self, config):
+        self.add_geom(Instance(BLOCK))
+
+        for i in xrange(config.rows):
+            location = ((0, i * 2, 0), (0, 0, math.pi / 8 * i))
+            bbox = BoundBox(*ROW_EXTENT).transform(Matrix(location))
+            self.defer_subgen('row', location, bbox)
+
+class NosyBlock(Block):
+    '''
+    Block which is taller next to other blocks.
+    '''
+
+    def generate(self, config):
+        found = self.get_intersection((-1.5, -1.5, 0, 2.5, 2.5, 1))
+        config.height += len(found.get_geoms())
+        Block.generate(self, config)
+
+class NosyRow(Row):
+    SUB_GENERATORS = {
+        'block': NosyBlock,
+    }
+
+class NosyGrid(Grid):
+    SUB_GENERATORS = {
+        'row': NosyRow,
+    }
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+from procodile.budget import BuildBudget
+from procodile.buildspace import BuildSpace
+from procodile.procedural import rungen
+from procodile.scheduler import QueueEntry
+
+from gens import Grid
+
+class Gen:
+    def __init__(self, depth):
+        self.depth = depth
+
+def test_limits():
+    b = BuildBudget(max_generators=2, max_depth=1)
+    entry = QueueEntry(None, Gen(0))
+    deep = QueueEntry(None, Gen(1))
+
+    assert(b.allows(entry))
+    assert(not b.allows(deep))
+
+    b.count('add_gen', (None, None))
+    b.count('add_gen', (None, None))
+    assert(not b.allows(entry))
+    assert(b.exceeded == 'max_generators')
+
+    # root generator (and re-runs) are always run
+    assert(b.allows(QueueEntry(None)))
+
+    b.start()
+    assert(b.allows(entry))
+    assert(b.exceeded is None)
+
+def test_time_limit():
+    b = BuildBudget(max_time=0)
+    assert(b.is_exhausted())
+    assert(b.exceeded == 'max_time')
+
+def test_refine():
+    budget = BuildBudget(max_depth=1)
+    bspace = BuildSpace(budget=budget)
+    rungen(Grid, Grid.make_config(), 7, bspace=bspace)
+    assert(len(bspace.truncated) == 12)
+
+    # refining with no limits leaves the budget of the build in place
+    assert(bspace.refine())
+    assert(bspace.truncated == [])
+    assert(bspace.budget is budget)
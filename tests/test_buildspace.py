@@ -0,0 +1,567 @@
+#!/usr/bin/env python
+
+import math
+import threading
+import time
+
+import numpy
+
+from procodile.buildspace import BoundBox, BuildSpace, DeferredIndex, \
+                                 QueryCache, SpatialIndex, SpatialResults, \
+                                 GeomView, unwrap
+from procodile.draw import Box, Prototype, Instance
+from procodile.procedural import rungen
+from procodile.utils import Matrix
+
+from gens import Grid, NosyGrid, DeferredGrid
+
+def test_deferred_index():
+    d = DeferredIndex()
+    p1, p2 = object(), object()
+
+    d.add(p1, 'a', BoundBox(0, 0, 0, 10, 10, 10))
+    d.add(p2, 'b', BoundBox(20, 0, 0, 30, 10, 10))
+    d.add(p1, 'c', BoundBox(5, 0, 0, 25, 10, 10))
+
+    assert([e.args for e in d.get(p1)] == ['a', 'c'])
+
+    # entries come out in the order of addition
+    entries = d.pop(BoundBox(8, 0, 0, 9, 1, 1))
+    assert([e.args for e in entries] == ['a', 'c'])
+    assert(len(d) == 1)
+
+    d.remove(p2)
+    assert(len(d) == 0)
+    assert(d.pop() == [])
+
+class Gen:
+    def __init__(self, parent=None):
+        self.bbox = BoundBox()
+        self.parent = parent
+        self.ancestors = [parent] + parent.ancestors if parent else []
+        self.children = []
+
+        if parent:
+            parent.children.append(self)
+
+class Geom:
+    def __init__(self, *bbox):
+        self.bbox = bbox
+        self.tags = []
+        self.generator = None
+        self.visible = True
+
+    def get_bound_box(self):
+        return self.bbox
+
+def test_index_batch():
+    index = SpatialIndex()
+    gen = Gen()
+    geoms = [Geom(i, 0, 0, i + 1, 1, 1) for i in range(5)]
+
+    index.begin_batch()
+    for geom in geoms:
+        gen.bbox.merge(BoundBox(*geom.bbox))
+        index.update(gen)
+        index.update(gen, geom)
+
+    # nothing written to the index yet
+    assert(index.index.get_size() == 0)
+    assert(index.has(gen, geoms[0]))
+
+    index.remove(gen, geoms[0])
+    index.end_batch()
+    assert(index.index.get_size() == 5)
+
+    sr = index.intersection((4.5, 0, 0, 5, 1, 1))
+    assert(sr.get_geoms() == [geoms[4]])
+    assert(sr.get_generators() == [gen])
+
+    # queries see buffered additions
+    index.begin_batch()
+    extra = Geom(10, 0, 0, 11, 1, 1)
+    index.add(gen, extra)
+    assert(index.intersection((10, 0, 0, 11, 1, 1)).get_geoms() == [extra])
+    index.end_batch()
+
+def test_index_bulk_load():
+    index = SpatialIndex()
+    gen = Gen()
+    geoms = [Geom(i, 0, 0, i + 1, 1, 1) for i in range(20)]
+
+    index.add(gen, geoms[0])
+    index.bulk_load([(gen, g) for g in geoms[1:]] + [(gen, None)])
+    assert(index.index.get_size() == 21)
+
+    sr = index.intersection((0.5, 0, 0, 2.5, 1, 1))
+    assert(set(sr.get_geoms()) == set(geoms[:3]))
+
+    index.remove(gen, geoms[0])
+    index.rebuild()
+    assert(index.index.get_size() == 20)
+    assert(index.intersection((0, 0, 0, 0.5, 1, 1)).get_geoms() == [])
+
+    # rebuilding an empty index
+    for g in geoms[1:]:
+        index.remove(gen, g)
+    index.remove(gen)
+    index.rebuild()
+    assert(index.index.get_size() == 0)
+
+def test_node_store():
+    index = SpatialIndex()
+    gen = Gen()
+    geoms = [Geom(i, 0, 0, i + 1, 1, 1) for i in range(1500)]
+
+    # grows past its initial capacity
+    for g in geoms:
+        index.add(gen, g)
+
+    store = index.node_map
+    assert(len(store) == 1500)
+    assert(store.get_bbox(id(geoms[1200])).as_tuple() ==
+           (1200, 0, 0, 1201, 1, 1))
+
+    bboxes = store.get_bboxes([id(geoms[3]), id(geoms[1])])
+    assert(bboxes.tolist() == [[3, 0, 0, 4, 1, 1], [1, 0, 0, 2, 1, 1]])
+
+    # handles of removed nodes are reused
+    handle = store.get(id(geoms[5])).handle
+    index.remove(gen, geoms[5])
+    assert(id(geoms[5]) not in store)
+
+    extra = Geom(5, 5, 5, 6, 6, 6)
+    index.add(gen, extra)
+    assert(store.get(id(extra)).handle == handle)
+    assert(index.intersection((5.2, 0, 0, 5.8, 1, 1)).get_geoms() == [])
+    assert(index.intersection((5, 5, 5, 6, 6, 6)).get_geoms() == [extra])
+
+    # adding again replaces the old entry
+    extra.bbox = (7, 7, 7, 8, 8, 8)
+    index.add(gen, extra)
+    assert(index.index.get_size() == 1500)
+    assert(index.intersection((5, 5, 5, 6, 6, 6)).get_geoms() == [])
+    assert(index.intersection((7, 7, 7, 8, 8, 8)).get_geoms() == [extra])
+
+def test_query_prune():
+    bspace = BuildSpace()
+
+    def make_gen(parent, *bbox):
+        gen = Gen(parent)
+        gen.info = gen
+        gen.bbox = gen.subtree_bbox = BoundBox(*bbox)
+        return gen
+
+    root = make_gen(None, 0, 0, 0, 100, 10, 10)
+    left = make_gen(root, 0, 0, 0, 10, 10, 10)
+    leaf = make_gen(left, 2, 0, 0, 4, 4, 4)
+    right = make_gen(root, 50, 0, 0, 60, 10, 10)
+    bspace.root_gen = root
+
+    visited = []
+    def match_fn(info, rinfo):
+        visited.append(info)
+        return True
+
+    assert(len(bspace.query(match_fn, (0, 0, 0, 100, 10, 10))) == 4)
+
+    del visited[:]
+    found = bspace.query(match_fn, (1, 1, 1, 3, 3, 3), prune=True)
+    assert(found == [root, left, leaf])
+
+    # the subtree of right is never looked at
+    assert(right not in visited)
+
+def test_query_cache():
+    cache = QueryCache(cell_size=10)
+    index = SpatialIndex(query_cache=cache)
+    gen = Gen()
+    a, b = Geom(0, 0, 0, 1, 1, 1), Geom(50, 0, 0, 51, 1, 1)
+    index.add(gen, a)
+    index.add(gen, b)
+
+    near_a = BoundBox(0, 0, 0, 5, 5, 5)
+    near_b = BoundBox(48, 0, 0, 52, 5, 5)
+
+    assert(index.intersection(near_a).get_geoms() == [a])
+    assert(index.within(near_b).get_geoms() == [b])
+    assert(cache.misses == 2)
+
+    sr = index.intersection(near_a)
+    assert(sr.get_geoms() == [a])
+    assert(cache.hits == 1)
+
+    # results handed out are copies
+    sr.geoms.clear()
+    assert(index.intersection(near_a).get_geoms() == [a])
+
+    # modifications invalidate only the cells they touch
+    c = Geom(2, 2, 2, 3, 3, 3)
+    index.add(gen, c)
+    assert(set(index.intersection(near_a).get_geoms()) == set([a, c]))
+    index.within(near_b)
+    assert((cache.hits, cache.misses) == (3, 3))
+
+    index.remove(gen, b)
+    assert(index.within(near_b).get_geoms() == [])
+
+    # so do rebuilds
+    index.rebuild()
+    assert(len(cache) == 0)
+
+def test_query_cache_levels():
+    cache = QueryCache(cell_size=10)
+    near, far = (0, 0, 0, 5, 5, 5), (1000, 0, 0, 1005, 5, 5)
+    cache.put('near', near, 'a')
+    cache.put('far', far, 'b')
+
+    # large modifications invalidate only the results around them
+    cache.modify((-200, -200, -200, 200, 200, 200))
+    assert(cache.get('far') == 'b')
+    assert(cache.get('near') is None)
+    assert(len(cache) == 1)
+
+    # results which are not asked for again are dropped in time
+    cache.put('near', near, 'a')
+    cache.modify(near)
+    cache.get('far')
+    assert(len(cache) == 1)
+
+    # as are cell epochs
+    cache.PRUNE_SIZE = cache._prune_size = 16
+    for i in range(100):
+        cache.modify((i * 10, 500, 0, i * 10 + 1, 501, 1))
+    assert(len(cache.cell_epochs) <= 16)
+    assert(cache.get('far') == 'b')
+
+    cache.modify((1000, 0, 0, 1001, 1, 1))
+    assert(cache.get('far') is None)
+
+class SubGen(Gen):
+    pass
+
+def test_results_filters():
+    index = SpatialIndex()
+
+    root = Gen()
+    gens = [Gen(root), SubGen(root)]
+    gens.append(SubGen(gens[0]))
+
+    geoms = []
+    for i, gen in enumerate(gens):
+        gen.bbox = BoundBox(0, 0, 0, 10, 10, 10)
+        index.add(gen)
+
+        for tags in ([], ['wall'], ['wall', 'door']):
+            geom = Geom(i, 0, 0, i + 1, 1, 1)
+            geom.tags.extend(tags)
+            geom.generator = gen
+            geoms.append(geom)
+            index.add(gen, geom)
+
+    # a tag added after indexing
+    geoms[0].tags.append('late')
+    index.update_tags(geoms[0])
+
+    sr = index.intersection((0, 0, 0, 10, 10, 10))
+    plain = SpatialResults(sr.generators.values(), sr.geoms.values())
+
+    queries = [
+        ('get_generators', dict(_type=SubGen)),
+        ('get_generators', dict(_type=Gen, parent=root)),
+        ('get_generators', dict(ancestor=gens[0])),
+        ('get_generators', dict(parent=[gens[0], gens[1]])),
+        ('get_geoms', dict(tag='wall')),
+        ('get_geoms', dict(tag=['door', 'nothing'])),
+        ('get_geoms', dict(tag='wall', generator=gens[2])),
+        ('get_geoms', dict(_type=[gens[1], 'door'])),
+        ('get_geoms', dict(generator=gens[:2], visible=True)),
+    ]
+
+    for method, kwargs in queries:
+        expected = getattr(plain, method)(**kwargs)
+        found = getattr(sr, method)(**kwargs)
+        assert(expected)
+        assert(sorted(found) == sorted(expected))
+
+    assert(sr.get_geoms(tag='late') == [geoms[0]])
+
+    index.remove(gens[2], geoms[-1])
+    assert(len(index.intersection((0, 0, 0, 10, 10, 10)).get_geoms(
+                tag='door')) == 2)
+
+class Point:
+    def __init__(self, x, y, z):
+        self.x, self.y, self.z = x, y, z
+
+class Mesh(Geom):
+    def __init__(self, *points):
+        self.points = [Point(*p) for p in points]
+        Geom.__init__(self, *(tuple(min(c) for c in zip(*points)) +
+                              tuple(max(c) for c in zip(*points))))
+
+    def _get_gts_vertices(self):
+        return self.points
+
+def test_local_views():
+    index = SpatialIndex()
+
+    gen = Gen()
+    gen.location = Matrix((10, 0, 0))
+    gen.bbox = BoundBox(10, 0, 0, 12, 2, 2)
+    index.add(gen)
+
+    geom = Mesh((10, 0, 0), (12, 2, 2))
+    geom.generator = gen
+    geom.tags.append('wall')
+    index.add(gen, geom)
+
+    # frame of a generator at (5, 0, 0) rotated by 90 degrees about z
+    location = Matrix((5, 0, 0), (0, 0, math.pi / 2))
+    sr = index.intersection((0, 0, 0, 20, 20, 20))
+    lsr = sr.localize(location.inverse())
+
+    gview = lsr.get_generators()[0]
+    view = lsr.get_geoms(tag='wall', generator=gview)[0]
+
+    assert(unwrap(view) is geom and unwrap(gview) is gen)
+    assert(view == geom and hash(view) == hash(geom))
+    assert(view.tags == ['wall'])
+
+    expected = (0, -7, 0, 2, -5, 2)
+    for a, b in zip(view.get_bound_box(), expected):
+        assert(abs(a - b) < 1e-9)
+    for a, b in zip(gview.bbox.as_tuple(), expected):
+        assert(abs(a - b) < 1e-9)
+
+    x, y, z = gview.location.get_translation()
+    assert(abs(x) < 1e-9 and abs(y + 5) < 1e-9)
+
+    # stored geometry is untouched
+    assert(geom.points[0].x == 10 and gen.bbox.xmin == 10)
+    assert(sr.get_geoms()[0] is geom)
+
+    # other attributes are those of the geom itself
+    view.visible = False
+    assert(geom.visible is False)
+
+    try:
+        gview.location = Matrix()
+    except AttributeError:
+        pass
+    else:
+        assert(False)
+
+    # geoms reached through views are views
+    gen.geoms = {id(geom): geom}
+    assert(gview.geoms.values()[0].get_bound_box() == view.get_bound_box())
+
+    # attributes of the geom are not hidden by those of the view
+    block = Instance(Prototype(Box(1, 1, 1)), Matrix((10, 0, 0)))
+    bview = GeomView(block, location.inverse())
+    x, y, z = bview.matrix.get_translation()
+    assert(abs(x) < 1e-9 and abs(y + 5) < 1e-9)
+
+    lo = bview.get_triangles().reshape(-1, 3).min(axis=0)
+    assert(numpy.allclose(lo, (0, -6, 0)))
+    assert(numpy.allclose(bview.get_bound_box()[:3], lo))
+
+    # and those in the global frame are not handed out
+    try:
+        view.faces
+    except AttributeError:
+        pass
+    else:
+        assert(False)
+
+def test_nearest_and_raycast():
+    index = SpatialIndex()
+    gen = Gen()
+
+    geoms = []
+    for i in range(10):
+        geom = Geom(i * 10, 0, 0, i * 10 + 1, 1, 1)
+        geom.tags.append('odd' if i % 2 else 'even')
+        geoms.append(geom)
+        index.add(gen, geom)
+
+    found, region = index.nearest((22, 0.5, 0.5), 2)
+    assert([g for d, g in found] == [geoms[2], geoms[3]])
+    assert(abs(found[0][0] - 1) < 1e-9)
+    assert(region.contains(BoundBox(21, 0.5, 0.5, 23, 0.5, 0.5)))
+
+    found, region = index.nearest((22, 0.5, 0.5), 2, tag='odd')
+    assert([g for d, g in found] == [geoms[3], geoms[1]])
+
+    # fewer than asked for depend on everything
+    found, region = index.nearest((0, 0, 0), 20)
+    assert(len(found) == 10 and region.xmax == float('inf'))
+
+    # content yet to be added is added from near to far, only
+    # as far as it takes to find as many as asked for
+    pending = [Geom(x, 0, 0, x + 1, 1, 1) for x in (150, 160, 5000)]
+
+    def before_query(region):
+        for geom in pending[:]:
+            if region.intersects(BoundBox(*geom.bbox)):
+                pending.remove(geom)
+                index.add(gen, geom)
+
+    def pending_bounds():
+        if not pending:
+            return None
+        bbox = BoundBox(*pending[0].bbox)
+        for geom in pending[1:]:
+            bbox.merge(BoundBox(*geom.bbox))
+        return bbox
+
+    index.before_query = before_query
+    index.pending_bounds = pending_bounds
+
+    found, region = index.nearest((0, 0, 0), 12)
+    assert(len(found) == 12 and region.xmax == 160)
+    assert(len(pending) == 1)
+
+    found, region = index.nearest((0, 0, 0), 20)
+    assert(len(found) == 13 and region.xmax == float('inf'))
+    assert(pending == [])
+
+    index.before_query = index.pending_bounds = None
+
+    found, region = index.raycast((-5, 0.5, 0.5), (1, 0, 0), 30)
+    assert([g for d, g in found] == geoms[:3])
+    assert([d for d, g in found] == [5, 15, 25])
+
+    found, region = index.raycast((15, 0.5, 0.5), (-2, 0, 0), 100, tag='odd')
+    assert([(d, g) for d, g in found] == [(4, geoms[1])])
+
+    found, region = index.raycast((5, 5, 0.5), (0, -1, 0), 10)
+    assert(found == [])
+
+def build(generator, strategy=BuildSpace.BFS, **kwargs):
+    bspace = BuildSpace(strategy, **kwargs)
+    rungen(generator, generator.make_config(), 7, bspace=bspace)
+    return bspace
+
+def test_parallel():
+    for generator in (Grid, NosyGrid):
+        expected = build(generator).serialize()
+        bspace = build(generator, BuildSpace.PARALLEL, processes=2)
+        assert(bspace.serialize() == expected)
+
+        # subtrees which query the build space are built here
+        rows = bspace.root_gen.children
+        replayed = [r.info.record is not None for r in rows]
+        assert(replayed == [generator is Grid] * len(rows))
+
+def test_del_geoms():
+    bspace = build(Grid)
+    block = bspace.root_gen.children[1].children[1]
+    block.del_geoms(*block.geoms.values())
+
+    # an empty generator is at its location
+    x, y, z = block.location.get_translation()
+    assert(block.bbox.as_tuple() == (x, y, z, x, y, z))
+    assert((x, y) != (0, 0))
+
+def test_step():
+    expected = build(Grid).serialize()
+
+    bspace = BuildSpace()
+    rungen(Grid, Grid.make_config(), 7, bspace=bspace, defer=True)
+    assert(bspace.root_gen is None)
+
+    # a zero budget advances the build by one generator at a time
+    steps = 0
+    while bspace.step(0):
+        steps += 1
+
+    assert(steps == 17)
+    assert(bspace.task is None and bspace.step() is False)
+    assert(bspace.state == bspace.STATE_COMPLETED)
+    assert(bspace.serialize() == expected)
+
+def test_run_async():
+    expected = build(Grid).serialize()
+
+    # the build is run here rather than by step
+    bspace = BuildSpace()
+    rungen(Grid, Grid.make_config(), 7, bspace=bspace, defer=True)
+
+    advances = 0
+    for _ in bspace.run_async():
+        advances += 1
+        if advances == 1:
+            assert(len(bspace.root_gen.children) == 0)
+            assert(len(bspace.queue) == 4)
+
+    assert(advances == 17)
+    assert(bspace.serialize() == expected)
+
+def test_pause_resume():
+    expected = BuildSpace()
+    geoms = []
+    expected.event_handlers.append(
+        lambda event, args: event == 'add_geom' and geoms.append(args[1]))
+    rungen(Grid, Grid.make_config(), 7, bspace=expected)
+
+    bspace = BuildSpace()
+    added = []
+    reached, paused = threading.Event(), threading.Event()
+
+    # the build holds on at its first geom till paused from here
+    def on_event(event, args):
+        if event != 'add_geom':
+            return
+
+        added.append(args[1])
+        if len(added) == 1:
+            reached.set()
+            paused.wait(10)
+
+    bspace.event_handlers.append(on_event)
+
+    thread = threading.Thread(target=rungen,
+                              args=(Grid, Grid.make_config(), 7),
+                              kwargs=dict(bspace=bspace))
+    thread.start()
+
+    reached.wait(10)
+    assert(reached.is_set())
+    bspace.pause()
+    paused.set()
+
+    # the build waits to be resumed
+    time.sleep(.2)
+    assert(thread.is_alive() and len(added) == 1)
+
+    bspace.resume()
+    thread.join(10)
+
+    assert(not thread.is_alive())
+    assert(len(added) == len(geoms))
+    assert(bspace.serialize() == expected.serialize())
+
+def test_deferred_subgens():
+    expected = build(Grid).serialize()
+
+    bspace = build(DeferredGrid)
+    assert(len(bspace.deferred) == 4)
+    assert(bspace.root_gen.children == [])
+
+    # expanded sub generators come out as if run right away
+    assert(bspace.expand() == 4)
+    assert(len(bspace.deferred) == 0)
+    assert(bspace.serialize() == expected)
+
+def test_deferred_query():
+    bspace = build(DeferredGrid)
+
+    # touches the declared bbox of the first row only
+    sr = bspace.index.intersection((5, -0.5, 0, 5.5, 0, 1))
+
+    assert(len(bspace.deferred) == 3)
+    rows = bspace.root_gen.children
+    assert([r.id for r in rows] == ['0'])
+    parents = set(g.generator.parent for g in sr.get_geoms())
+    assert(parents == set(rows))
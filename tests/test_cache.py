@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+
+from procodile.buildspace import BuildSpace
+from procodile.cache import GenerationCache, DiskCache
+from procodile.procedural import rungen
+
+from gens import Grid, DeferredGrid
+
+def test_memory_lru():
+    c = GenerationCache(max_entries=2)
+    c.put('a', 1)
+    c.put('b', 2)
+    assert(c.get('a') == 1)
+    c.put('c', 3)
+
+    # 'b' was least recently used
+    assert('b' not in c)
+    assert(len(c) == 2)
+
+def test_disk_persistence():
+    d = tempfile.mkdtemp()
+    try:
+        c = DiskCache(d)
+        c.put('ab12', {'x': 1})
+
+        c = DiskCache(d)
+        assert(c.get('ab12') == {'x': 1})
+        assert(c.get('cd34') is None)
+        assert((c.hits, c.misses) == (1, 1))
+        assert(c.size == os.path.getsize(os.path.join(d, 'ab', 'ab12')))
+
+        # unreadable entries are misses and are dropped
+        open(os.path.join(d, 'ab', 'ab12'), 'wb').write('junk')
+        assert(c.get('ab12') is None)
+        assert('ab12' not in c)
+
+    finally:
+        shutil.rmtree(d)
+
+def test_disk_eviction():
+    d = tempfile.mkdtemp()
+    try:
+        c = DiskCache(d, max_bytes=1000)
+        for i in range(20):
+            c.put('%04d' % i, 'x' * 100)
+        assert(c.size <= 1000)
+        assert('0019' in c)
+        assert('0000' not in c)
+
+    finally:
+        shutil.rmtree(d)
+
+def test_disk_memory():
+    d = tempfile.mkdtemp()
+    try:
+        c = DiskCache(d, memory=GenerationCache())
+        c.put('ab12', {'x': 1})
+        assert('ab12' in c.memory and 'ab12' in c)
+
+        # memory hits mark records as recently used on disk too
+        fpath = os.path.join(d, 'ab', 'ab12')
+        os.utime(fpath, (0, 0))
+        assert(c.get('ab12') == {'x': 1})
+        assert(os.path.getmtime(fpath) > 0)
+
+    finally:
+        shutil.rmtree(d)
+
+def build(cache, generator=Grid):
+    bspace = BuildSpace(cache=cache)
+    rungen(generator, generator.make_config(), 7, bspace=bspace)
+    bspace.expand()
+    return bspace
+
+def test_replay():
+    for generator in (Grid, DeferredGrid):
+        expected = build(None, generator).serialize()
+
+        c = GenerationCache()
+        missed = build(c, generator)
+        hits, misses = c.hits, c.misses
+        assert(misses > 0)
+
+        # cache hits replay records to the same output
+        replayed = build(c, generator)
+        assert(c.misses == misses and c.hits > hits)
+        assert(replayed.root_gen.info.record is not None)
+
+        assert(missed.serialize() == expected)
+        assert(replayed.serialize() == expected)
+
+def test_disk_rehydration():
+    d = tempfile.mkdtemp()
+    try:
+        expected = build(DiskCache(d)).serialize()
+
+        # a new session
+        c = DiskCache(d)
+        bspace = build(c)
+        assert(c.misses == 0 and c.hits == 17)
+        assert(bspace.root_gen.info.record is not None)
+        assert(bspace.serialize() == expected)
+
+    finally:
+        shutil.rmtree(d)
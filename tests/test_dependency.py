@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+from procodile.buildspace import BoundBox, SpatialResults
+from procodile.dependency import DependencyTracker
+
+class Gen:
+    def __init__(self, parent=None):
+        self.ancestors = [parent] + parent.ancestors if parent else []
+
+def test_region_overlap():
+    d = DependencyTracker()
+    root = Gen()
+    reader = Gen(root)
+    d.add_read(reader, BoundBox(0, 0, 0, 10, 10, 10))
+
+    d.start_recording()
+    d.on_change(Gen(root), BoundBox(20, 20, 0, 30, 30, 10))
+    assert(d.get_dependents(d.stop_recording()) == [])
+
+    d.start_recording()
+    d.on_change(Gen(root), BoundBox(5, 5, 0, 30, 30, 10))
+    assert(d.get_dependents(d.stop_recording()) == [reader])
+
+def test_generator_read():
+    d = DependencyTracker()
+    other = Gen()
+    reader = Gen()
+    sr = SpatialResults([other], [])
+    d.add_read(reader, BoundBox(0, 0, 0, 1, 1, 1), sr)
+
+    d.start_recording()
+    d.remove(other)
+    assert(d.get_dependents(d.stop_recording()) == [reader])
+
+def test_exclusions():
+    d = DependencyTracker()
+    reader = Gen()
+    child = Gen(reader)
+    bbox = BoundBox(0, 0, 0, 1, 1, 1)
+    d.add_read(reader, bbox)
+
+    # changes made by sub generators do not affect a generator
+    d.start_recording()
+    d.on_change(child, bbox)
+    assert(d.get_dependents(d.stop_recording()) == [])
+
+    # but changes made elsewhere at the same time do
+    d.start_recording()
+    d.on_change(child, bbox)
+    d.on_change(Gen(), bbox)
+    assert(d.get_dependents(d.stop_recording()) == [reader])
+
+    # generators which ran while recording are up to date
+    d.start_recording()
+    fresh = Gen()
+    d.add_read(fresh, bbox)
+    d.on_change(Gen(), bbox)
+    assert(d.get_dependents(d.stop_recording()) == [reader])
@@ -0,0 +1,318 @@
+import math
+import pickle
+
+import numpy
+
+from procodile.draw import Vertex, Edge, Face, Surface, Box, Cylinder, \
+                           Cone, Rectangle, Disc, Prototype, Instance, \
+                           MeshTemplates, templates
+import procodile.draw as draw
+from procodile.utils import Matrix
+from procodile.narrowphase import get_triangles
+
+def make_surface():
+    # triangles of areas 2 (xy plane) and 0.5 (yz plane)
+    # sharing the edge a-b
+    a, b = Vertex(0, 0, 0), Vertex(0, 1, 0)
+    c, d = Vertex(4, 0, 0), Vertex(0, 0, 1)
+
+    c.tcoord = (1.0, 0.0)
+    d.normal = (0.0, 0.0, 1.0)
+
+    ab = Edge(a, b)
+    f1 = Face(ab, Edge(b, c), Edge(c, a))
+    f2 = Face(ab, Edge(b, d), Edge(d, a))
+
+    return Surface(f1, f2), (a, b, c, d)
+
+def test_mesh_arrays():
+    s, (a, b, c, d) = make_surface()
+    positions, indices, normals, tcoords = s.get_mesh_arrays()
+
+    assert(positions.dtype == numpy.float32)
+    assert(indices.dtype == numpy.uint32)
+    assert(positions.shape == (4, 3) and indices.shape == (2, 3))
+
+    rows = dict((tuple(p), i) for i, p in enumerate(positions.tolist()))
+
+    # normals are weighted by the areas of the faces
+    expected = numpy.array([1, 0, 4]) / 17 ** 0.5
+    assert(numpy.allclose(abs(normals[rows[(0, 0, 0)]]), expected))
+
+    # normals given to vertices are kept
+    assert(normals[rows[(0, 0, 1)]].tolist() == [0, 0, 1])
+
+    assert(tcoords[rows[(4, 0, 0)]].tolist() == [1, 0])
+    assert(numpy.isnan(tcoords[rows[(0, 1, 0)]]).all())
+
+def test_mesh():
+    s, (a, b, c, d) = make_surface()
+    vertices, indices, normals, tcoords = s.mesh
+
+    assert(len(vertices) == len(normals) == len(tcoords) == 4)
+    assert(all(isinstance(v, tuple) for v in vertices))
+    assert(tcoords[vertices.index((4.0, 0.0, 0.0))] == (1.0, 0.0))
+    assert(tcoords[vertices.index((0.0, 1.0, 0.0))] is None)
+    assert(sorted(i for f in indices for i in f) == [0, 0, 1, 1, 2, 3])
+
+def test_instance():
+    box = Box(2, 1, 1)
+    prototype = Prototype(box)
+
+    a = Instance(prototype, Matrix((10, 0, 0)))
+    b = Instance(prototype)
+    b.rotate(0, 0, 1, math.pi / 2)
+    b.translate(0, 5, 0)
+
+    assert(numpy.allclose(a.get_bound_box(), (10, 0, 0, 12, 1, 1)))
+    assert(numpy.allclose(b.get_bound_box(), (-1, 5, 0, 0, 7, 1)))
+
+    # the bound box is cached and moved along while it can be
+    b.translate(1, 0, 0)
+    assert(b._bbox is not None)
+    assert(numpy.allclose(b.get_bound_box(), (0, 5, 0, 1, 7, 1)))
+    b.rotate(0, 0, 1, math.pi / 4)
+    assert(b._bbox is None)
+    points = b.get_vertices()
+    assert(numpy.allclose(b.get_bound_box(),
+                          list(points.min(axis=0)) + list(points.max(axis=0))))
+    b.rotate(0, 0, 1, -math.pi / 4)
+    b.translate(-1, 0, 0)
+
+    positions, indices, normals, tcoords = a.get_mesh_arrays()
+    assert(positions.shape == (24, 3) and indices.shape == (12, 3))
+    assert(indices.max() == 23)
+
+    # normals turn with the instance
+    meshes = dict(b.get_meshes())
+    assert(numpy.allclose(abs(meshes['front'][2]), (1, 0, 0)))
+
+    # and stay perpendicular to faces under non-uniform scaling
+    d = Instance(prototype, Matrix(numpy.array([[1, 1, 0, 0],
+                                                [0, 1, 0, 0],
+                                                [0, 0, 3, 0],
+                                                [0, 0, 0, 1.]])))
+    positions, indices, normals, tcoords = d.get_mesh_arrays(numpy.float64)
+    triangles = positions[indices]
+    for i in range(3):
+        edge = triangles[:, (i + 1) % 3] - triangles[:, i]
+        dots = (normals[indices[:, i]] * edge).sum(axis=1)
+        assert(numpy.allclose(dots, 0))
+    assert(numpy.allclose((normals * normals).sum(axis=1), 1))
+
+    # meshes of the prototype are made once
+    assert(prototype.get_meshes() is prototype._meshes)
+    assert(len(get_triangles(b)) == 12)
+
+    a.generator = object()
+    c = pickle.loads(pickle.dumps(a, pickle.HIGHEST_PROTOCOL))
+    assert(c.generator is None)
+    assert(numpy.allclose(c.get_bound_box(), a.get_bound_box()))
+
+def get_faces(geom):
+    faces = []
+    for name, s in sorted(geom.surfaces.items()):
+        for f in s._obj.faces():
+            faces.append((name, tuple((v.x, v.y, v.z) for v in f.vertices())))
+    return sorted(faces)
+
+def test_templates():
+    templates.clear()
+
+    a = Cylinder(1, 2, 8)
+    hits = templates.hits
+    b = Cylinder(1, 2, 8)
+    assert(templates.hits == hits + 1)
+    assert(get_faces(a) == get_faces(b))
+
+    # copies do not share vertices
+    b.translate(5, 0, 0)
+    assert(get_faces(Cylinder(1, 2, 8)) == get_faces(a))
+
+    top = b.surfaces['top']
+    assert(len(top.disc_vertices) == 8)
+    assert(top.center.position == (5, 0, 2))
+
+    # the first one (a miss) is given a copy as well
+    for top in (a.surfaces['top'], b.surfaces['top']):
+        ids = set(v.id for v in top.vertices)
+        for v in top.disc_vertices + [top.center]:
+            assert(v.id in ids and v._update_target is top)
+            assert(v.tcoord == top.tcoords[v.id])
+
+    # attributes are not shared by copies
+    surface, vertices = make_surface()
+    surface.names = ['a']
+    t = draw._SurfaceTemplate(surface)
+    x, y = t.stamp(), t.stamp()
+    x.names.append('b')
+    assert(y.names == surface.names == ['a'])
+
+    # templates are told apart by type and dimensions
+    assert(get_faces(Cone(1, 2, 8)) != get_faces(a))
+    assert(get_faces(Cylinder(1, 3, 8)) != get_faces(a))
+
+    t = MeshTemplates(max_entries=2)
+    for size in (1, 2, 3):
+        t.make(Box(size, 1, 1), (Box, size))
+    assert(len(t) == 2)
+
+def assert_same_mesh(a, b):
+    for x, y in zip(a.get_mesh_arrays(numpy.float64),
+                    b.get_mesh_arrays(numpy.float64)):
+        assert(x.shape == y.shape)
+        assert(numpy.allclose(numpy.nan_to_num(x), numpy.nan_to_num(y)))
+
+def test_template_surfaces():
+    saved = draw.templates
+
+    try:
+        for make in (lambda: Rectangle(2, 3), lambda: Disc(2, 6)):
+            # built without templates
+            draw.templates = MeshTemplates(max_entries=0)
+            plain = make()
+
+            t = draw.templates = MeshTemplates()
+            first, second = make(), make()
+            assert((t.hits, t.misses) == (1, 1))
+
+            assert_same_mesh(first, plain)
+            assert_same_mesh(second, plain)
+
+            # copies do not share vertices
+            second.translate(1, 0, 0)
+            assert_same_mesh(make(), plain)
+            xmin = second.get_bound_box()[0]
+            assert(abs(xmin - plain.get_bound_box()[0] - 1) < 1e-9)
+    finally:
+        draw.templates = saved
+
+def test_deferred_transform():
+    surface, (a, b, c, d) = make_surface()
+    points = get_triangles(surface).reshape(-1, 3)
+
+    surface.rotate(0, 0, 1, math.pi / 2)
+    surface.translate(10, 0, 0)
+    surface.translate(0, 5, 0)
+
+    # nothing applied till the geometry is needed
+    assert(surface._pending is not None)
+
+    matrix = Matrix.get_translation_matrix((10, 5, 0)).multiply(
+             Matrix.get_rotation_matrix((math.pi / 2, (0, 0, 1)), True))
+    expected = matrix.transform_points(points)
+
+    bbox = surface.get_bound_box()
+    assert(surface._pending is not None)
+    assert(numpy.allclose(bbox, tuple(expected.min(axis=0)) +
+                                tuple(expected.max(axis=0))))
+
+    # normals turn with the surface
+    assert(numpy.allclose(surface.vnormals[d.id], (0, 0, 1)))
+    surface.rotate(1, 0, 0, math.pi / 2)
+    data = pickle.loads(pickle.dumps(surface))
+    assert(surface._pending is None)
+
+    matrix = Matrix.get_rotation_matrix((math.pi / 2, (1, 0, 0)), True). \
+             multiply(matrix)
+    expected = matrix.transform_points(points)
+    assert(numpy.allclose(get_triangles(surface).reshape(-1, 3), expected))
+    assert(numpy.allclose(get_triangles(data).reshape(-1, 3), expected))
+    assert(numpy.allclose(surface.vnormals[d.id], (0, -1, 0)))
+
+    # and stay perpendicular to faces under shearing
+    a, b, c = Vertex(0, 0, 0), Vertex(0, 1, 0), Vertex(4, 0, 0)
+    c.normal = (0.0, 0.0, 1.0)
+    surface = Surface(Face(Edge(a, b), Edge(b, c), Edge(c, a)))
+    surface.transform(Matrix(numpy.array([[1, 0, 1, 0],
+                                          [0, 1, 0, 0],
+                                          [0, 0, 2, 0],
+                                          [0, 0, 0, 1.]])))
+    surface.get_mesh_arrays()
+    assert(numpy.allclose(surface.vnormals[c.id], (0, 0, 1)))
+
+def test_primitive_sides():
+    # the caps are made (and moved up) before the sides
+    # when their templates are not around yet
+    templates.clear()
+
+    for geom in (Cylinder(1, 2, 8), Cone(1, 2, 8)):
+        points = get_triangles(geom.surfaces['side']).reshape(-1, 3)
+        assert(numpy.allclose(points[:, 2].min(), 0))
+        assert(numpy.allclose(points[:, 2].max(), 2))
+
+    # the side of a cone meets at the apex
+    top = points[numpy.isclose(points[:, 2], 2)]
+    assert(numpy.allclose(top[:, :2], 0))
+
+def test_parts():
+    # made afresh (template miss) and stamped (hit)
+    templates.clear()
+
+    for disc in (Disc(1, 6), Disc(1, 6)):
+        disc.translate(0, 0, 2)
+        assert(disc.center.position == (0, 0, 2))
+
+        v = disc.disc_vertices[0]
+        assert(numpy.allclose(v.position, (1, 0, 2)))
+
+        # not moved again by the disc
+        v.z = 3
+        assert(numpy.allclose(disc.disc_vertices[0].position, (1, 0, 3)))
+        assert(disc.get_bound_box()[5] == 3)
+
+    a, b, c = Vertex(0, 0, 0), Vertex(0, 1, 0), Vertex(4, 0, 0)
+    face = Face(Edge(a, b), Edge(b, c), Edge(c, a))
+
+    surface = Surface()
+    surface.add(face)
+    surface.translate(1, 0, 0)
+    assert(sorted(v.x for v in face.vertices) == [1, 1, 5])
+
+    face.translate(0, 0, 1)
+    assert(surface.get_bound_box() == (1, 0, 1, 5, 1, 1))
+
+def get_exact_bbox(geom):
+    points = get_triangles(geom).reshape(-1, 3)
+    return tuple(points.min(axis=0)) + tuple(points.max(axis=0))
+
+def test_bbox_cache():
+    box = Box(2, 4, 6)
+    bbox = box.get_bound_box()
+    assert(numpy.allclose(bbox, get_exact_bbox(box)))
+
+    # moved along with the geom
+    box.translate(1, 2, 3)
+    box.rotate(0, 0, 1, math.pi / 2)
+    cached = [s._bbox for s in box.surfaces.itervalues()]
+    assert(None not in cached and box._bbox is not None)
+    assert(numpy.allclose(box.get_bound_box(), get_exact_bbox(box)))
+
+    # dropped by other rotations and worked out again
+    box.rotate(1, 1, 0, 0.3)
+    assert(set(s._bbox for s in box.surfaces.itervalues()) == set([None]))
+    assert(box._bbox is None)
+    assert(numpy.allclose(box.get_bound_box(), get_exact_bbox(box)))
+
+    # and by changes to the surfaces of a group
+    box.remove('top')
+    assert(numpy.allclose(box.get_bound_box(), get_exact_bbox(box)))
+
+    surface, (a, b, c, d) = make_surface()
+    assert(surface.get_bound_box() == (0, 0, 0, 4, 1, 1))
+
+    # moving vertices through wrappers of parts
+    for v in surface.vertices:
+        if v.x == 4:
+            v.x = 8
+    assert(surface.get_bound_box() == (0, 0, 0, 8, 1, 1))
+
+    e = Vertex(0, -3, 0)
+    face = Face(Edge(a, e), Edge(e, b), Edge(b, a))
+    assert(face.get_bound_box() == (0, -3, 0, 0, 1, 0))
+    surface.add(face)
+    assert(surface.get_bound_box() == (0, -3, 0, 8, 1, 1))
+
+    # parts see transforms of the surface
+    surface.translate(1, 0, 0)
+    assert(face.get_bound_box() == (1, -3, 0, 1, 1, 0))
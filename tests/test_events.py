@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+from procodile.events import EventBatcher
+
+def test_flush_size():
+    batches = []
+    b = EventBatcher(batches.append, flush_size=2, flush_interval=100)
+
+    for i in range(5):
+        b('add_material', (i,))
+
+    assert([len(x) for x in batches] == [2, 2])
+    b.flush()
+    assert([len(x) for x in batches] == [2, 2, 1])
+
+def test_coalesce():
+    batches = []
+    b = EventBatcher(batches.append, flush_size=100, flush_interval=100)
+    gen, geom1, geom2 = object(), object(), object()
+
+    b('add_gen', (gen, None))
+    b('add_geom', (gen, geom1))
+    b('del_geom', (gen, geom2))
+    b('del_geom', (gen, geom1))
+    b('del_gen', (gen, None))
+    b.flush()
+
+    assert(batches == [[('del_geom', (gen, geom2))]])
+
+    # deletion in a later batch is delivered
+    b('add_geom', (gen, geom1))
+    b.flush()
+    b('del_geom', (gen, geom1))
+    b.flush()
+    assert(len(batches) == 3)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import random
+
+from procodile.indexbackend import RtreeBackend, NumpyBackend, GridBackend, \
+                                   QUERIES, get_backend
+
+def make_box(r, size):
+    x, y, z = r.uniform(0, 100), r.uniform(0, 100), r.uniform(0, 10)
+    w = r.uniform(0, size)
+    return (x, y, z, x + w, y + w, z + w)
+
+def intersects(a, b):
+    return all(a[i] <= b[i + 3] and b[i] <= a[i + 3] for i in range(3))
+
+def contains(a, b):
+    return all(a[i] <= b[i] and b[i + 3] <= a[i + 3] for i in range(3))
+
+MATCHES = {
+    'intersection': intersects,
+    'within': lambda bbox, q: intersects(bbox, q) and contains(q, bbox),
+    'surrounding': lambda bbox, q: intersects(bbox, q) and
+                                   not contains(q, bbox),
+    'enclosing': lambda bbox, q: contains(bbox, q),
+}
+
+def check_backend(make_backend):
+    r = random.Random(0)
+
+    entries = [(i, make_box(r, 5)) for i in range(200)]
+    # some large entries
+    entries.extend((i, make_box(r, 80)) for i in range(200, 210))
+
+    backend = make_backend(entries[:100])
+    for _id, bbox in entries[100:]:
+        backend.insert(_id, bbox)
+
+    for _id, bbox in entries[::3]:
+        backend.delete(_id, bbox)
+
+    live = dict(entries)
+    for _id, bbox in entries[::3]:
+        del live[_id]
+
+    assert(backend.get_size() == len(live))
+
+    queries = [make_box(r, 20) for i in range(50)]
+    queries.append((-1000, -1000, -1000, 1000, 1000, 1000))
+
+    for q in queries:
+        expected = sorted(_id for _id, bbox in live.iteritems()
+                          if intersects(bbox, q))
+        assert(sorted(backend.intersection(q)) == expected)
+
+        for query in QUERIES:
+            match = MATCHES[query]
+            expected = sorted(_id for _id, bbox in live.iteritems()
+                              if match(bbox, q))
+            assert(sorted(backend.query(q, query)) == expected)
+
+    # a box inside an entry
+    _id, bbox = live.items()[0]
+    q = bbox[:3] + bbox[:3]
+    assert(_id in backend.query(q, 'enclosing'))
+
+def test_rtree():
+    check_backend(RtreeBackend)
+
+def test_numpy():
+    check_backend(NumpyBackend)
+
+def test_grid():
+    check_backend(lambda entries=None: GridBackend(entries, cell_size=4))
+
+def test_get_backend():
+    assert(get_backend(None) is RtreeBackend)
+    assert(get_backend('grid') is GridBackend)
+
+    try:
+        get_backend('nonexistent')
+    except ValueError:
+        pass
+    else:
+        assert(False)
+
+def distance(bbox, point):
+    d = [max(bbox[i] - point[i], point[i] - bbox[i + 3], 0) for i in range(3)]
+    return sum(v * v for v in d)
+
+def check_nearest(make_backend):
+    r = random.Random(1)
+    entries = [(i, make_box(r, 5)) for i in range(300)]
+
+    backend = make_backend(entries)
+    for _id, bbox in entries[::2]:
+        backend.delete(_id, bbox)
+
+    live = entries[1::2]
+
+    for i in range(20):
+        point = make_box(r, 0)[:3]
+        expected = sorted(distance(bbox, point) for _id, bbox in live)
+
+        ids = backend.nearest(point, 5)
+        boxes = dict(live)
+        found = [distance(boxes[_id], point) for _id in ids]
+
+        assert(len(ids) >= 5)
+        assert(found[:5] == expected[:5])
+
+    assert(len(backend.nearest((0, 0, 0), 1000)) == len(live))
+
+def test_nearest():
+    check_nearest(RtreeBackend)
+    check_nearest(NumpyBackend)
+    check_nearest(GridBackend)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import math
+
+from procodile.draw import Box
+from procodile.utils import Matrix
+from procodile.narrowphase import get_triangles, filter_geoms
+
+def make_bar():
+    # 10 x 1 x 1 bar along the diagonal of the xy plane
+    bar = Box(10, 1, 1)
+    bar.rotate(0, 0, 1, math.pi / 4)
+    return bar
+
+def test_triangles():
+    assert(get_triangles(Box(1, 2, 3)).shape == (12, 3, 3))
+
+def test_intersection():
+    bar = make_bar()
+    big = Box(20, 20, 20)
+    big.translate(-5, -5, -5)
+
+    # within the bound box of the bar but away from it
+    corner = (6, 0, 0, 7, 1, 1)
+    # on the bar
+    middle = (3, 3, 0, 4, 4, 1)
+
+    assert(filter_geoms([bar], corner, 'intersection') == [])
+    assert(filter_geoms([bar], middle, 'intersection') == [bar])
+
+    # a box deep inside a solid touches none of its faces
+    assert(filter_geoms([bar, big], corner, 'intersection') == [big])
+    assert(filter_geoms([bar, big], middle, 'enclosing') == [big])
+    assert(filter_geoms([bar, big], middle, 'surrounding') == [bar, big])
+
+def test_within():
+    bar = make_bar()
+    bbox = (-0.8, -0.1, -0.1, 7.2, 7.9, 1.1)
+
+    assert(filter_geoms([bar], bbox, 'within') == [bar])
+
+    # the same box in a frame rotated back onto the bar
+    frame = Matrix((0, 0, 0), (0, 0, math.pi / 4))
+    bbox = (-0.1, -0.1, -0.1, 10.1, 1.1, 1.1)
+    assert(filter_geoms([bar], bbox, 'within', frame.inverse()) == [bar])
+    bbox = (-0.1, -0.1, -0.1, 9, 1.1, 1.1)
+    assert(filter_geoms([bar], bbox, 'within', frame.inverse()) == [])
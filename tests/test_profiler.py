@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import cStringIO
+
+from procodile.buildspace import BuildSpace
+from procodile.profiler import BuildProfiler
+from procodile.procedural import rungen
+
+from gens import Base
+
+class Gen:
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.info = None
+        self.children = []
+        if parent:
+            parent.children.append(self)
+
+class Root(Gen): pass
+class Child(Gen): pass
+
+def test_nesting():
+    p = BuildProfiler(count_vertices=False)
+    root = Root('root')
+    child = Child('child', root)
+
+    p.on_generator_start(root)
+    p.on_generator_start(child)
+    p.on_index_written(child, 0.5)
+    p.on_generator_end(child)
+    p.on_generator_end(root)
+
+    assert(root.stats.child_time == child.stats.total_time)
+    assert(child.stats.self_time == child.stats.total_time)
+    assert(child.stats.index_time == 0.5)
+
+    report = p.get_report(root).split('\n')
+    assert(report[0].startswith('Root (root)'))
+    assert(report[1].startswith('  Child (child)'))
+
+    stream = cStringIO.StringIO()
+    p.write_collapsed(root, stream)
+    lines = stream.getvalue().splitlines()
+    assert([l.split()[0] for l in lines] == ['Root', 'Root;Child'])
+
+    assert(sorted(p.get_class_stats()) == ['Child', 'Root'])
+
+class Failing(Base):
+    def generate(self, config):
+        raise ValueError('failed')
+
+def test_failure():
+    p = BuildProfiler()
+    bspace = BuildSpace(profiler=p)
+
+    try:
+        rungen(Failing, Failing.make_config(), bspace=bspace)
+    except ValueError:
+        pass
+    else:
+        assert(False)
+
+    # the generator is done with even though it failed
+    assert(p._stack == [])
+    assert(len(p.stats) == 1)
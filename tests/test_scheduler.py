@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import procodile.scheduler as sched
+from procodile.buildspace import BoundBox
+
+class Gen:
+    def __init__(self, depth, bbox=None):
+        self.depth = depth
+        self.bbox = bbox or BoundBox()
+
+def _entries(*parents):
+    return [sched.QueueEntry(str(i), p) for i, p in enumerate(parents)]
+
+def _run_order(scheduler, entries):
+    for e in entries:
+        scheduler.push(e)
+    return [e.run_fn for e in scheduler.drain()]
+
+def test_fifo_lifo():
+    entries = _entries(None, Gen(0), Gen(1))
+    assert(_run_order(sched.FIFOScheduler(), entries) == ['0', '1', '2'])
+    assert(_run_order(sched.LIFOScheduler(), entries) == ['2', '1', '0'])
+
+def test_queue_entry_depth():
+    e = sched.QueueEntry(None, Gen(3))
+    assert(e.depth == 4)
+    assert(sched.QueueEntry(None).depth == 0)
+
+def test_shallowest_first():
+    entries = _entries(Gen(2), Gen(0), Gen(1), Gen(0))
+    order = _run_order(sched.ShallowestFirstScheduler(), entries)
+
+    # equal keys retain queue order
+    assert(order == ['1', '3', '2', '0'])
+
+def test_largest_bbox_first():
+    small = Gen(0, BoundBox(0, 0, 0, 1, 1, 0))
+    large = Gen(0, BoundBox(0, 0, 0, 10, 10, 0))
+    entries = _entries(small, large)
+    order = _run_order(sched.LargestBBoxFirstScheduler(), entries)
+    assert(order == ['1', '0'])
+
+    # declared bbox takes precedence over parent's
+    e = sched.QueueEntry('x', small, BoundBox(0, 0, 0, 100, 0, 0))
+    order = _run_order(sched.LargestBBoxFirstScheduler(), entries + [e])
+    assert(order == ['x', '1', '0'])
+
+    # parents' bboxes are read once they have stopped growing
+    s = sched.LargestBBoxFirstScheduler()
+    growing = Gen(0, BoundBox(0, 0, 0, 1, 1, 0))
+    entries = _entries(large, growing)
+    for e in entries:
+        s.push(e)
+    growing.bbox.merge(BoundBox(0, 0, 0, 20, 20, 0))
+    assert(len(s) == 2)
+    assert([e.run_fn for e in s.drain()] == ['1', '0'])
+
+def test_priority_key():
+    entries = _entries(Gen(0), Gen(5), Gen(2))
+    s = sched.PriorityScheduler(lambda e: -e.depth)
+    assert(_run_order(s, entries) == ['1', '2', '0'])
+    assert(len(s) == 0)